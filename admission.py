@@ -0,0 +1,142 @@
+"""Admission control of the routes that query the backends.
+
+Each client has a token bucket refilled at `rate` tokens per second up to `burst` tokens. A request takes as many
+tokens as it may cost (`get_cost`): one token per cell query of the default `limit`, so a grid request takes 54. The
+routes take them on a miss of the response cache only, as a cached response costs no backend query.
+Independently, at most `max_concurrency` computations per worker query the backends at a time; the others wait up to
+`queue_timeout` seconds for a slot. Rejected requests are answered with 429 and `Retry-After`.
+Buckets and slots are kept per process; with several gunicorn workers, each worker enforces its own.
+"""
+import asyncio
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from typing import Mapping, Optional
+
+import metrics
+from params import TooManyRequests
+
+DEFAULT_LIMIT = 10
+# An export reads a whole cell, so it takes a full bucket: a client can start one every `burst / rate` seconds.
+EXPORT_COST = float('inf')
+
+
+def get_cost(num_cells: int, limit: int) -> float:
+    """The cost of a request querying `num_cells` cells of `limit` pages, in cell queries of the default `limit`."""
+    return num_cells * max(1, math.ceil(limit / DEFAULT_LIMIT))
+
+
+class TokenBuckets:
+
+    def __init__(self, rate: float, burst: float, max_clients: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()  # client -> (tokens, time of the last update)
+
+    def take(self, client: str, cost: float) -> float:
+        """Take `cost` tokens from the bucket of `client`.
+
+        Returns 0 if they were taken, or else the seconds until they are available. A request costing more than
+        `burst` is admitted on a full bucket.
+        """
+        cost = min(cost, self.burst)
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0.
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                wait = (cost - tokens) / self.rate
+            self.buckets[client] = (tokens, now)
+            while len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        return wait
+
+
+class AdmissionControl:
+
+    def __init__(
+            self,
+            enabled: bool,
+            max_limit: int = 100,
+            rate: float = 10.,
+            burst: float = 120.,
+            max_concurrency: int = 8,
+            queue_timeout: float = 1.,
+            client_header: str = '',
+    ):
+        self.enabled = enabled
+        self.max_limit = max_limit
+        self.buckets = TokenBuckets(rate, burst)
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.client_header = client_header
+        self.semaphore = threading.BoundedSemaphore(max_concurrency) if enabled and max_concurrency else None
+
+    @property
+    def limit_cap(self) -> Optional[int]:
+        """The largest `limit` served, or None (no cap) when admission control is disabled."""
+        return self.max_limit if self.enabled else None
+
+    def get_client(self, remote_addr: Optional[str], headers: Mapping[str, str]) -> str:
+        """Identify a client by its address, or by the address its proxy appended to `client_header`."""
+        if self.client_header and headers.get(self.client_header):
+            return headers[self.client_header].split(',')[-1].strip()
+        return remote_addr or ''
+
+    def admit(self, client: str, cost: float):
+        """Raise `TooManyRequests` if `client` has used up its tokens."""
+        if not self.enabled:
+            return
+        wait = self.buckets.take(client, cost)
+        if wait > 0:
+            metrics.record_rejected('rate')
+            raise TooManyRequests('Too many requests. Retry later.', retry_after=math.ceil(wait))
+
+    def reject_busy(self):
+        metrics.record_rejected('concurrency')
+        raise TooManyRequests('The server is busy. Retry later.', retry_after=max(1, math.ceil(self.queue_timeout)))
+
+    @contextmanager
+    def backend_slot(self):
+        """Hold one of the `max_concurrency` slots of backend calls while the block runs."""
+        if self.semaphore is None:
+            yield
+            return
+        if not self.semaphore.acquire(timeout=self.queue_timeout):
+            self.reject_busy()
+        try:
+            yield
+        finally:
+            self.semaphore.release()
+
+
+class AsyncAdmissionControl(AdmissionControl):
+    """`AdmissionControl` for coroutines running on one event loop."""
+
+    def __init__(self, enabled: bool, **kwargs):
+        super().__init__(enabled, **kwargs)
+        self.semaphore = None
+        self.async_semaphore: Optional[asyncio.Semaphore] = None
+
+    @asynccontextmanager
+    async def backend_slot(self):
+        if not self.enabled or not self.max_concurrency:
+            yield
+            return
+        if self.async_semaphore is None:
+            self.async_semaphore = asyncio.Semaphore(self.max_concurrency)  # created on the loop that uses it
+        try:
+            await asyncio.wait_for(self.async_semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.reject_busy()
+        try:
+            yield
+        finally:
+            self.async_semaphore.release()
@@ -1,56 +1,67 @@
 """An API server for covid-19-ui."""
 import json
 from datetime import datetime
+from typing import Callable
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
-from mojimoji import han_to_zen
 
+import metrics
+import query_profiler
+from admission import EXPORT_COST, AdmissionControl, get_cost
+from cache import create_response_cache
 from db_handler import DBHandler
 from log_handler import LogHandler
 from meta_data_handler import MetaDataHandler
+from page_export import iterate_chunks
+from single_flight import SingleFlight
+from suggest_index import TOP_K, get_suggest_index
+from params import (
+    InvalidUsage,
+    InvalidPassword,
+    TooManyRequests,
+    get_start,
+    get_limit,
+    get_lang,
+    get_query,
+    get_with_total,
+    get_date_range,
+    get_export_cell,
+    get_icountries,
+    get_queue_args,
+    get_queue_order,
+    get_visible_only,
+    get_page_edit,
+    get_page_edits,
+)
 from slack_handler import SlackHandler
 from util import load_config
 
 
-class InvalidUsage(Exception):
-
-    status_code = 400
-
-    def __init__(self, message, status_code=None, payload=None):
-        Exception.__init__(self)
-        self.message = message
-        if status_code is not None:
-            self.status_code = status_code
-        self.payload = payload
-
-    def to_dict(self):
-        rv = dict(self.payload or ())
-        rv['message'] = self.message
-        return rv
-
+cfg = load_config()
 
-class InvalidPassword(Exception):
+metrics.install()
+query_profiler.install(cfg['db_handler']['mongo_host'], cfg['db_handler']['mongo_port'], **cfg['query_profiler'])
 
-    status_code = 403
+response_cache = create_response_cache(**cfg['response_cache'])
+single_flight = SingleFlight(**cfg['single_flight'])
+admission = AdmissionControl(**cfg['admission'])
 
-    def __init__(self, message, status_code=None, payload=None):
-        Exception.__init__(self)
-        self.message = message
-        if status_code is not None:
-            self.status_code = status_code
-        self.payload = payload
+app = Flask(__name__)
+CORS(app, **cfg['cors'])
 
-    def to_dict(self):
-        rv = dict(self.payload or ())
-        rv['message'] = self.message
-        return rv
 
+@app.before_request
+def start_request():
+    g.request_stats = metrics.start_request()
 
-cfg = load_config()
 
-app = Flask(__name__)
-CORS(app, **cfg['cors'])
+@app.after_request
+def finish_request(response):
+    response.headers['Server-Timing'] = metrics.finish_request(
+        g.request_stats, request.endpoint or 'unknown', response.status_code, response.calculate_content_length() or 0
+    )
+    return response
 
 
 @app.route('/')
@@ -58,45 +69,84 @@ def index():
     return jsonify({})
 
 
-def get_start() -> int:
-    start = request.args.get('start', '0')  # NOTE: set the default value as a string object.
-    if not start.isdecimal():
-        raise InvalidUsage('Parameter `start` must be an integer.')
-    return int(start)
-
+def cached_jsonify(key, build, charge: Callable[[], None] = None):
+    """Serialize the result of `build`, reusing the serialized response while the data generation is unchanged.
 
-def get_limit() -> int:
-    limit = request.args.get('limit', '10')  # NOTE: set the default value as a string object.
-    if not limit.isdecimal():
-        raise InvalidUsage('Parameter `limit` must be an integer.')
-    return int(limit)
+    Concurrent requests for the same key share one call of `build`. `charge` is called on a miss of the response cache
+    only, so that repeated requests served from it are not throttled.
+    """
+    if response_cache is None:
+        if charge is not None:
+            charge()
+        return jsonify(single_flight.do(key, build))
 
+    def build_body() -> bytes:
+        if charge is not None:
+            charge()
+        return single_flight.do(key, lambda: jsonify(build()).get_data())
 
-def get_lang() -> str:
-    lang = request.args.get('lang', 'ja')
-    if lang not in {'ja', 'en'}:
-        raise InvalidUsage('Allowed languages are `ja` and `en`.')
-    return lang
+    return Response(response_cache.get_or_build(key, build_body), mimetype='application/json')
 
 
-def get_query() -> str:
-    return request.args.get('query', '')
+def admit(num_cells: int, limit: int):
+    admission.admit(admission.get_client(request.remote_addr, request.headers), get_cost(num_cells, limit))
 
 
 @app.route('/classes')
 @app.route('/classes/<class_>')
 @app.route('/classes/<class_>/<country>')
 def classes(class_=None, country=None):
-    db_handler = DBHandler(**cfg['db_handler'])
-    return jsonify(db_handler.classes(class_, country, get_start(), get_limit(), get_lang(), get_query()))
+    args = request.args
+    start, limit, lang, query = get_start(args), get_limit(args, admission.limit_cap), get_lang(args), get_query(args)
+    with_total, (since, until) = get_with_total(args), get_date_range(args)
+    if class_ == 'search':
+        admit(len(DBHandler.get_search_cells(country)), limit)
+
+    def build():
+        db_handler = DBHandler(**cfg['db_handler'])
+        with admission.backend_slot():
+            return db_handler.classes(class_, country, start, limit, lang, query, with_total, since, until)
+
+    if class_ == 'search':
+        return jsonify(single_flight.do(('classes', class_, country, start, limit, lang, query, since, until), build))
+    return cached_jsonify(('classes', class_, country, start, limit, lang, with_total, since, until), build,
+                          lambda: admit(len(DBHandler.get_class_cells(class_, country)), limit))
 
 
 @app.route('/countries')
 @app.route('/countries/<country>')
 @app.route('/countries/<country>/<class_>')
 def countries(country=None, class_=None):
+    args = request.args
+    start, limit, lang = get_start(args), get_limit(args, admission.limit_cap), get_lang(args)
+    with_total, (since, until) = get_with_total(args), get_date_range(args)
+    def build():
+        db_handler = DBHandler(**cfg['db_handler'])
+        with admission.backend_slot():
+            return db_handler.countries(country, class_, start, limit, lang, with_total, since, until)
+
+    return cached_jsonify(('countries', country, class_, start, limit, lang, with_total, since, until), build,
+                          lambda: admit(len(DBHandler.get_country_cells(country, class_)), limit))
+
+
+@app.route('/counts')
+def counts():
+    def build():
+        db_handler = DBHandler(**cfg['db_handler'])
+        return db_handler.page_counts.get_all()
+
+    return cached_jsonify(('counts',), build)
+
+
+@app.route('/export')
+def export():
+    args = request.args
+    (itopics, icountries), lang, (since, until) = get_export_cell(args), get_lang(args), get_date_range(args)
+    admission.admit(admission.get_client(request.remote_addr, request.headers), EXPORT_COST)
+
     db_handler = DBHandler(**cfg['db_handler'])
-    return jsonify(db_handler.countries(country, class_, get_start(), get_limit(), get_lang()))
+    pages = db_handler.export_pages(itopics, icountries, lang, since, until)
+    return Response(stream_with_context(iterate_chunks(pages)), mimetype='application/x-ndjson')
 
 
 @app.route('/update', methods=['POST'])
@@ -107,16 +157,7 @@ def update():
         raise InvalidPassword('The password is not correct')
 
     db_handler = DBHandler(**cfg['db_handler'])
-    updated = db_handler.update_page(
-        url=data.get('url'),
-        is_hidden=data.get('is_hidden'),
-        is_about_covid_19=data.get('is_about_COVID-19'),
-        is_useful=data.get('is_useful'),
-        is_about_false_rumor=data.get('is_about_false_rumor'),
-        icountry=data.get('new_displayed_country'),
-        etopics=data.get('new_classes'),
-        notes=han_to_zen(str(data.get('notes'))),
-    )
+    updated = db_handler.update_page(**get_page_edit(data))
 
     log_handler = LogHandler(**cfg['log_handler'])
     log_handler.extend_topic_check_log([json.dumps(updated, ensure_ascii=False)])
@@ -124,6 +165,39 @@ def update():
     return jsonify(updated)
 
 
+@app.route('/update/batch', methods=['POST'])
+def update_batch():
+    data = request.get_json()
+
+    if data.get('password') != cfg['password']:
+        raise InvalidPassword('The password is not correct')
+
+    db_handler = DBHandler(**cfg['db_handler'])
+    results = db_handler.update_pages(get_page_edits(data))
+
+    log_handler = LogHandler(**cfg['log_handler'])
+    log_handler.extend_topic_check_log(
+        [json.dumps(result['updated'], ensure_ascii=False) for result in results if result['status'] == 'updated']
+    )
+
+    return jsonify(results)
+
+
+@app.route('/queue', methods=['POST'])
+def queue():
+    data = request.get_json()
+
+    if data.get('password') != cfg['password']:
+        raise InvalidPassword('The password is not correct')
+
+    args = get_queue_args(data)
+    order, icountries, visible_only = get_queue_order(args), get_icountries(args), get_visible_only(args)
+    start, limit, lang = get_start(args), get_limit(args, admission.limit_cap), get_lang(args)
+
+    db_handler = DBHandler(**cfg['db_handler'])
+    return jsonify(db_handler.get_queue(order, icountries, start, limit, lang, visible_only))
+
+
 @app.route('/history', methods=['GET'])
 def history():
     log_handler = LogHandler(**cfg['log_handler'])
@@ -151,8 +225,22 @@ def feedback():
 
 @app.route('/meta')
 def meta():
+    lang = get_lang(request.args)
     meta_data_handler = MetaDataHandler()
-    return jsonify(meta_data_handler.get(get_lang()))
+    return cached_jsonify(('meta', lang), lambda: meta_data_handler.get(lang))
+
+
+@app.route('/suggest')
+def suggest():
+    args = request.args
+    limit, lang = min(get_limit(args), TOP_K), get_lang(args)
+    suggest_index = get_suggest_index(lang)
+    return jsonify(suggest_index.suggest(args.get('q', ''), limit) if suggest_index else [])
+
+
+@app.route('/metrics')
+def show_metrics():
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
 
 
 @app.errorhandler(InvalidUsage)
@@ -167,3 +255,11 @@ def handle_invalid_password(error):
     response = jsonify(error.to_dict())
     response.status_code = error.status_code
     return response
+
+
+@app.errorhandler(TooManyRequests)
+def handle_too_many_requests(error):
+    response = jsonify(error.to_dict())
+    response.status_code = error.status_code
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
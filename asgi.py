@@ -0,0 +1,310 @@
+"""An ASGI variant of the API server for covid-19-ui.
+
+It serves the same routes and responses as `app.py` and can run side by side with it:
+
+    $ uvicorn asgi:app --port 12346
+"""
+import json
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Callable
+
+from starlette.applications import Starlette
+from starlette.background import BackgroundTasks
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+import metrics
+import query_profiler
+from admission import EXPORT_COST, AsyncAdmissionControl, get_cost
+from async_db_handler import AsyncDBHandler
+from db_handler import DBHandler
+from cache import create_response_cache
+from log_handler import LogHandler
+from meta_data_handler import MetaDataHandler
+from page_export import iterate_chunks_async
+from single_flight import AsyncSingleFlight
+from suggest_index import TOP_K, get_suggest_index
+from params import (
+    InvalidUsage,
+    InvalidPassword,
+    TooManyRequests,
+    get_start,
+    get_limit,
+    get_lang,
+    get_query,
+    get_with_total,
+    get_date_range,
+    get_export_cell,
+    get_icountries,
+    get_queue_args,
+    get_queue_order,
+    get_visible_only,
+    get_page_edit,
+    get_page_edits,
+)
+from slack_handler import SlackHandler
+from util import load_config
+
+cfg = load_config()
+
+metrics.install()
+
+response_cache = create_response_cache(**cfg['response_cache'])
+single_flight = AsyncSingleFlight(**cfg['single_flight'])
+admission = AsyncAdmissionControl(**cfg['admission'])
+
+# NOTE: the Motor client is bound to the event loop it is first used on, so the handler is created on startup.
+db_handler: AsyncDBHandler = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global db_handler
+    query_profiler.install(cfg['db_handler']['mongo_host'], cfg['db_handler']['mongo_port'], **cfg['query_profiler'])
+    db_handler = AsyncDBHandler(**cfg['db_handler'])
+    yield
+    await db_handler.close()
+
+
+async def index(request):
+    return JSONResponse({})
+
+
+async def cached_json_response(key, build, charge: Callable[[], None] = None):
+    """Serialize the result of `build`, reusing the serialized response while the data generation is unchanged.
+
+    Concurrent requests for the same key share one call of `build`. `charge` is called on a miss of the response cache
+    only, so that repeated requests served from it are not throttled.
+    """
+    if response_cache is None:
+        if charge is not None:
+            charge()
+        return JSONResponse(await single_flight.do(key, build))
+
+    async def build_body() -> bytes:
+        return JSONResponse(await build()).body
+
+    body = response_cache.get(key)
+    if body is None:
+        if charge is not None:
+            charge()
+        generation = response_cache.generation.current()
+        body = await single_flight.do(key, build_body)
+        response_cache.set(key, body, generation)
+    return Response(body, media_type='application/json')
+
+
+def admit(request, num_cells: int, limit: int):
+    client = admission.get_client(request.client.host if request.client else None, request.headers)
+    admission.admit(client, get_cost(num_cells, limit))
+
+
+async def classes(request):
+    class_ = request.path_params.get('class_')
+    country = request.path_params.get('country')
+    args = request.query_params
+    start, limit, lang, query = get_start(args), get_limit(args, admission.limit_cap), get_lang(args), get_query(args)
+    with_total, (since, until) = get_with_total(args), get_date_range(args)
+    if class_ == 'search':
+        admit(request, len(DBHandler.get_search_cells(country)), limit)
+
+    async def build():
+        async with admission.backend_slot():
+            return await db_handler.classes(class_, country, start, limit, lang, query, with_total, since, until)
+
+    if class_ == 'search':
+        key = ('classes', class_, country, start, limit, lang, query, since, until)
+        return JSONResponse(await single_flight.do(key, build))
+    key = ('classes', class_, country, start, limit, lang, with_total, since, until)
+    return await cached_json_response(
+        key, build, lambda: admit(request, len(DBHandler.get_class_cells(class_, country)), limit)
+    )
+
+
+async def countries(request):
+    country = request.path_params.get('country')
+    class_ = request.path_params.get('class_')
+    args = request.query_params
+    start, limit, lang = get_start(args), get_limit(args, admission.limit_cap), get_lang(args)
+    with_total, (since, until) = get_with_total(args), get_date_range(args)
+    async def build():
+        async with admission.backend_slot():
+            return await db_handler.countries(country, class_, start, limit, lang, with_total, since, until)
+
+    key = ('countries', country, class_, start, limit, lang, with_total, since, until)
+    return await cached_json_response(
+        key, build, lambda: admit(request, len(DBHandler.get_country_cells(country, class_)), limit)
+    )
+
+
+async def counts(request):
+    async def build():
+        return await run_in_threadpool(db_handler.page_counts.get_all)
+
+    return await cached_json_response(('counts',), build)
+
+
+async def export(request):
+    args = request.query_params
+    (itopics, icountries), lang, (since, until) = get_export_cell(args), get_lang(args), get_date_range(args)
+    client = admission.get_client(request.client.host if request.client else None, request.headers)
+    admission.admit(client, EXPORT_COST)
+
+    pages = db_handler.export_pages(itopics, icountries, lang, since, until)
+    return StreamingResponse(iterate_chunks_async(pages), media_type='application/x-ndjson')
+
+
+async def update(request):
+    data = await request.json()
+
+    if data.get('password') != cfg['password']:
+        raise InvalidPassword('The password is not correct')
+
+    updated = await db_handler.update_page(**get_page_edit(data))
+
+    log_handler = LogHandler(**cfg['log_handler'])
+    await run_in_threadpool(log_handler.extend_topic_check_log, [json.dumps(updated, ensure_ascii=False)])
+
+    return JSONResponse(updated)
+
+
+async def update_batch(request):
+    data = await request.json()
+
+    if data.get('password') != cfg['password']:
+        raise InvalidPassword('The password is not correct')
+
+    results = await db_handler.update_pages(get_page_edits(data))
+
+    log_handler = LogHandler(**cfg['log_handler'])
+    await run_in_threadpool(
+        log_handler.extend_topic_check_log,
+        [json.dumps(result['updated'], ensure_ascii=False) for result in results if result['status'] == 'updated'],
+    )
+
+    return JSONResponse(results)
+
+
+async def queue(request):
+    data = await request.json()
+
+    if data.get('password') != cfg['password']:
+        raise InvalidPassword('The password is not correct')
+
+    args = get_queue_args(data)
+    order, icountries, visible_only = get_queue_order(args), get_icountries(args), get_visible_only(args)
+    start, limit, lang = get_start(args), get_limit(args, admission.limit_cap), get_lang(args)
+
+    return JSONResponse(await db_handler.get_queue(order, icountries, start, limit, lang, visible_only))
+
+
+async def history(request):
+    log_handler = LogHandler(**cfg['log_handler'])
+    return JSONResponse(await run_in_threadpool(log_handler.find_topic_check_log, url=request.query_params.get('url')))
+
+
+async def feedback(request):
+    data = await request.json()
+    feedback_content = data.get('content', '')
+    if feedback_content == '':
+        raise InvalidUsage('Feedback content is empty.')
+    if len(feedback_content) > 1000:
+        raise InvalidUsage('Feedback content is too long.')
+
+    # Post to Slack after the response is sent so that a slow Slack API does not hold the request.
+    tasks = BackgroundTasks()
+    for args in cfg['slack_handlers']:
+        tasks.add_task(SlackHandler(**args).post, feedback_content)
+
+    log_handler = LogHandler(**cfg['log_handler'])
+    await run_in_threadpool(log_handler.extend_feedback_log, [f'{datetime.today()}\t{feedback_content}'])
+
+    return JSONResponse({}, background=tasks)
+
+
+async def meta(request):
+    lang = get_lang(request.query_params)
+    meta_data_handler = MetaDataHandler()
+
+    async def build():
+        return await run_in_threadpool(meta_data_handler.get, lang)
+
+    return await cached_json_response(('meta', lang), build)
+
+
+async def suggest(request):
+    args = request.query_params
+    limit, lang = min(get_limit(args), TOP_K), get_lang(args)
+    suggest_index = get_suggest_index(lang)
+    return JSONResponse(suggest_index.suggest(args.get('q', ''), limit) if suggest_index else [])
+
+
+async def show_metrics(request):
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type='text/plain; version=0.0.4')
+
+
+class MetricsMiddleware(BaseHTTPMiddleware):
+
+    async def dispatch(self, request, call_next):
+        stats = metrics.start_request()
+        response = await call_next(request)
+        endpoint = request.scope.get('endpoint')
+        response.headers['Server-Timing'] = metrics.finish_request(
+            stats,
+            endpoint.__name__ if endpoint else 'unknown',
+            response.status_code,
+            int(response.headers.get('content-length', 0)),
+        )
+        return response
+
+
+async def handle_error(request, error):
+    return JSONResponse(error.to_dict(), status_code=error.status_code)
+
+
+async def handle_too_many_requests(request, error):
+    return JSONResponse(error.to_dict(), status_code=error.status_code, headers={'Retry-After': str(error.retry_after)})
+
+
+origins = cfg['cors']['origins']
+app = Starlette(
+    routes=[
+        Route('/', index),
+        Route('/classes', classes),
+        Route('/classes/{class_}', classes),
+        Route('/classes/{class_}/{country}', classes),
+        Route('/countries', countries),
+        Route('/countries/{country}', countries),
+        Route('/countries/{country}/{class_}', countries),
+        Route('/counts', counts),
+        Route('/export', export),
+        Route('/update', update, methods=['POST']),
+        Route('/update/batch', update_batch, methods=['POST']),
+        Route('/queue', queue, methods=['POST']),
+        Route('/history', history, methods=['GET']),
+        Route('/feedback', feedback, methods=['POST']),
+        Route('/meta', meta),
+        Route('/suggest', suggest),
+        Route('/metrics', show_metrics),
+    ],
+    middleware=[
+        Middleware(MetricsMiddleware),
+        Middleware(
+            CORSMiddleware,
+            allow_origins=origins.split(',') if isinstance(origins, str) else origins,
+            allow_methods=['*'],
+            allow_headers=['*'],
+        ),
+    ],
+    exception_handlers={
+        InvalidUsage: handle_error,
+        InvalidPassword: handle_error,
+        TooManyRequests: handle_too_many_requests,
+    },
+    lifespan=lifespan,
+)
@@ -0,0 +1,299 @@
+import asyncio
+import time
+from collections import Counter
+from datetime import datetime
+from typing import AsyncIterator, List, Dict, Optional, Union
+
+from elasticsearch import AsyncElasticsearch, AsyncTransport
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError
+
+from db_handler import DBHandler
+from generation import get_generation
+from local_search import LOCAL_SEARCH_DIR, AsyncFallbackSearch, AsyncLocalSearch, get_local_search
+from metrics import record_es_call
+from page_archive import get_archive_collection_name
+from page_counts import (
+    COUNT_PROJECTION,
+    apply_page_set,
+    get_count_deltas,
+    get_count_requests,
+    get_counts_collection_name,
+    get_page_counts,
+)
+from page_export import EXPORT_BATCH_SIZE, EXPORT_SORT, get_export_projection
+from page_index import get_page_index
+
+
+class InstrumentedAsyncTransport(AsyncTransport):
+    """The asyncio counterpart of `metrics.InstrumentedTransport`, kept here since `AsyncTransport` needs aiohttp."""
+
+    async def perform_request(self, method, url, headers=None, params=None, body=None):
+        start = time.perf_counter()
+        try:
+            return await super().perform_request(method, url, headers=headers, params=params, body=body)
+        finally:
+            record_es_call(method, time.perf_counter() - start)
+
+
+class AsyncDBHandler:
+    """An asyncio counterpart of `DBHandler` for the read and edit paths served by the API.
+
+    Queries are built by the static methods of `DBHandler`, so both handlers return the same documents.
+    The cells of grid and multi-country search requests are fetched concurrently.
+    """
+
+    def __init__(
+            self,
+            mongo_host: str,
+            mongo_port: int,
+            mongo_db_name: str,
+            mongo_collection_name: str,
+            es_host: str,
+            es_port: int,
+            use_page_index: bool = False,
+            use_search_views: bool = False,
+            search_backend: str = 'elasticsearch',
+            local_search_dir: str = LOCAL_SEARCH_DIR,
+            archive_max_age_days: int = 0,
+            dedup: bool = False,  # only used by the ingest of `DBHandler`
+    ):
+        self.mongo = AsyncIOMotorClient(mongo_host, mongo_port)
+        self.db = self.mongo.get_database(mongo_db_name)
+        self.collection = self.db.get_collection(name=mongo_collection_name)
+        self.archive_collection = None
+        if archive_max_age_days:
+            self.archive_collection = self.db.get_collection(name=get_archive_collection_name(mongo_collection_name))
+        if search_backend == 'local':
+            self.es = AsyncLocalSearch(get_local_search(local_search_dir))
+        else:
+            self.es = AsyncElasticsearch(f'{es_host}:{es_port}', transport_class=InstrumentedAsyncTransport)
+            if search_backend == 'fallback':
+                self.es = AsyncFallbackSearch(self.es, get_local_search(local_search_dir))
+        self.page_index = None
+        if use_page_index:
+            self.page_index = get_page_index(
+                mongo_host, mongo_port, mongo_db_name, mongo_collection_name, use_archive=bool(archive_max_age_days)
+            )
+        self.use_search_views = use_search_views
+        self.counts_collection = self.db.get_collection(name=get_counts_collection_name(mongo_collection_name))
+        self.page_counts = get_page_counts(mongo_host, mongo_port, mongo_db_name, mongo_collection_name)
+
+    async def close(self):
+        self.mongo.close()
+        await self.es.close()
+
+    async def classes(
+            self,
+            etopic: str,
+            ecountry: str,
+            start: int,
+            limit: int,
+            lang: str,
+            query: str,
+            with_total: bool = False,
+            since: str = None,
+            until: str = None,
+    ):
+        if etopic == 'search':
+            return await self.search(ecountry, start, limit, lang, query, since, until)
+
+        cells = DBHandler.get_class_cells(etopic, ecountry)
+        return DBHandler.assemble_cells(cells, await asyncio.gather(*(
+            self.get_cell(itopics, icountries, start, limit, lang, with_total, since, until)
+            for _, itopics, icountries in cells
+        )))
+
+    async def countries(
+            self,
+            ecountry: str,
+            etopic: str,
+            start: int,
+            limit: int,
+            lang: str,
+            with_total: bool = False,
+            since: str = None,
+            until: str = None,
+    ):
+        cells = DBHandler.get_country_cells(ecountry, etopic)
+        return DBHandler.assemble_cells(cells, await asyncio.gather(*(
+            self.get_cell(itopics, icountries, start, limit, lang, with_total, since, until)
+            for _, itopics, icountries in cells
+        )))
+
+    async def get_cell(
+            self,
+            itopics: List[str],
+            icountries: List[str],
+            start: int,
+            limit: int,
+            lang: str,
+            with_total: bool,
+            since: str = None,
+            until: str = None,
+    ):
+        pages = await self.get_pages(itopics, icountries, start, limit, lang, since, until)
+        if not with_total:
+            return pages
+        if since or until:
+            return DBHandler.add_total(pages, await self.count_pages(itopics, icountries, since, until), start)
+        await asyncio.get_event_loop().run_in_executor(None, self.page_counts.ensure_fresh)
+        return DBHandler.add_total(pages, self.page_counts.get_total(itopics, icountries), start)
+
+    async def apply_count_deltas(self, deltas: Counter):
+        requests = get_count_requests(deltas)
+        if requests:
+            await self.counts_collection.bulk_write(requests, ordered=False)
+
+    async def search(
+            self, ecountry: str, start: int, limit: int, lang: str, query: str, since: str = None, until: str = None
+    ):
+        index = DBHandler.get_es_index(lang)
+
+        async def search_cell(icountries: List[str]) -> list:
+            body = DBHandler.get_es_query(icountries, query, start, limit, since, until)
+            r = await self.es.search(index=index, body=body)
+            hits = r['hits']['hits']
+            if len(hits) == 0:
+                return []
+            if not self.use_search_views:
+                return DBHandler.reshape_hits(hits, await self.find_hit_docs(hits), lang)
+            pages, stale_hits = DBHandler.reshape_hit_views(hits, lang, await self.find_hit_updates(hits))
+            if stale_hits:
+                pages = DBHandler.sort_hit_pages(
+                    pages + DBHandler.reshape_hits(stale_hits, await self.find_hit_docs(stale_hits), lang)
+                )
+            return pages
+
+        cells = DBHandler.get_search_cells(ecountry)
+        return DBHandler.assemble_cells(cells, await asyncio.gather(*(
+            search_cell(icountries) for _, _, icountries in cells
+        )))
+
+    def get_tiers(self) -> list:
+        return [self.collection] + ([self.archive_collection] if self.archive_collection is not None else [])
+
+    async def find_tier(self, url: str):
+        if self.archive_collection is None or await self.collection.count_documents({'page.url': url}, limit=1):
+            return self.collection
+        if await self.archive_collection.count_documents({'page.url': url}, limit=1):
+            return self.archive_collection
+        return self.collection
+
+    async def find_hit_updates(self, hits: list) -> Dict[str, Optional[datetime]]:
+        filter_ = {'page.url': {'$in': [hit['_source']['url'] for hit in hits]}}
+        updated_ats = {}
+        for collection in self.get_tiers():
+            async for doc in collection.find(filter_, projection=['page.url', 'updated_at']):
+                updated_ats[doc['page']['url']] = doc.get('updated_at')
+        return updated_ats
+
+    async def find_hit_docs(self, hits: list) -> List[dict]:
+        cur = self.collection.find(filter=DBHandler.get_hits_filter(hits), sort=DBHandler.get_sort())
+        docs = await cur.to_list(length=None)
+        missing_hits = DBHandler.get_missing_hits(hits, docs) if self.archive_collection is not None else []
+        if missing_hits:
+            filter_ = DBHandler.get_hits_filter(missing_hits)
+            cur = self.archive_collection.find(filter=filter_, sort=DBHandler.get_sort())
+            docs += await cur.to_list(length=None)
+        return docs
+
+    async def get_pages(
+            self,
+            itopics: List[str],
+            icountries: List[str],
+            start: int,
+            limit: int,
+            lang: str,
+            since: str = None,
+            until: str = None,
+    ) -> List[dict]:
+        if self.page_index is not None:
+            # Refreshing the index reads MongoDB synchronously, so do it off the event loop.
+            await asyncio.get_event_loop().run_in_executor(None, self.page_index.ensure_fresh)
+            return self.page_index.get_pages(itopics, icountries, start, limit, lang, since, until)
+        filter_ = DBHandler.get_filter(itopics, icountries, since, until)
+        sort_ = DBHandler.get_sort(itopics)
+        cur = self.collection.find(filter=filter_, sort=sort_).skip(start).limit(limit)
+        pages = [DBHandler.reshape_page(doc['page'], lang) async for doc in cur]
+        if len(pages) < limit and self.archive_collection is not None:
+            num_hot = start + len(pages) if pages or not start else await self.collection.count_documents(filter_)
+            cur = self.archive_collection.find(filter=filter_, sort=sort_)
+            cur = cur.skip(max(0, start - num_hot)).limit(limit - len(pages))
+            pages += [DBHandler.reshape_page(doc['page'], lang) async for doc in cur]
+        return pages
+
+    async def get_queue(
+            self, order: str, icountries: List[str], start: int, limit: int, lang: str, visible_only: bool = False
+    ) -> List[dict]:
+        filter_ = DBHandler.get_queue_filter(icountries, visible_only)
+        cur = self.collection.find(filter=filter_, sort=DBHandler.get_queue_sort(order))
+        return [DBHandler.reshape_queue_page(doc['page'], lang) async for doc in cur.skip(start).limit(limit)]
+
+    async def count_pages(self, itopics: List[str], icountries: List[str], since: str = None, until: str = None) -> int:
+        if self.page_index is not None:
+            await asyncio.get_event_loop().run_in_executor(None, self.page_index.ensure_fresh)
+            return self.page_index.count_pages(itopics, icountries, since, until)
+        filter_ = DBHandler.get_filter(itopics, icountries, since, until)
+        return sum([await collection.count_documents(filter_) for collection in self.get_tiers()])
+
+    async def export_pages(
+            self, itopics: List[str], icountries: List[str], lang: str, since: str = None, until: str = None
+    ) -> AsyncIterator[dict]:
+        filter_ = DBHandler.get_filter(itopics, icountries, since, until)
+        for collection in self.get_tiers():
+            cur = collection.find(
+                filter=filter_, projection=get_export_projection(lang), sort=EXPORT_SORT, batch_size=EXPORT_BATCH_SIZE
+            )
+            async for doc in cur:
+                yield DBHandler.reshape_page(doc['page'], lang)
+
+    async def update_page(
+            self,
+            url: str,
+            is_hidden: bool,
+            is_about_covid_19: bool,
+            is_useful: bool,
+            is_about_false_rumor: bool,
+            icountry: str,
+            etopics: List[str],
+            notes: str
+    ) -> Dict[str, Union[int, str, List[str]]]:
+        update, updated = DBHandler.get_page_update(
+            url, is_hidden, is_about_covid_19, is_useful, is_about_false_rumor, icountry, etopics, notes
+        )
+        collection = await self.find_tier(url)
+        before = await collection.find_one_and_update(
+            {'page.url': url}, update, projection=COUNT_PROJECTION, upsert=True, return_document=ReturnDocument.BEFORE
+        )
+        before_page: Optional[dict] = before['page'] if before else None
+        await self.apply_count_deltas(get_count_deltas(before_page, apply_page_set(before_page, update['$set'])))
+        get_generation().bump()
+        return updated
+
+    async def update_pages(self, edits: List[Dict]) -> List[Dict]:
+        requests, results = DBHandler.get_page_updates(edits)
+        if requests:
+            urls = list({url for _, url, _ in requests})
+            befores, archived_urls = [], set()
+            for collection in self.get_tiers():
+                cur = collection.find({'page.url': {'$in': urls}}, projection=COUNT_PROJECTION + ['page.url'])
+                for doc in await cur.to_list(length=None):
+                    befores.append(doc['page'])
+                    if collection is self.archive_collection:
+                        archived_urls.add(doc['page']['url'])
+            applied = []
+            tiers_requests = DBHandler.split_page_updates(requests, archived_urls)
+            for collection, tier_requests in zip(self.get_tiers(), tiers_requests):
+                if not tier_requests:
+                    continue
+                try:
+                    await collection.bulk_write(DBHandler.get_bulk_requests(tier_requests), ordered=True)
+                    applied += tier_requests
+                except BulkWriteError as e:
+                    applied += tier_requests[:e.details['writeErrors'][0]['index']]
+                    DBHandler.fail_page_updates(tier_requests, results, e.details)
+            await self.apply_count_deltas(DBHandler.get_page_updates_count_deltas(befores, applied))
+            get_generation().bump()
+        return results
@@ -0,0 +1,89 @@
+"""Generate a synthetic article list in the format of `ARTICLE_LIST`."""
+import json
+import random
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Iterator
+
+from util import ITOPICS, ICOUNTRIES
+
+JA_WORDS = ['感染', '拡大', 'ワクチン', '接種', '検査', '陽性', '病院', '緊急事態', '宣言', '学校', '休校', '経済', '支援', '給付金', '観光']
+EN_WORDS = ['infection', 'spread', 'vaccine', 'rollout', 'testing', 'positive', 'hospital', 'emergency', 'declaration',
+            'school', 'closure', 'economy', 'support', 'benefit', 'tourism']
+
+
+def generate_articles(
+        num_articles: int, seed: int = 0, num_domains: int = 200, days: int = 365, duplicate_rate: float = 0.
+) -> Iterator[dict]:
+    """Yield `num_articles` articles. The same `seed` always yields the same articles.
+
+    A `duplicate_rate` share of them are one of the 100 previous articles republished by another site.
+    """
+    rnd = random.Random(seed)
+    duplicate_rnd = random.Random(seed + 1)  # so that the other articles do not depend on `duplicate_rate`
+    recent = deque(maxlen=100)
+    origin = datetime(2020, 3, 1)
+    for i in range(num_articles):
+        timestamp = (origin + timedelta(seconds=rnd.randrange(days * 24 * 60 * 60))).isoformat()
+        domain_id = rnd.randrange(num_domains)
+        ja_words = rnd.sample(JA_WORDS, 4)
+        en_words = rnd.sample(EN_WORDS, 4)
+        classes_bert = {itopic: rnd.random() for itopic in ITOPICS}
+        classes_bert['is_useful'] = rnd.random()
+        classes_bert['is_about_false_rumor'] = rnd.random() ** 4
+        snippet_topics = rnd.sample(ITOPICS, rnd.randrange(len(ITOPICS)))
+        article = {
+            'url': f'https://www.site{domain_id}.example.com/articles/{i}.html',
+            'country': rnd.choice(ICOUNTRIES),
+            'orig': {
+                'title': f'Article {i}: ' + ' '.join(en_words),
+                'timestamp': timestamp,
+            },
+            'ja_translated': {
+                'title': f'記事{i} ' + 'の'.join(ja_words),
+                'timestamp': timestamp,
+            },
+            'en_translated': {
+                'title': f'Article {i}: ' + ' '.join(en_words),
+                'timestamp': timestamp,
+            },
+            'classes': {
+                'is_about_COVID-19': 1 if rnd.random() < 0.9 else 0,
+                'is_clear': 1 if rnd.random() < 0.8 else 0,
+            },
+            'classes_bert': classes_bert,
+            'snippets': {itopic: ['、'.join(rnd.sample(JA_WORDS, 6)) + 'について。'] for itopic in snippet_topics},
+            'snippets_en': {itopic: [' '.join(rnd.sample(EN_WORDS, 8)) + '.'] for itopic in snippet_topics},
+            'domain': f'www.site{domain_id}.example.com',
+            'domain_label': f'サイト{domain_id}',
+            'domain_label_en': f'Site {domain_id}',
+        }
+        if recent and duplicate_rnd.random() < duplicate_rate:
+            original = duplicate_rnd.choice(recent)
+            article = dict(original, url=f'https://www.site{domain_id}.example.com/articles/{i}.html',
+                           domain=f'www.site{domain_id}.example.com')
+        recent.append(article)
+        yield article
+
+
+def write_article_list(path: str, num_articles: int, seed: int = 0):
+    with open(path, 'w', encoding='utf-8') as f:
+        for article in generate_articles(num_articles, seed=seed):
+            f.write(json.dumps(article, ensure_ascii=False) + '\n')
+
+
+def generate_check_log(urls: list, num_records: int, seed: int = 0) -> Iterator[str]:
+    """Yield lines of the topic check log written by `/update`."""
+    rnd = random.Random(seed)
+    for _ in range(num_records):
+        yield json.dumps({
+            'url': rnd.choice(urls),
+            'is_hidden': 0,
+            'is_about_COVID-19': 1,
+            'is_useful': 1,
+            'is_about_false_rumor': 0,
+            'new_country': rnd.choice(ICOUNTRIES),
+            'new_topics': rnd.sample(ITOPICS, 1),
+            'notes': '',
+            'time': datetime.now().isoformat(),
+        }, ensure_ascii=False)
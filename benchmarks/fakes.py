@@ -0,0 +1,80 @@
+"""In-memory stand-ins for the backends, used when no local mongod/ElasticSearch is given."""
+from typing import Dict, List
+
+
+class FakeIndices:
+
+    def __init__(self, es: 'FakeElasticsearch'):
+        self.es = es
+
+    def exists(self, index: str) -> bool:
+        return index in self.es.docs
+
+    def create(self, index: str, body: dict = None):
+        self.es.docs.setdefault(index, {})
+
+
+class FakeElasticsearch:
+    """Just enough of `Elasticsearch` to answer the queries built by `DBHandler.get_es_query`.
+
+    A document matches when its region is one of the requested regions and its text contains any of the query terms.
+    """
+
+    def __init__(self):
+        self.docs: Dict[str, Dict[str, dict]] = {}
+        self.indices = FakeIndices(self)
+
+    def index(self, index: str, body: dict, id: str = None):
+        docs = self.docs.setdefault(index, {})
+        docs[id or str(len(docs))] = body
+
+    def delete(self, index: str, id: str):
+        self.docs.get(index, {}).pop(id, None)
+
+    def bulk(self, body: List[dict]) -> dict:
+        items = []
+        actions = iter(body)
+        for action in actions:
+            (op, meta), = action.items()
+            if op == 'index':
+                self.index(meta['_index'], next(actions), id=meta['_id'])
+                items.append({op: dict(meta, status=200)})
+            else:
+                found = meta['_id'] in self.docs.get(meta['_index'], {})
+                self.delete(meta['_index'], meta['_id'])
+                items.append({op: dict(meta, status=200 if found else 404)})
+        return {'errors': False, 'items': items}
+
+    def search(self, index: str, body: dict) -> dict:
+        must = body['query']['bool']['must']
+        regions = {should['term']['region'] for should in must[0]['bool']['should']}
+        terms = must[1]['match']['text'].lower().split()
+        ranges = [
+            filter_['nested']['query']['range']['timestamp.local'] for filter_ in body['query']['bool'].get('filter', [])
+        ]
+        hits = []
+        for id_, source in self.docs.get(index, {}).items():
+            if source['region'] not in regions:
+                continue
+            timestamp = source['timestamp']['local']
+            if any(timestamp < range_.get('gte', '') or timestamp >= range_.get('lt', '\uffff') for range_ in ranges):
+                continue
+            text = source['text'].lower()
+            matched = [term for term in terms if term in text]
+            if not matched:
+                continue
+            hits.append({'_id': id_, '_source': source, 'highlight': {'text': [self.highlight(source['text'], matched)]}})
+        hits.sort(key=lambda hit: hit['_source']['timestamp']['local'], reverse=True)
+        start, size = body.get('from', 0), body.get('size', 10)
+        return {'hits': {'total': {'value': len(hits)}, 'hits': hits[start:start + size]}}
+
+    @staticmethod
+    def highlight(text: str, terms: List[str], fragment_size: int = 100) -> str:
+        lower = text.lower()
+        pos = min(lower.find(term) for term in terms)
+        fragment = text[max(0, pos - fragment_size // 2):pos + fragment_size // 2]
+        for term in terms:
+            i = fragment.lower().find(term)
+            if i >= 0:
+                fragment = f'{fragment[:i]}<em>{fragment[i:i + len(term)]}</em>{fragment[i + len(term):]}'
+        return fragment
@@ -0,0 +1,268 @@
+"""Benchmark the API handlers against a synthetic corpus.
+
+By default everything runs in memory (mongomock and `FakeElasticsearch`). Pass `--mongo_host`/`--es_host` to measure
+against a local mongod/ElasticSearch instead; the benchmark database and indices there are overwritten.
+
+    $ python -m benchmarks.run --num_articles 5000 --save_baseline benchmarks/baseline.json
+    $ python -m benchmarks.run --num_articles 5000 --baseline benchmarks/baseline.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from contextlib import ExitStack
+from typing import Callable, Dict, List
+from unittest import mock
+
+from db_handler import DBHandler
+from generation import Generation
+from log_handler import LogHandler
+from meta_data_handler import MetaDataHandler
+from local_search import LocalSearch
+from page_archive import get_archive_collection_name, move_pages
+from page_counts import PageCounts
+from page_export import iterate_chunks
+from page_index import PageIndex
+from search_sync import LANGS, SearchSync
+from util import COUNTRIES, ETOPIC_ITOPICS_MAP, ECOUNTRY_ICOUNTRIES_MAP
+
+from benchmarks.corpus import generate_articles, generate_check_log
+from benchmarks.fakes import FakeElasticsearch
+
+BENCHMARK_DB_NAME = 'covid19_benchmark'
+BENCHMARK_COLLECTION_NAME = 'pages'
+
+
+def make_db_handler(args) -> DBHandler:
+    """Create a `DBHandler` connected to an empty benchmark database.
+
+    Without `--mongo_host` (`--es_host`), the handler is built on mongomock (`FakeElasticsearch`) instead.
+    """
+    config = {
+        'mongo_host': args.mongo_host or 'localhost',
+        'mongo_port': args.mongo_port,
+        'mongo_db_name': BENCHMARK_DB_NAME,
+        'mongo_collection_name': BENCHMARK_COLLECTION_NAME,
+        'es_host': args.es_host or 'localhost',
+        'es_port': args.es_port,
+        'use_search_views': args.search_views,
+        'dedup': args.dedup,
+    }
+    with ExitStack() as stack:
+        if not args.mongo_host:
+            import mongomock
+            mongo = mongomock.MongoClient()  # shared by the handler and its page counts
+            for module in ('db_handler', 'page_counts', 'page_index'):
+                stack.enter_context(mock.patch(f'{module}.MongoClient', lambda *args, **kwargs: mongo))
+        if not args.es_host:
+            stack.enter_context(mock.patch('db_handler.Elasticsearch', lambda *args, **kwargs: FakeElasticsearch()))
+        db_handler = DBHandler(**config)
+    db_handler.mongo.drop_database(BENCHMARK_DB_NAME)
+    return db_handler
+
+
+def index_pages(db_handler: DBHandler, work_dir: str) -> Dict[str, float]:
+    """Index the pages in the database with a full search sync; returns the figures of the sync."""
+    if not isinstance(db_handler.es, FakeElasticsearch):
+        for lang in LANGS:
+            db_handler.es.indices.delete(index=DBHandler.get_es_index(lang), ignore=[404])
+    stats = SearchSync(db_handler, state_path=os.path.join(work_dir, 'search_sync.json')).sync(full=True)
+    if not isinstance(db_handler.es, FakeElasticsearch):
+        db_handler.es.indices.refresh(index='covid19-pages-*')
+    return stats
+
+
+def make_meta_data_handler(work_dir: str) -> MetaDataHandler:
+    meta_data_handler = MetaDataHandler()
+    meta_data_handler.meta_data_dir = work_dir
+    meta_data_handler.stats_path = os.path.join(work_dir, 'stats.json')
+    meta_data_handler.sources_path = os.path.join(work_dir, 'sources.json')
+    stats = {country['country']: {'death_total': 0, 'confirmation_total': 0, 'death_today': 0, 'confirmation_today': 0}
+             for country in COUNTRIES}
+    meta_data_handler.set_stats({'last_updated': '1/1/21', 'stats': stats})
+    meta_data_handler.set_sources({country['country']: ['http://example.com'] for country in COUNTRIES})
+    return meta_data_handler
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies: List[float]) -> Dict[str, float]:
+    """Summarize latencies in seconds as milliseconds."""
+    values = sorted(latency * 1000 for latency in latencies)
+    return {
+        'n': len(values),
+        'mean': sum(values) / len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+    }
+
+
+def measure(fn: Callable[[], object], repeat: int, warmup: int) -> Dict[str, float]:
+    """Measure a request handler, including the JSON serialization of its response."""
+    for _ in range(warmup):
+        json.dumps(fn(), ensure_ascii=False)
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        json.dumps(fn(), ensure_ascii=False)
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies)
+
+
+def run(args) -> Dict[str, Dict[str, float]]:
+    rnd = random.Random(args.seed)
+    results = {}
+    work_dir = tempfile.mkdtemp(prefix='covid19-benchmark-')
+
+    db_handler = make_db_handler(args)
+    db_handler.create_indexes()
+    articles = list(generate_articles(args.num_articles, seed=args.seed, duplicate_rate=args.duplicate_rate))
+
+    latencies = []
+    start = time.perf_counter()
+    for article in articles:
+        t = time.perf_counter()
+        db_handler.upsert_page(article)
+        latencies.append(time.perf_counter() - t)
+    db_handler.flush_counts()
+    elapsed = time.perf_counter() - start
+    results['ingest'] = dict(summarize(latencies), docs_per_sec=len(articles) / elapsed)
+    db_handler.page_counts = PageCounts(db_handler.counts_collection, Generation(os.path.join(work_dir, 'generation')))
+
+    if args.archive_before:
+        db_handler.archive_collection = db_handler.db.get_collection(
+            name=get_archive_collection_name(BENCHMARK_COLLECTION_NAME)
+        )
+        db_handler.create_indexes()
+        results['archive'] = summarize([move_pages(db_handler.collection, db_handler.archive_collection,
+                                                   args.archive_before)['seconds']])
+
+    if args.local_search:
+        db_handler.es = LocalSearch(os.path.join(work_dir, 'search'))
+    sync_stats = index_pages(db_handler, work_dir)
+    results['search_sync'] = dict(summarize([sync_stats['seconds']]), docs_per_sec=sync_stats['pages_per_second'])
+    if args.page_index:
+        db_handler.page_index = PageIndex(
+            db_handler.collection, Generation(os.path.join(work_dir, 'generation')), db_handler.archive_collection
+        )
+
+    urls = [article['url'] for article in articles]
+    log_handler = LogHandler(log_dir=work_dir)
+    log_handler.extend_topic_check_log(list(generate_check_log(urls, args.num_checks)))
+    meta_data_handler = make_meta_data_handler(work_dir)
+
+    itopics = ETOPIC_ITOPICS_MAP['感染状況']
+    icountries = ECOUNTRY_ICOUNTRIES_MAP['all']
+    scenarios = {
+        'classes_grid': lambda: db_handler.classes(None, None, 0, args.limit, 'ja', ''),
+        'classes_grid_total': lambda: db_handler.classes(None, None, 0, args.limit, 'ja', '', with_total=True),
+        'classes_topic': lambda: db_handler.classes('感染状況', None, 0, args.limit, 'ja', ''),
+        'countries_grid': lambda: db_handler.countries(None, None, 0, args.limit, 'en'),
+        'search_country': lambda: db_handler.classes('search', 'jp', 0, args.limit, 'ja', 'ワクチン'),
+        'search_all': lambda: db_handler.classes('search', None, 0, args.limit, 'en', 'vaccine'),
+        'search_week': lambda: db_handler.classes(
+            'search', None, 0, args.limit, 'en', 'vaccine', since='2020-09-01', until='2020-09-07'
+        ),
+        'history': lambda: log_handler.find_topic_check_log(url=rnd.choice(urls)),
+        'meta': lambda: meta_data_handler.get('ja'),
+    }
+    scenarios['cell_week'] = \
+        lambda: db_handler.get_pages(itopics, icountries, 0, args.limit, 'ja', '2020-09-01', '2020-09-07')
+    for depth in args.depths:
+        scenarios[f'cell_depth_{depth}'] = \
+            lambda depth=depth: db_handler.get_pages(itopics, icountries, depth, args.limit, 'ja')
+
+    for name, fn in scenarios.items():
+        if args.scenarios and name not in args.scenarios:
+            continue
+        results[name] = measure(fn, args.repeat, args.warmup)
+
+    if not args.scenarios or 'export' in args.scenarios:
+        # The whole corpus, serialized the way `/export` streams it.
+        num_pages = sum(chunk.count(b'\n') for chunk in iterate_chunks(db_handler.export_pages([], [], 'en')))
+        results['export'] = measure(
+            lambda: sum(len(chunk) for chunk in iterate_chunks(db_handler.export_pages([], [], 'en'))), 3, 1
+        )
+        results['export']['docs_per_sec'] = num_pages / (results['export']['p50'] / 1000)
+    return results
+
+
+def print_results(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]] = None):
+    header = f'{"scenario":<20}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}'
+    if baseline:
+        header += f'{"base p50":>10}{"change":>9}'
+    print(header)
+    for name, result in results.items():
+        line = f'{name:<20}{result["p50"]:>10.3f}{result["p95"]:>10.3f}{result["p99"]:>10.3f}'
+        if baseline and name in baseline:
+            line += f'{baseline[name]["p50"]:>10.3f}{result["p50"] / baseline[name]["p50"] - 1:>+9.1%}'
+        print(line)
+    if 'ingest' in results:
+        print(f'ingest throughput: {results["ingest"]["docs_per_sec"]:.1f} docs/s')
+    if 'export' in results:
+        print(f'export throughput: {results["export"]["docs_per_sec"]:.1f} docs/s')
+    if 'search_sync' in results:
+        print(f'search sync throughput: {results["search_sync"]["docs_per_sec"]:.1f} docs/s')
+
+
+def find_regressions(results, baseline, tolerance: float) -> List[str]:
+    return [
+        name for name, result in results.items()
+        if name in baseline and result['p50'] > baseline[name]['p50'] * (1 + tolerance)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_articles', type=int, default=2000, help='The number of synthetic articles.')
+    parser.add_argument('--num_checks', type=int, default=1000, help='The number of records in the check log.')
+    parser.add_argument('--seed', type=int, default=0, help='The random seed of the synthetic corpus.')
+    parser.add_argument('--limit', type=int, default=10, help='The value of `limit` of list requests.')
+    parser.add_argument('--depths', type=int, nargs='+', default=[0, 100, 1000], help='`start` values to page to.')
+    parser.add_argument('--repeat', type=int, default=10, help='The number of measured runs per scenario.')
+    parser.add_argument('--warmup', type=int, default=2, help='The number of unmeasured runs per scenario.')
+    parser.add_argument('--scenarios', nargs='*', help='If given, only run these scenarios (ingest always runs).')
+    parser.add_argument('--mongo_host', help='A local mongod to use instead of mongomock.')
+    parser.add_argument('--mongo_port', type=int, default=27017)
+    parser.add_argument('--es_host', help='A local ElasticSearch to use instead of the in-memory stand-in.')
+    parser.add_argument('--es_port', type=int, default=9200)
+    parser.add_argument('--page_index', action='store_true', help='If true, serve lists from the in-memory page index.')
+    parser.add_argument('--local_search', action='store_true', help='If true, search with the embedded engine.')
+    parser.add_argument('--search_views', action='store_true', help='If true, build search results from the index.')
+    parser.add_argument('--archive_before', help='If given, archive the pages published before this date first.')
+    parser.add_argument('--dedup', action='store_true', help='If true, collapse near-duplicates at ingest.')
+    parser.add_argument('--duplicate_rate', type=float, default=0., help='The share of near-duplicate articles.')
+    parser.add_argument('--save_baseline', help='Save the results to this path.')
+    parser.add_argument('--baseline', help='Compare the results with the baseline saved at this path.')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed relative slowdown of p50.')
+    args = parser.parse_args()
+
+    results = run(args)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    print_results(results, baseline)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'args': {k: v for k, v in vars(args).items() if k not in {'save_baseline', 'baseline'}},
+                       'results': results}, f, indent=2)
+
+    if baseline:
+        regressions = find_regressions(results, baseline, args.tolerance)
+        if regressions:
+            print(f'Regressions beyond {args.tolerance:.0%}: {", ".join(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
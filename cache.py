@@ -0,0 +1,225 @@
+"""Caches of serialized responses, invalidated when the data generation moves."""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Hashable, Optional, Tuple
+
+import metrics
+from generation import Generation, get_generation
+
+SHARED_RESPONSE_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'response_cache')
+FILE_MAGIC = b'COVIDRC1'
+FILE_HEADER = struct.Struct('<8sII')  # magic, the number of slots, slot size
+SLOT_HEADER = struct.Struct('<16sQdII')  # key digest, generation, expiry, length, sequence number
+SLOT_HEADER_SIZE = 64
+OVERSIZED = 0xffffffff  # the length of the entry of a response larger than a slot
+
+
+class ResponseCache:
+    """An in-process LRU cache of serialized responses.
+
+    Entries expire after `ttl` seconds, and all of them are dropped as soon as another process bumps the generation.
+    The TTL bounds staleness for data that does not bump the generation, e.g., ElasticSearch indices.
+    """
+
+    def __init__(self, generation: Generation, max_entries: int = 1024, ttl: float = 300.):
+        self.generation = generation
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expiry, body)
+        self.entries_generation = generation.current()
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        generation = self.generation.current()
+        with self.lock:
+            if generation != self.entries_generation:
+                self.entries.clear()
+                self.entries_generation = generation
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self.entries[key]
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+        metrics.record_cache('response', entry is not None)
+        return entry[1] if entry is not None else None
+
+    def set(self, key: Hashable, body: bytes, generation: int):
+        """Store a response built from the data at `generation`, read before building it."""
+        with self.lock:
+            if generation != self.entries_generation:
+                return
+            self.entries[key] = (time.monotonic() + self.ttl, body)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get_or_build(self, key: Hashable, build: Callable[[], bytes]) -> bytes:
+        body = self.get(key)
+        if body is None:
+            generation = self.generation.current()
+            body = build()
+            self.set(key, body, generation)
+        return body
+
+
+class SharedResponseCache:
+    """A cache of serialized responses shared by all the processes on the host through a memory-mapped file.
+
+    The file holds `num_slots` fixed-size slots, each made of an index entry (key digest, generation, expiry, length
+    and a sequence number) and `slot_bytes` of data. A key maps to one slot. A response larger than a slot is not
+    cached, only an entry of length `OVERSIZED`, so that the processes build it without waiting for each other. Entries
+    are tagged with the generation they were built at, so a bump invalidates them all without touching the file.
+    Writers lock the index entry of their slot; readers take no lock and validate their copy with the sequence number,
+    which is odd while the slot is being written.
+    """
+
+    def __init__(
+            self,
+            generation: Generation,
+            path: str = SHARED_RESPONSE_CACHE_PATH,
+            num_slots: int = 256,
+            slot_bytes: int = 2 * 1024 * 1024,
+            ttl: float = 300.,
+    ):
+        self.generation = generation
+        self.num_slots = num_slots
+        self.slot_bytes = slot_bytes
+        self.ttl = ttl
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o664)
+        size = FILE_HEADER.size + num_slots * (SLOT_HEADER_SIZE + slot_bytes)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            header = os.pread(self.fd, FILE_HEADER.size, 0)
+            if len(header) < FILE_HEADER.size or FILE_HEADER.unpack(header) != (FILE_MAGIC, num_slots, slot_bytes):
+                os.ftruncate(self.fd, 0)  # drop the entries of another layout
+                os.ftruncate(self.fd, size)
+                os.pwrite(self.fd, FILE_HEADER.pack(FILE_MAGIC, num_slots, slot_bytes), 0)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.size = size
+        self.mm = mmap.mmap(self.fd, size)
+        # `lockf` excludes other processes, not the other threads of this one.
+        self.write_lock = threading.Lock()
+        self.slot_locks = [threading.Lock() for _ in range(num_slots)]
+
+    @staticmethod
+    def digest(key: Hashable) -> bytes:
+        return hashlib.blake2b(repr(key).encode('utf-8'), digest_size=16).digest()
+
+    def get_slot(self, digest: bytes) -> int:
+        return int.from_bytes(digest[:8], 'little') % self.num_slots
+
+    def get_offsets(self, digest: bytes) -> Tuple[int, int]:
+        slot = self.get_slot(digest)
+        header_offset = FILE_HEADER.size + slot * SLOT_HEADER_SIZE
+        data_offset = FILE_HEADER.size + self.num_slots * SLOT_HEADER_SIZE + slot * self.slot_bytes
+        return header_offset, data_offset
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        body = self.read(key)
+        metrics.record_cache('shared_response', body is not None)
+        return body
+
+    def read_entry(self, digest: bytes) -> Optional[Tuple[int, int]]:
+        """The length and sequence number of the valid entry of `digest`, if any."""
+        header_offset, _ = self.get_offsets(digest)
+        entry_digest, generation, expiry, length, seq = SLOT_HEADER.unpack_from(self.mm, header_offset)
+        if seq % 2 == 1 or entry_digest != digest:
+            return None
+        if generation != self.generation.current() or expiry < time.time():
+            return None
+        return length, seq
+
+    def is_oversized(self, key: Hashable) -> bool:
+        entry = self.read_entry(self.digest(key))
+        return entry is not None and entry[0] == OVERSIZED
+
+    def read(self, key: Hashable) -> Optional[bytes]:
+        digest = self.digest(key)
+        header_offset, data_offset = self.get_offsets(digest)
+        entry = self.read_entry(digest)
+        if entry is None or entry[0] == OVERSIZED:
+            return None
+        length, seq = entry
+        body = self.mm[data_offset:data_offset + length]
+        if SLOT_HEADER.unpack_from(self.mm, header_offset)[4] != seq:  # overwritten while being copied
+            return None
+        return body
+
+    def set(self, key: Hashable, body: bytes, generation: int):
+        """Store a response built from the data at `generation`, read before building it."""
+        if generation != self.generation.current():
+            return
+        length = len(body) if len(body) <= self.slot_bytes else OVERSIZED
+        digest = self.digest(key)
+        header_offset, data_offset = self.get_offsets(digest)
+        with self.write_lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, SLOT_HEADER_SIZE, header_offset)
+            try:
+                seq = SLOT_HEADER.unpack_from(self.mm, header_offset)[4]
+                SLOT_HEADER.pack_into(self.mm, header_offset, b'\0' * 16, 0, 0., 0, seq + 1)
+                if length != OVERSIZED:
+                    self.mm[data_offset:data_offset + length] = body
+                SLOT_HEADER.pack_into(
+                    self.mm, header_offset, digest, generation, time.time() + self.ttl, length, seq + 2
+                )
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, SLOT_HEADER_SIZE, header_offset)
+
+    @contextmanager
+    def compute_lock(self, key: Hashable):
+        """Lock the slot of `key` against other threads and processes building a response for it.
+
+        The lock of the other processes is a byte-range lock past the end of the file, one byte per slot, so it never
+        blocks readers or writers of the slot itself. It is only taken while holding the lock of the slot in this
+        process, since `lockf` does not exclude threads.
+        """
+        slot = self.get_slot(self.digest(key))
+        with self.slot_locks[slot]:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, self.size + slot)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, self.size + slot)
+
+    def get_or_build(self, key: Hashable, build: Callable[[], bytes]) -> bytes:
+        body = self.get(key)
+        if body is not None:
+            return body
+        if self.is_oversized(key):
+            # It will not be cached, so waiting for another process to build it would only serialize the builds.
+            return build()
+        # Let one process build the response while the others wait for it and then read it from the cache.
+        with self.compute_lock(key):
+            body = self.read(key)
+            if body is None:
+                generation = self.generation.current()
+                body = build()
+                self.set(key, body, generation)
+        return body
+
+
+def create_response_cache(
+        enabled: bool,
+        backend: str = 'local',
+        max_entries: int = 1024,
+        ttl: float = 300.,
+        shared_slots: int = 256,
+        shared_slot_bytes: int = 2 * 1024 * 1024,
+):
+    """Create the response cache configured by `cfg['response_cache']`, or None if it is disabled."""
+    if not enabled:
+        return None
+    if backend == 'shared':
+        return SharedResponseCache(get_generation(), num_slots=shared_slots, slot_bytes=shared_slot_bytes, ttl=ttl)
+    return ResponseCache(get_generation(), max_entries=max_entries, ttl=ttl)
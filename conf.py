@@ -10,6 +10,11 @@ config = {
     'password': os.getenv('PASSWORD'),
     'log_handler': {
         'log_dir': os.getenv('LOG_HANDLER_LOG_DIR'),
+        'segment_bytes': int(os.getenv('LOG_HANDLER_SEGMENT_BYTES', str(16 * 1024 * 1024))),
+        'segment_seconds': float(os.getenv('LOG_HANDLER_SEGMENT_SECONDS', str(7 * 24 * 60 * 60))),
+        'compress': os.getenv('LOG_HANDLER_COMPRESS', '') == '1',
+        'retention_segments': int(os.getenv('LOG_HANDLER_RETENTION_SEGMENTS'))
+        if os.getenv('LOG_HANDLER_RETENTION_SEGMENTS') else None,
     },
     'cors': {
         'origins': os.getenv('CORS_ORIGINS'),
@@ -20,7 +25,51 @@ config = {
         'mongo_db_name': os.getenv('DB_HANDLER_MONGO_DB_NAME'),
         'mongo_collection_name': os.getenv('DB_HANDLER_MONGO_COLLECTION_NAME'),
         'es_host': os.getenv('DB_HANDLER_ES_HOST'),
-        'es_port': int(os.getenv('DB_HANDLER_ES_PORT'))
+        'es_port': int(os.getenv('DB_HANDLER_ES_PORT')),
+        'use_page_index': os.getenv('DB_HANDLER_USE_PAGE_INDEX', '') == '1',
+        'use_search_views': os.getenv('DB_HANDLER_USE_SEARCH_VIEWS', '') == '1',
+        'search_backend': os.getenv('DB_HANDLER_SEARCH_BACKEND', 'elasticsearch'),
+        'local_search_dir': os.getenv('DB_HANDLER_LOCAL_SEARCH_DIR')
+        or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'search'),
+        'archive_max_age_days': int(os.getenv('DB_HANDLER_ARCHIVE_MAX_AGE_DAYS', '0')),
+        'dedup': os.getenv('DB_HANDLER_DEDUP', '') == '1',
+    },
+    'response_cache': {
+        'enabled': os.getenv('RESPONSE_CACHE_ENABLED', '') == '1',
+        'backend': os.getenv('RESPONSE_CACHE_BACKEND', 'local'),
+        'max_entries': int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '1024')),
+        'ttl': float(os.getenv('RESPONSE_CACHE_TTL', '300')),
+        'shared_slots': int(os.getenv('RESPONSE_CACHE_SHARED_SLOTS', '256')),
+        'shared_slot_bytes': int(os.getenv('RESPONSE_CACHE_SHARED_SLOT_BYTES', str(2 * 1024 * 1024))),
+    },
+    'single_flight': {
+        'stale_seconds': float(os.getenv('SINGLE_FLIGHT_STALE_SECONDS', '0')),
+    },
+    'query_profiler': {
+        'enabled': os.getenv('QUERY_PROFILER_ENABLED', '') == '1',
+        'threshold_ms': float(os.getenv('QUERY_PROFILER_THRESHOLD_MS', '100')),
+        'log_path': os.getenv('QUERY_PROFILER_LOG_PATH')
+        or os.path.join(os.getenv('LOG_HANDLER_LOG_DIR', ''), 'slow_queries.txt'),
+    },
+    'admission': {
+        'enabled': os.getenv('ADMISSION_ENABLED', '') == '1',
+        'max_limit': int(os.getenv('ADMISSION_MAX_LIMIT', '100')),
+        'rate': float(os.getenv('ADMISSION_RATE', '10')),
+        'burst': float(os.getenv('ADMISSION_BURST', '120')),
+        'max_concurrency': int(os.getenv('ADMISSION_MAX_CONCURRENCY', '8')),
+        'queue_timeout': float(os.getenv('ADMISSION_QUEUE_TIMEOUT', '1')),
+        'client_header': os.getenv('ADMISSION_CLIENT_HEADER', ''),
+    },
+    'search_sync': {
+        'enabled': os.getenv('SEARCH_SYNC_ENABLED', '') == '1',
+        'batch_size': int(os.getenv('SEARCH_SYNC_BATCH_SIZE', '500')),
+    },
+    'cron': {
+        'database_interval': float(os.getenv('CRON_DATABASE_INTERVAL', str(60 * 60))),
+        'stats_interval': float(os.getenv('CRON_STATS_INTERVAL', str(6 * 60 * 60))),
+        'sources_interval': float(os.getenv('CRON_SOURCES_INTERVAL', str(24 * 60 * 60))),
+        'logs_interval': float(os.getenv('CRON_LOGS_INTERVAL', str(24 * 60 * 60))),
+        'retry_seconds': float(os.getenv('CRON_RETRY_SECONDS', '60')),
     },
     'twitter_handler': {
         'token': os.getenv('TWITTER_HANDLER_OAUTH_TOKEN'),
@@ -1,19 +1,30 @@
 import argparse
 import collections
+import cProfile
 import json
 import logging
 import random
 import shutil
+import signal
 import tempfile
 import time
 import urllib.parse
 import urllib.request
+from datetime import datetime
 
 import pandas as pd
+from pymongo import ReturnDocument
 
+import page_counts
+import query_profiler
 from db_handler import DBHandler, Status
+from generation import get_generation
+from ingest_profiler import StageTimer, no_stage
 from log_handler import LogHandler
 from meta_data_handler import MetaDataHandler
+from scheduler import Job, Scheduler, job_lock
+from search_sync import SearchSync
+from suggest_index import build_suggest_index, get_suggest_path
 from twitter_handler import TwitterHandler
 from util import load_config, COUNTRIES, ECOUNTRY_ICOUNTRIES_MAP
 
@@ -22,40 +33,82 @@ logging.basicConfig(level='DEBUG')
 
 cfg = load_config()
 
+# Bump the data generation every this number of changed pages, so that caches do not lag behind a long update.
+GENERATION_BATCH_SIZE = 1000
 
-def update_database(do_tweet: bool = False):
-    db_handler = DBHandler(**cfg['db_handler'])
+
+def update_database(
+        do_tweet: bool = False,
+        db_handler: DBHandler = None,
+        dry_run: bool = False,
+        profile: bool = False,
+        profile_path: str = None,
+):
+    db_handler = db_handler or DBHandler(**cfg['db_handler'])
     log_handler = LogHandler(**cfg['log_handler'])
+    if not dry_run:
+        db_handler.create_indexes()
+        if db_handler.counts_collection.estimated_document_count() == 0:
+            rebuild_counts(db_handler)
 
     logger.debug('Add automatically categorized pages.')
-    data_path = cfg['data']['article_list']
-    maybe_tweeted_ds = []
-    with open(data_path, mode='r', encoding='utf-8') as f:
-        for line in f:
-            d = db_handler.upsert_page(json.loads(line))
-            if d and do_tweet and d['status'] == Status.INSERTED and d['is_useful']:
-                maybe_tweeted_ds.append(d)
-    num_docs = db_handler.collection.count_documents({})
+    timer = StageTimer() if profile else None
+    profiler = cProfile.Profile() if profile_path else None
+    if profiler is not None:
+        profiler.enable()
+    started = time.perf_counter()
+    maybe_tweeted_ds, statuses = add_pages(db_handler, do_tweet, dry_run, timer)
+    seconds = time.perf_counter() - started
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+        logger.info(f'Wrote the profile of the ingest to {profile_path}.')
+    num_lines = sum(statuses.values())
+    logger.info(f'{"Would add" if dry_run else "Added"} {num_lines} articles in {seconds:.1f} s '
+                f'({num_lines / max(seconds, 1e-9):.0f} docs/s): '
+                + ', '.join(f'{statuses[name]} {name}' for name in [status.name for status in Status] + ['SKIPPED']))
+    if timer is not None:
+        for line in timer.format_report(seconds):
+            logger.info(line)
+    if dry_run:
+        return
+
+    num_docs = sum(collection.count_documents({}) for collection in db_handler.get_tiers())
     log_handler.extend_page_number_log([f'{time.asctime()}:The number of pages is {num_docs}.'])
 
     logger.debug('Add manually checked pages.')
     for line in log_handler.iterate_topic_check_log():
         log = json.loads(line)
-        existing_page = db_handler.collection.find_one({'page.url': log['url']})
-        if not existing_page:
-            continue
-        db_handler.collection.update_one(
-            {'page.url': log['url']},
-            {'$set': {
-                'page.is_about_COVID-19': log['is_about_COVID-19'],
-                'page.is_useful': log['is_useful'],
-                'page.is_about_false_rumor': log.get('is_about_false_rumor', 0),
-                'page.is_checked': 1,
-                'page.is_hidden': log.get('is_hidden', 0),
-                'page.displayed_country': log['new_country'],
-                'page.topics': {new_topic: 1.0 for new_topic in log['new_topics']}
-            }}
+        checked = {
+            'page.is_about_COVID-19': log['is_about_COVID-19'],
+            'page.is_useful': log['is_useful'],
+            'page.is_about_false_rumor': log.get('is_about_false_rumor', 0),
+            'page.is_checked': 1,
+            'page.is_hidden': log.get('is_hidden', 0),
+            'page.displayed_country': log['new_country'],
+            'page.topics': {new_topic: 1.0 for new_topic in log['new_topics']}
+        }
+        # Only touch pages that differ from the check, so that `updated_at` marks actual modifications.
+        doc = db_handler.find_tier(log['url']).find_one_and_update(
+            {'page.url': log['url'], '$or': [{key: {'$ne': value}} for key, value in checked.items()]},
+            {'$set': dict(checked, updated_at=datetime.utcnow())},
+            projection=page_counts.COUNT_PROJECTION,
+            return_document=ReturnDocument.BEFORE
         )
+        if doc:
+            db_handler.count_deltas.update(
+                page_counts.get_count_deltas(doc['page'], page_counts.apply_page_set(doc['page'], checked))
+            )
+    db_handler.flush_counts()
+    get_generation().bump()
+
+    if db_handler.archive_collection is not None:
+        archive_pages(db_handler)
+
+    if cfg['search_sync']['enabled']:
+        sync_search(db_handler)
+
+    update_suggestions(db_handler)
 
     logger.debug('Tweet a useful new page.')
     if do_tweet:
@@ -68,6 +121,94 @@ def update_database(do_tweet: bool = False):
         twitter_handler.post(text)
 
 
+def add_pages(db_handler: DBHandler, do_tweet: bool, dry_run: bool, timer: StageTimer = None):
+    """Upsert the articles of the article list; returns the new useful pages and the numbers of pages per status."""
+    stage = timer.stage if timer is not None else no_stage
+    maybe_tweeted_ds = []
+    statuses = collections.Counter()
+    num_changed = 0
+    with open(cfg['data']['article_list'], mode='r', encoding='utf-8') as f:
+        for line in f:
+            with stage('parse'):
+                document = json.loads(line)
+            d = db_handler.upsert_page(document, dry_run=dry_run, timer=timer)
+            statuses[d['status'].name if d else 'SKIPPED'] += 1  # pages without a title are skipped
+            if dry_run:
+                continue
+            if d and d['status'] in {Status.INSERTED, Status.UPDATED}:
+                num_changed += 1
+                if num_changed % GENERATION_BATCH_SIZE == 0:
+                    db_handler.flush_counts()
+                    get_generation().bump()
+            if d and do_tweet and d['status'] == Status.INSERTED and d['is_useful']:
+                maybe_tweeted_ds.append(d)
+    if num_changed % GENERATION_BATCH_SIZE:
+        db_handler.flush_counts()
+        get_generation().bump()
+    return maybe_tweeted_ds, statuses
+
+
+def sync_search(db_handler: DBHandler = None, full: bool = False):
+    db_handler = db_handler or DBHandler(**cfg['db_handler'])
+
+    for search_sync in SearchSync.for_db_handler(db_handler, batch_size=cfg['search_sync']['batch_size']):
+        logger.debug(f'Sync the search indices of {type(search_sync.es).__name__} with the database.')
+        stats = search_sync.sync(full=full)
+        logger.info(f'Synced {stats["pages"]} pages to the search indices in {stats["seconds"]:.1f} s '
+                    f'({stats["pages_per_second"]:.0f} pages/s, lag {stats["lag_seconds"]:.0f} s): '
+                    f'{stats["indexed"]} indexed, {stats["deleted"]} deleted, {stats["errors"]} errors.')
+
+
+def archive_pages(db_handler: DBHandler = None):
+    db_handler = db_handler or DBHandler(**cfg['db_handler'])
+    if db_handler.archive_collection is None:
+        logger.warning('The archive is disabled. Set DB_HANDLER_ARCHIVE_MAX_AGE_DAYS to enable it.')
+        return
+
+    logger.debug(f'Move the pages older than {db_handler.archive_max_age_days} days to the archive.')
+    stats = db_handler.archive_pages()
+    logger.info(f'Moved {stats["moved"]} pages to the archive in {stats["seconds"]:.1f} s.')
+    get_generation().bump()
+
+
+def rebuild_dedup(db_handler: DBHandler = None):
+    db_handler = db_handler or DBHandler(**cfg['db_handler'])
+    if db_handler.duplicate_index is None:
+        logger.warning('Dedup is disabled. Set DB_HANDLER_DEDUP=1 to enable it.')
+        return
+
+    logger.debug('Index the pages without a MinHash signature for dedup.')
+    stats = db_handler.rebuild_dedup()
+    logger.info(f'Indexed {stats["indexed"]} pages for dedup ({stats["skipped"]} without English text) '
+                f'in {stats["seconds"]:.1f} s.')
+
+
+def backfill_scores(db_handler: DBHandler = None):
+    db_handler = db_handler or DBHandler(**cfg['db_handler'])
+
+    logger.debug('Set the queue scores of the pages ingested without them.')
+    with open(cfg['data']['article_list'], mode='r', encoding='utf-8') as f:
+        stats = db_handler.backfill_scores(json.loads(line) for line in f)
+    logger.info(f'Set the scores of {stats["updated"]} pages from {stats["articles"]} articles.')
+
+
+def rebuild_counts(db_handler: DBHandler = None):
+    db_handler = db_handler or DBHandler(**cfg['db_handler'])
+
+    logger.debug('Recount the pages per topic and country.')
+    page_counts.rebuild(db_handler.get_tiers(), db_handler.counts_collection)
+    get_generation().bump()
+
+
+def update_suggestions(db_handler: DBHandler = None):
+    db_handler = db_handler or DBHandler(**cfg['db_handler'])
+
+    logger.debug('Build the suggest indices.')
+    for lang in ('ja', 'en'):
+        build_suggest_index(db_handler.collection, lang, get_suggest_path(lang))
+    get_generation().bump()
+
+
 def update_stats():
     meta_data_handler = MetaDataHandler()
     log_handler = LogHandler(**cfg['log_handler'])
@@ -113,6 +254,7 @@ def update_stats():
         }
 
     meta_data_handler.set_stats({'last_updated': last_update, 'stats': stats})
+    get_generation().bump()
 
 
 def update_sources():
@@ -134,6 +276,63 @@ def update_sources():
                     sources[ecountry].append(f'http://{source}')
 
     meta_data_handler.set_sources(sources)
+    get_generation().bump()
+
+
+def maintain_logs():
+    log_handler = LogHandler(**cfg['log_handler'])
+
+    logger.debug('Compact the topic check log and compress old log segments.')
+    log_handler.maintain()
+
+
+def report_queries():
+    profiler_cfg = cfg['query_profiler']
+    summaries = query_profiler.summarize_records(query_profiler.iterate_records(profiler_cfg['log_path']))
+    if not summaries:
+        print(f'No slow queries are recorded in {profiler_cfg["log_path"]}.')
+        return
+    for summary in summaries:
+        print(f'{summary["count"]} x {summary["command"]} on {summary["collection"]}: '
+              f'total {summary["total_ms"]:.0f} ms, median {summary["median_ms"]:.0f} ms, max {summary["max_ms"]:.0f} ms')
+        print(f'  filter: {json.dumps(summary["shape"], ensure_ascii=False)}')
+        print(f'  sort: {json.dumps(summary["sort"], ensure_ascii=False)}')
+        print(f'  examined/returned: {summary["docs_examined"]}/{summary["n_returned"]}')
+        print(f'  plan: {summary["plan"]}')
+
+
+def run_locked(name: str, fn, *args, **kwargs):
+    """Run a job unless a daemon or another `cron.py` is running it."""
+    with job_lock(name) as locked:
+        if not locked:
+            logger.warning(f'Skip {name}: another process is running it.')
+            return
+        fn(*args, **kwargs)
+
+
+def daemon(do_tweet: bool = False):
+    """Run the updates on their intervals in this process until it receives SIGTERM or SIGINT."""
+    cron_cfg = cfg['cron']
+    # The handler, its connections and the page counts stay warm across the runs of the database job.
+    db_handler = DBHandler(**cfg['db_handler'])
+    jobs = [
+        Job(name, fn, cron_cfg[f'{name}_interval'], retry_seconds=cron_cfg['retry_seconds'])
+        for name, fn in [
+            ('database', lambda: update_database(do_tweet=do_tweet, db_handler=db_handler)),
+            ('stats', update_stats),
+            ('sources', update_sources),
+            ('logs', maintain_logs),
+        ]
+    ]
+    scheduler = Scheduler(jobs)
+
+    def stop(signum, frame):
+        logger.info(f'Received signal {signum}. Stop after the running jobs.')
+        scheduler.stop()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    scheduler.run()
 
 
 def main():
@@ -142,17 +341,64 @@ def main():
     parser.add_argument('--update_database', action='store_true', help='If true, update the database.')
     parser.add_argument('--update_stats', action='store_true', help='If true, update the stats information.')
     parser.add_argument('--update_sources', action='store_true', help='If true, update the source information.')
+    parser.add_argument('--update_suggestions', action='store_true', help='If true, build the suggest indices.')
+    parser.add_argument('--sync_search', action='store_true', help='If true, sync the search indices with the database.')
+    parser.add_argument('--full', action='store_true', help='If true, `--sync_search` sends all the pages.')
+    parser.add_argument('--archive_pages', action='store_true', help='If true, move old pages to the archive.')
+    parser.add_argument('--rebuild_counts', action='store_true', help='If true, recount the pages per topic and country.')
+    parser.add_argument('--rebuild_dedup', action='store_true', help='If true, index the existing pages for dedup.')
+    parser.add_argument('--backfill_scores', action='store_true', help='If true, set the queue scores of old pages.')
+    parser.add_argument('--maintain_logs', action='store_true', help='If true, compact and compress the logs.')
+    parser.add_argument('--dry_run', action='store_true', help='If true, `--update_database` writes nothing.')
+    parser.add_argument('--profile', action='store_true', help='If true, time the stages of `--update_database`.')
+    parser.add_argument('--profile_path', help='If given, write a cProfile of `--update_database` to this path.')
     parser.add_argument('--do_tweet', action='store_true', help='If true, randomly tweet a newly registered page.')
+    parser.add_argument('--daemon', action='store_true', help='If true, run the updates on intervals.')
+    parser.add_argument('--query_report', action='store_true', help='If true, summarize the recorded slow queries.')
     args = parser.parse_args()
 
+    query_profiler.install(cfg['db_handler']['mongo_host'], cfg['db_handler']['mongo_port'], **cfg['query_profiler'])
+
+    if args.daemon:
+        daemon(do_tweet=args.do_tweet)
+        return
+
+    if args.query_report:
+        report_queries()
+
+    if args.update_all or args.maintain_logs:
+        run_locked('logs', maintain_logs)
+
     if args.update_all or args.update_database:
-        update_database(do_tweet=args.do_tweet)
+        if args.dry_run:
+            update_database(dry_run=True, profile=args.profile, profile_path=args.profile_path)
+        else:
+            run_locked('database', update_database,
+                       do_tweet=args.do_tweet, profile=args.profile, profile_path=args.profile_path)
+
+    if args.archive_pages:
+        run_locked('database', archive_pages)
+
+    if args.rebuild_counts:
+        run_locked('database', rebuild_counts)
+
+    if args.rebuild_dedup:
+        run_locked('database', rebuild_dedup)
+
+    if args.backfill_scores:
+        run_locked('database', backfill_scores)
+
+    if args.update_suggestions:
+        run_locked('database', update_suggestions)
+
+    if args.sync_search:
+        run_locked('database', sync_search, full=args.full)
 
     if args.update_all or args.update_stats:
-        update_stats()
+        run_locked('stats', update_stats)
 
     if args.update_all or args.update_sources:
-        update_sources()
+        run_locked('sources', update_sources)
 
 
 if __name__ == '__main__':
@@ -1,10 +1,28 @@
-from datetime import datetime
+from collections import Counter
+from datetime import date, datetime, timedelta
 from enum import Enum
-from typing import List, Dict, Union, Optional
+from typing import Iterator, List, Dict, Set, Union, Optional, Tuple
 
 from elasticsearch import Elasticsearch
-from pymongo import MongoClient, DESCENDING
+from pymongo import MongoClient, ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
 
+from generation import get_generation
+from ingest_profiler import StageTimer, no_stage
+from local_search import LOCAL_SEARCH_DIR, FallbackSearch, get_local_search
+from metrics import InstrumentedTransport
+from page_archive import get_archive_boundary, get_archive_collection_name, get_cutoff, move_pages
+from page_counts import (
+    COUNT_PROJECTION,
+    apply_count_deltas,
+    apply_page_set,
+    get_count_deltas,
+    get_counts_collection_name,
+    get_page_counts,
+)
+from page_dedup import DuplicateIndex, get_duplicates_collection_name, get_lsh_collection_name, get_signature
+from page_export import EXPORT_BATCH_SIZE, EXPORT_SORT, get_export_projection
+from page_index import get_page_index
 from util import (
     ITOPICS,
     ITOPIC_ETOPIC_MAP,
@@ -18,10 +36,20 @@ from util import (
 )
 
 
+# The version of the page views stored in the search indices; bump it when `reshape_page` changes so that
+# search falls back to MongoDB until the indices are synced again.
+SEARCH_VIEW_VERSION = 1
+
+# The model scores (`classes_bert`) kept at ingest that order the queue of unchecked pages, per `/queue` order.
+QUEUE_SCORES = {'useful': 'is_useful', 'rumor': 'is_about_false_rumor'}
+SCORES_BATCH_SIZE = 1000
+
+
 class Status(Enum):
     UPDATED = 0
     INSERTED = 1
     IGNORED = 2
+    DUPLICATE = 3  # a near-duplicate of another page; see `page_dedup`
 
 
 class DBHandler:
@@ -34,14 +62,184 @@ class DBHandler:
             mongo_collection_name: str,
             es_host: str,
             es_port: int,
+            use_page_index: bool = False,
+            use_search_views: bool = False,
+            search_backend: str = 'elasticsearch',
+            local_search_dir: str = LOCAL_SEARCH_DIR,
+            archive_max_age_days: int = 0,
+            dedup: bool = False,
     ):
         self.mongo = MongoClient(mongo_host, mongo_port)
         self.db = self.mongo.get_database(mongo_db_name)
         self.collection = self.db.get_collection(name=mongo_collection_name)
-        self.es = Elasticsearch(f'{es_host}:{es_port}')
+        # With `archive_max_age_days`, cron moves older pages to the archive; see `page_archive`.
+        self.archive_max_age_days = archive_max_age_days
+        self.archive_collection = None
+        if archive_max_age_days:
+            self.archive_collection = self.db.get_collection(name=get_archive_collection_name(mongo_collection_name))
+        self.archive_boundary: Optional[str] = None  # loaded on first use by `get_tier`
+        # With `dedup`, `upsert_page` keeps near-duplicates of known pages out of the pages collection.
+        self.duplicate_index = None
+        if dedup:
+            self.duplicate_index = DuplicateIndex(
+                self.db.get_collection(name=get_lsh_collection_name(mongo_collection_name)),
+                self.db.get_collection(name=get_duplicates_collection_name(mongo_collection_name)),
+            )
+        # `search_backend` is `elasticsearch`, `local` (the embedded engine of `local_search`), or `fallback`
+        # (ElasticSearch, and the embedded engine while ElasticSearch cannot be reached).
+        if search_backend == 'local':
+            self.es = get_local_search(local_search_dir)
+        else:
+            self.es = Elasticsearch(f'{es_host}:{es_port}', transport_class=InstrumentedTransport)
+            if search_backend == 'fallback':
+                self.es = FallbackSearch(self.es, get_local_search(local_search_dir))
+        self.page_index = None
+        if use_page_index:
+            self.page_index = get_page_index(
+                mongo_host, mongo_port, mongo_db_name, mongo_collection_name, use_archive=bool(archive_max_age_days)
+            )
+        self.use_search_views = use_search_views
+        self.counts_collection = self.db.get_collection(name=get_counts_collection_name(mongo_collection_name))
+        self.page_counts = get_page_counts(mongo_host, mongo_port, mongo_db_name, mongo_collection_name)
+        self.count_deltas = Counter()  # changes of the counts by `upsert_page` not written yet; see `flush_counts`
+
+    def create_indexes(self):
+        for collection in self.get_tiers():
+            # Ingest, edits and the lookups of dedup and search find pages by URL.
+            collection.create_index('page.url')
+            # `updated_at` is the time a page was last written; it lets readers fetch only the pages modified since.
+            collection.create_index('updated_at')
+            # Lists are sorted by the date first, so a date range is a contiguous range of this index.
+            collection.create_index([
+                ('page.orig.simple_timestamp', DESCENDING),
+                ('page.displayed_country', ASCENDING),
+                ('page.is_about_COVID-19', ASCENDING),
+                ('page.is_hidden', ASCENDING),
+            ])
+        # The queue of `get_queue`: the index only holds the unchecked pages, and a check removes a page from it.
+        for score in QUEUE_SCORES.values():
+            self.collection.create_index(
+                [(f'page.scores.{score}', DESCENDING), ('page.orig.simple_timestamp', DESCENDING)],
+                partialFilterExpression={'page.is_checked': 0},
+            )
+        if self.duplicate_index is not None:
+            self.duplicate_index.create_indexes()
+
+    def get_tiers(self) -> list:
+        """The collections of the pages: the pages collection, and the archive if it is enabled."""
+        return [self.collection] + ([self.archive_collection] if self.archive_collection is not None else [])
+
+    def get_tier(self, simple_timestamp: str):
+        """The collection a page published on `simple_timestamp` belongs to."""
+        if self.archive_collection is None:
+            return self.collection
+        if self.archive_boundary is None:
+            self.archive_boundary = get_archive_boundary(self.archive_collection)
+        return self.archive_collection if simple_timestamp <= self.archive_boundary else self.collection
 
-    def upsert_page(self, document: dict) -> Optional[Dict[str, str]]:
-        """Add a page to the database. If the page has already been registered, update the page."""
+    def find_tier(self, url: str):
+        """The collection holding the page of `url`; the pages collection if there is no such page."""
+        if self.archive_collection is None or self.collection.count_documents({'page.url': url}, limit=1):
+            return self.collection
+        if self.archive_collection.count_documents({'page.url': url}, limit=1):
+            return self.archive_collection
+        return self.collection
+
+    def archive_pages(self) -> Dict[str, float]:
+        """Move the pages older than `archive_max_age_days` to the archive."""
+        stats = move_pages(self.collection, self.archive_collection, get_cutoff(self.archive_max_age_days))
+        self.archive_boundary = None
+        return stats
+
+    def rebuild_dedup(self) -> Dict[str, float]:
+        """Index the pages ingested without dedup for it; see `page_dedup`."""
+        return self.duplicate_index.backfill(self.get_tiers())
+
+    def upsert_page(
+            self, document: dict, dry_run: bool = False, timer: StageTimer = None
+    ) -> Optional[Dict[str, str]]:
+        """Add a page to the database. If the page has already been registered, update the page.
+
+        With `dry_run`, return the page with the status it would get without writing anything.
+        `timer` times the stages of the page; see `ingest_profiler`.
+        """
+        stage = timer.stage if timer is not None else no_stage
+        with stage('reshape'):
+            document_ = self.reshape_document(document)
+        if document_ is None:
+            return
+        with stage('reshape_snippets'):
+            document_['ja_snippets'] = self.reshape_snippets(document['snippets'])
+            document_['en_snippets'] = self.reshape_snippets(document['snippets_en'])
+
+        url = document_['url']
+        with stage('find_one'):
+            existing_collection = self.collection
+            existing_page = self.collection.find_one({'page.url': url})
+            if not existing_page and self.archive_collection is not None:
+                existing_collection = self.archive_collection
+                existing_page = self.archive_collection.find_one({'page.url': url})
+            duplicate = None
+            if not existing_page and self.duplicate_index is not None:
+                duplicate = self.duplicate_index.find_duplicate(url)
+
+        signature, canonical_url = None, None
+        is_newer = bool(existing_page) and document_['orig']['timestamp'] > existing_page['page']['orig']['timestamp']
+        if is_newer and self.duplicate_index is not None:
+            with stage('dedup'):
+                # An updated page is indexed with the signature of its new text.
+                signature = get_signature(document_)
+        elif not existing_page and self.duplicate_index is not None:
+            with stage('dedup'):
+                if duplicate:
+                    canonical_url = duplicate['canonical_url']
+                else:
+                    signature = get_signature(document_)
+                    if signature is not None:
+                        canonical_url = self.duplicate_index.find_canonical(
+                            signature, document_['country'], self.get_tiers()
+                        )
+
+        with stage('write'):
+            if canonical_url:
+                if not dry_run and (
+                        not duplicate or document_['orig']['timestamp'] > duplicate['page']['orig']['timestamp']):
+                    self.duplicate_index.add_duplicate(document_, canonical_url)
+                document_['status'] = Status.DUPLICATE
+                document_['canonical_url'] = canonical_url
+            elif is_newer:
+                if not dry_run:
+                    collection = self.get_tier(document_['orig']['simple_timestamp'])
+                    update = {'$set': {'page': document_, 'updated_at': datetime.utcnow()}}
+                    if signature is not None:
+                        update['$set']['minhash'] = signature.tobytes()
+                    elif self.duplicate_index is not None:
+                        update['$unset'] = {'minhash': 1}
+                    collection.update_one({'page.url': url}, update, upsert=True)
+                    if collection is not existing_collection:
+                        existing_collection.delete_one({'page.url': url})  # the page has moved out of the archive
+                    if self.duplicate_index is not None:
+                        self.duplicate_index.update_page(existing_page, signature, document_['country'], url)
+                    self.count_deltas.update(get_count_deltas(existing_page['page'], document_))
+                document_['status'] = Status.UPDATED
+            elif not existing_page:
+                if not dry_run:
+                    collection = self.get_tier(document_['orig']['simple_timestamp'])
+                    doc = {'page': document_, 'updated_at': datetime.utcnow()}
+                    if signature is not None:
+                        doc['minhash'] = signature.tobytes()
+                    collection.insert_one(doc)
+                    if signature is not None:
+                        self.duplicate_index.add_page(signature, document_['country'], url)
+                    self.count_deltas.update(get_count_deltas(None, document_))
+                document_['status'] = Status.INSERTED
+            else:
+                document_['status'] = Status.IGNORED
+        return document_
+
+    @staticmethod
+    def reshape_document(document: dict) -> Optional[dict]:
+        """The page of an article of the article list, without its snippets; None if a title is missing."""
         if any((
                 not document['orig']['title'],
                 not document['ja_translated']['title'],
@@ -49,26 +247,6 @@ class DBHandler:
         )):
             return
 
-        def reshape_snippets(snippets: Dict[str, List[str]]) -> Dict[str, str]:
-            # Find a general snippet.
-            general_snippet = ''
-            for itopic in ITOPICS:
-                if itopic in snippets:
-                    general_snippet = snippets[itopic][0] if snippets[itopic] else ''
-                    break
-
-            # Reshape snippets.
-            reshaped = {}
-            for itopic in ITOPICS:
-                snippets_about_topic = snippets.get(itopic, [])
-                if snippets_about_topic and snippets_about_topic[0]:
-                    reshaped[itopic] = snippets_about_topic[0].strip()
-                elif general_snippet:
-                    reshaped[itopic] = general_snippet
-                else:
-                    reshaped[itopic] = ''
-            return reshaped
-
         is_about_covid_19: int = document['classes']['is_about_COVID-19']
         country: str = document['country']
         orig: Dict[str, str] = {
@@ -94,8 +272,6 @@ class DBHandler:
                 topics[topic] = float(score)
             else:
                 break
-        ja_snippets = reshape_snippets(document['snippets'])
-        en_snippets = reshape_snippets(document['snippets_en'])
 
         is_checked = 0
         is_useful = 1 if document['classes_bert']['is_useful'] > USEFUL_THRESHOLD else 0
@@ -105,7 +281,7 @@ class DBHandler:
         domain = document.get('domain', '')
         ja_domain_label = document.get('domain_label', '')
         en_domain_label = document.get('domain_label_en', '')
-        document_ = {
+        return {
             'country': country,
             'displayed_country': country,
             'orig': orig,
@@ -113,172 +289,447 @@ class DBHandler:
             'en_translated': en_translated,
             'url': url,
             'topics': topics,
-            'ja_snippets': ja_snippets,
-            'en_snippets': en_snippets,
+            'ja_snippets': {},
+            'en_snippets': {},
             'is_checked': is_checked,
             'is_hidden': 0,
             'is_about_COVID-19': is_about_covid_19,
             'is_useful': is_useful,
             'is_clear': is_clear,
             'is_about_false_rumor': is_about_false_rumor,
+            'scores': DBHandler.get_queue_scores(document),
             'domain': domain,
             'ja_domain_label': ja_domain_label,
             'en_domain_label': en_domain_label
         }
 
-        existing_page = self.collection.find_one({'page.url': url})
-        if existing_page and orig['timestamp'] > existing_page['page']['orig']['timestamp']:
-            self.collection.update_one({'page.url': url}, {'$set': {'page': document_}}, upsert=True)
-            document_['status'] = Status.UPDATED
-        elif not existing_page:
-            self.collection.insert_one({'page': document_})
-            document_['status'] = Status.INSERTED
-        else:
-            document_['status'] = Status.IGNORED
-        return document_
+    @staticmethod
+    def get_queue_scores(document: dict) -> Dict[str, float]:
+        return {score: float(document['classes_bert'][score]) for score in QUEUE_SCORES.values()}
+
+    def backfill_scores(self, documents: Iterator[dict]) -> Dict[str, int]:
+        """Set the queue scores of the pages ingested before they were kept, from their articles in `documents`."""
+        stats = {'articles': 0, 'updated': 0}
+        requests = []
+        for document in documents:
+            stats['articles'] += 1
+            requests.append(UpdateOne(
+                {'page.url': document['url'], 'page.scores': {'$exists': False}},
+                {'$set': {'page.scores': self.get_queue_scores(document)}},
+            ))
+            if len(requests) == SCORES_BATCH_SIZE:
+                stats['updated'] += self.collection.bulk_write(requests, ordered=False).modified_count
+                requests = []
+        if requests:
+            stats['updated'] += self.collection.bulk_write(requests, ordered=False).modified_count
+        return stats
 
-    def classes(self, etopic: str, ecountry: str, start: int, limit: int, lang: str, query: str):
+    @staticmethod
+    def reshape_snippets(snippets: Dict[str, List[str]]) -> Dict[str, str]:
+        # Find a general snippet.
+        general_snippet = ''
+        for itopic in ITOPICS:
+            if itopic in snippets:
+                general_snippet = snippets[itopic][0] if snippets[itopic] else ''
+                break
+
+        # Reshape snippets.
+        reshaped = {}
+        for itopic in ITOPICS:
+            snippets_about_topic = snippets.get(itopic, [])
+            if snippets_about_topic and snippets_about_topic[0]:
+                reshaped[itopic] = snippets_about_topic[0].strip()
+            elif general_snippet:
+                reshaped[itopic] = general_snippet
+            else:
+                reshaped[itopic] = ''
+        return reshaped
+
+    def flush_counts(self):
+        """Write the changes of the counts made by `upsert_page` since the last flush."""
+        apply_count_deltas(self.counts_collection, self.count_deltas)
+        self.count_deltas.clear()
+
+    def classes(
+            self,
+            etopic: str,
+            ecountry: str,
+            start: int,
+            limit: int,
+            lang: str,
+            query: str,
+            with_total: bool = False,
+            since: str = None,
+            until: str = None,
+    ):
         if etopic == 'search':
-            return self.search(ecountry, start, limit, lang, query)
+            return self.search(ecountry, start, limit, lang, query, since, until)
+
+        cells = self.get_class_cells(etopic, ecountry)
+        return self.assemble_cells(cells, [
+            self.get_cell(itopics, icountries, start, limit, lang, with_total, since, until)
+            for _, itopics, icountries in cells
+        ])
+
+    def countries(
+            self,
+            ecountry: str,
+            etopic: str,
+            start: int,
+            limit: int,
+            lang: str,
+            with_total: bool = False,
+            since: str = None,
+            until: str = None,
+    ):
+        cells = self.get_country_cells(ecountry, etopic)
+        return self.assemble_cells(cells, [
+            self.get_cell(itopics, icountries, start, limit, lang, with_total, since, until)
+            for _, itopics, icountries in cells
+        ])
 
+    def get_cell(
+            self,
+            itopics: List[str],
+            icountries: List[str],
+            start: int,
+            limit: int,
+            lang: str,
+            with_total: bool,
+            since: str = None,
+            until: str = None,
+    ):
+        pages = self.get_pages(itopics, icountries, start, limit, lang, since, until)
+        if not with_total:
+            return pages
+        if since or until:
+            # The counts are not kept per date; count the pages in the range, which costs as much as the range.
+            return self.add_total(pages, self.count_pages(itopics, icountries, since, until), start)
+        return self.add_total(pages, self.page_counts.get_total(itopics, icountries), start)
+
+    @staticmethod
+    def add_total(pages: List[dict], total: Optional[int], start: int) -> dict:
+        """Wrap the pages of a cell with the number of its pages and whether there are pages after them."""
+        has_more = start + len(pages) < total if total is not None else len(pages) > 0
+        return {'pages': pages, 'total': total, 'has_more': has_more}
+
+    def search(
+            self, ecountry: str, start: int, limit: int, lang: str, query: str, since: str = None, until: str = None
+    ):
+        def convert_hits_to_pages(hits: list) -> list:
+            if len(hits) == 0:
+                return []
+            if not self.use_search_views:
+                return self.reshape_hits(hits, self.find_hit_docs(hits), lang)
+            pages, stale_hits = self.reshape_hit_views(hits, lang, self.find_hit_updates(hits))
+            if stale_hits:
+                pages = self.sort_hit_pages(pages + self.reshape_hits(stale_hits, self.find_hit_docs(stale_hits), lang))
+            return pages
+
+        index = self.get_es_index(lang)
+        cells = self.get_search_cells(ecountry)
+        results = []
+        for _, _, icountries in cells:
+            r = self.es.search(index=index, body=self.get_es_query(icountries, query, start, limit, since, until))
+            results.append(convert_hits_to_pages(r['hits']['hits']))
+        return self.assemble_cells(cells, results)
+
+    @staticmethod
+    def get_class_cells(etopic: str, ecountry: str) -> List[Tuple[Tuple[str, ...], List[str], List[str]]]:
+        """Enumerate the `(keys, itopics, icountries)` cells a `/classes` request is made of.
+
+        `keys` is the path of the cell in the response; an empty path means the response is the cell itself.
+        """
         etopic = ETOPIC_TRANS_MAP.get((etopic, 'ja'), etopic)
         ecountry = ECOUNTRY_TRANS_MAP.get((ecountry, 'ja'), ecountry)
 
         if etopic and ecountry:
-            itopics = ETOPIC_ITOPICS_MAP.get(etopic, [])
-            icountries = ECOUNTRY_ICOUNTRIES_MAP.get(ecountry, [])
-            reshaped_pages = self.get_pages(itopics, icountries, start, limit, lang)
+            return [((), ETOPIC_ITOPICS_MAP.get(etopic, []), ECOUNTRY_ICOUNTRIES_MAP.get(ecountry, []))]
         elif etopic:
             itopics = ETOPIC_ITOPICS_MAP.get(etopic, [])
-            reshaped_pages = {}
-            for ecountry, icountries in ECOUNTRY_ICOUNTRIES_MAP.items():
-                if ecountry == 'all':
-                    continue
-                reshaped_pages[ecountry] = self.get_pages(itopics, icountries, start, limit, lang)
+            return [
+                ((ecountry,), itopics, icountries)
+                for ecountry, icountries in ECOUNTRY_ICOUNTRIES_MAP.items() if ecountry != 'all'
+            ]
         else:
-            reshaped_pages = {}
-            for etopic, itopics in ETOPIC_ITOPICS_MAP.items():
-                if etopic == 'all':
-                    continue
-                reshaped_pages[etopic] = {}
-                for ecountry, icountries in ECOUNTRY_ICOUNTRIES_MAP.items():
-                    if ecountry == 'all':
-                        continue
-                    reshaped_pages[etopic][ecountry] = self.get_pages(itopics, icountries, start, limit, lang)
-        return reshaped_pages
-
-    def countries(self, ecountry: str, etopic: str, start: int, limit: int, lang: str):
+            return [
+                ((etopic, ecountry), itopics, icountries)
+                for etopic, itopics in ETOPIC_ITOPICS_MAP.items() if etopic != 'all'
+                for ecountry, icountries in ECOUNTRY_ICOUNTRIES_MAP.items() if ecountry != 'all'
+            ]
+
+    @staticmethod
+    def get_country_cells(ecountry: str, etopic: str) -> List[Tuple[Tuple[str, ...], List[str], List[str]]]:
+        """Enumerate the `(keys, itopics, icountries)` cells a `/countries` request is made of."""
         etopic = ETOPIC_TRANS_MAP.get((etopic, 'ja'), etopic)
         ecountry = ECOUNTRY_TRANS_MAP.get((ecountry, 'ja'), ecountry)
 
         if ecountry and etopic:
-            itopics = ETOPIC_ITOPICS_MAP.get(etopic, [])
-            icountries = ECOUNTRY_ICOUNTRIES_MAP.get(ecountry, [])
-            reshaped_pages = self.get_pages(itopics, icountries, start, limit, lang)
+            return [((), ETOPIC_ITOPICS_MAP.get(etopic, []), ECOUNTRY_ICOUNTRIES_MAP.get(ecountry, []))]
         elif ecountry:
             icountries = ECOUNTRY_ICOUNTRIES_MAP.get(ecountry, [])
-            reshaped_pages = {}
-            for etopic, itopics in ETOPIC_ITOPICS_MAP.items():
-                if etopic == 'all':
-                    continue
-                reshaped_pages[etopic] = self.get_pages(itopics, icountries, start, limit, lang)
+            return [
+                ((etopic,), itopics, icountries)
+                for etopic, itopics in ETOPIC_ITOPICS_MAP.items() if etopic != 'all'
+            ]
         else:
-            reshaped_pages = {}
-            for ecountry, icountries in ECOUNTRY_ICOUNTRIES_MAP.items():
-                if ecountry == 'all':
-                    continue
-                reshaped_pages[ecountry] = {}
-                for etopic, itopics in ETOPIC_ITOPICS_MAP.items():
-                    if etopic == 'all':
-                        continue
-                    reshaped_pages[ecountry][etopic] = self.get_pages(itopics, icountries, start, limit, lang)
-        return reshaped_pages
-
-    def search(self, ecountry: str, start: int, limit: int, lang: str, query: str):
-        def get_es_query(regions: List[str]):
-            return {
-                'query': {
-                    'bool': {
-                        'must': [
-                            {
-                                'bool': {
-                                    'should': [
-                                        {
-                                            'term': {
-                                                'region': region
-                                            }
+            return [
+                ((ecountry, etopic), itopics, icountries)
+                for ecountry, icountries in ECOUNTRY_ICOUNTRIES_MAP.items() if ecountry != 'all'
+                for etopic, itopics in ETOPIC_ITOPICS_MAP.items() if etopic != 'all'
+            ]
+
+    @staticmethod
+    def get_search_cells(ecountry: str) -> List[Tuple[Tuple[str, ...], List[str], List[str]]]:
+        """Enumerate the `(keys, itopics, icountries)` cells a search request is made of."""
+        if ecountry:
+            return [((), [], ECOUNTRY_ICOUNTRIES_MAP.get(ecountry, []))]
+        return [
+            ((ecountry,), [], icountries)
+            for ecountry, icountries in ECOUNTRY_ICOUNTRIES_MAP.items() if ecountry != 'all'
+        ]
+
+    @staticmethod
+    def assemble_cells(cells: List[Tuple[Tuple[str, ...], List[str], List[str]]], results: list):
+        """Nest the result of each cell under its path."""
+        if len(cells) == 1 and cells[0][0] == ():
+            return results[0]
+        assembled = {}
+        for (keys, _, _), result in zip(cells, results):
+            d = assembled
+            for key in keys[:-1]:
+                d = d.setdefault(key, {})
+            d[keys[-1]] = result
+        return assembled
+
+    @staticmethod
+    def get_es_index(lang: str) -> str:
+        return 'covid19-pages-ja' if lang == 'ja' else 'covid19-pages-en'
+
+    @staticmethod
+    def get_es_query(
+            regions: List[str], query: str, start: int, limit: int, since: str = None, until: str = None
+    ) -> dict:
+        return {
+            'query': {
+                'bool': {
+                    'must': [
+                        {
+                            'bool': {
+                                'should': [
+                                    {
+                                        'term': {
+                                            'region': region
                                         }
-                                        for region in regions
-                                    ]
-                                }
-                            },
-                            {
-                                'match': {
-                                    'text': query
-                                }
-                            },
-                        ],
-                    }
-                },
-                "highlight": {
-                    "fields": {
-                        "text": {}
-                    }
-                },
-                'sort': [{
-                    'timestamp.local': {
-                        'order': 'desc',
-                        'nested': {
-                            'path': 'timestamp'
-                        }
+                                    }
+                                    for region in regions
+                                ]
+                            }
+                        },
+                        {
+                            'match': {
+                                'text': query
+                            }
+                        },
+                    ],
+                    'filter': DBHandler.get_es_date_filter(since, until),
+                }
+            },
+            "highlight": {
+                "fields": {
+                    "text": {}
+                }
+            },
+            'sort': [{
+                'timestamp.local': {
+                    'order': 'desc',
+                    'nested': {
+                        'path': 'timestamp'
                     }
-                }],
-                'from': start,
-                'size': limit,
-            }
+                }
+            }],
+            'from': start,
+            'size': limit,
+        }
 
-        def convert_hits_to_pages(hits: list) -> list:
-            if len(hits) == 0:
-                return []
-            url_to_hit = {hit['_source']['url']: hit for hit in hits}
-            cur = self.collection.find(
-                filter={'$or': [{'page.url': hit['_source']['url']} for hit in hits]},
-                sort=self.get_sort()
-            )
-            return [
-                self.reshape_page(d['page'], lang, self.trim_snippet(url_to_hit[d['page']['url']]['highlight']['text']))
-                for d in cur
-            ]
+    @staticmethod
+    def get_es_date_filter(since: str = None, until: str = None) -> List[dict]:
+        """The filter of the pages published from `since` to `until` (inclusive dates) on `timestamp.local`."""
+        range_ = {}
+        if since:
+            range_['gte'] = since
+        if until:
+            range_['lt'] = DBHandler.get_next_day(until)
+        if not range_:
+            return []
+        return [{'nested': {'path': 'timestamp', 'query': {'range': {'timestamp.local': range_}}}}]
 
-        index = 'covid19-pages-ja' if lang == 'ja' else 'covid19-pages-en'
+    @staticmethod
+    def get_next_day(day: str) -> str:
+        return (date.fromisoformat(day) + timedelta(days=1)).isoformat()
 
-        if ecountry:
-            body = get_es_query([c for c in ECOUNTRY_ICOUNTRIES_MAP.get(ecountry, [])])
-            r = self.es.search(index=index, body=body)
-            return convert_hits_to_pages(r['hits']['hits'])
-        else:
-            reshaped_pages = {}
-            for ecountry, icountries in ECOUNTRY_ICOUNTRIES_MAP.items():
-                if ecountry == 'all':
-                    continue
-                body = get_es_query(icountries)
-                r = self.es.search(index=index, body=body)
-                reshaped_pages[ecountry] = convert_hits_to_pages(r['hits']['hits'])
-            return reshaped_pages
+    @staticmethod
+    def get_hits_filter(hits: list) -> dict:
+        return {'$or': [{'page.url': hit['_source']['url']} for hit in hits]}
+
+    def find_hit_docs(self, hits: list) -> List[dict]:
+        docs = list(self.collection.find(filter=self.get_hits_filter(hits), sort=self.get_sort()))
+        missing_hits = self.get_missing_hits(hits, docs) if self.archive_collection is not None else []
+        if missing_hits:
+            # The archived pages are older than the others, so they come last.
+            docs += self.archive_collection.find(filter=self.get_hits_filter(missing_hits), sort=self.get_sort())
+        return docs
+
+    def find_hit_updates(self, hits: list) -> Dict[str, Optional[datetime]]:
+        """The time the pages of search hits were last written, by URL; see `reshape_hit_views`."""
+        filter_ = {'page.url': {'$in': [hit['_source']['url'] for hit in hits]}}
+        updated_ats = {}
+        for collection in self.get_tiers():
+            for doc in collection.find(filter_, projection=['page.url', 'updated_at']):
+                updated_ats[doc['page']['url']] = doc.get('updated_at')
+        return updated_ats
 
-    def get_pages(self, itopics: List[str], icountries: List[str], start: int, limit: int, lang: str) -> List[dict]:
-        filter_ = self.get_filter(itopics, icountries)
+    @staticmethod
+    def get_missing_hits(hits: list, docs: List[dict]) -> list:
+        """The hits whose pages are not in `docs`."""
+        urls = {doc['page']['url'] for doc in docs}
+        return [hit for hit in hits if hit['_source']['url'] not in urls]
+
+    @classmethod
+    def reshape_hits(cls, hits: list, docs, lang: str) -> list:
+        """Reshape the Mongo documents of search hits, attaching the highlighted snippets."""
+        url_to_hit = {hit['_source']['url']: hit for hit in hits}
+        return [
+            cls.reshape_page(d['page'], lang, cls.trim_snippet(url_to_hit[d['page']['url']]['highlight']['text']))
+            for d in docs
+        ]
+
+    @classmethod
+    def reshape_hit_views(
+            cls, hits: list, lang: str, updated_ats: Dict[str, Optional[datetime]]
+    ) -> Tuple[List[dict], list]:
+        """Build the pages of search hits from the page views stored in the search index.
+
+        `updated_ats` are the times the pages were last written, from `find_hit_updates`. Returns the pages, in the
+        order of the hits, and the hits without an up-to-date view (e.g., edited since the last sync), which have to be
+        looked up in MongoDB.
+        """
+        pages, stale_hits = [], []
+        for hit in hits:
+            source = hit['_source']
+            if source.get('view_version') != SEARCH_VIEW_VERSION or 'view' not in source \
+                    or not cls.is_view_fresh(source, updated_ats):
+                stale_hits.append(hit)
+                continue
+            page = dict(source['view'], topics=list(source['view']['topics']))
+            cls.add_search_topic(page, cls.trim_snippet(hit['highlight']['text']))
+            pages.append(page)
+        return pages, stale_hits
+
+    @staticmethod
+    def is_view_fresh(source: dict, updated_ats: Dict[str, Optional[datetime]]) -> bool:
+        """Whether the view of a search document was built from the page as it was last written."""
+        if source['url'] not in updated_ats:
+            return False  # not in MongoDB anymore
+        updated_at = updated_ats[source['url']]
+        if updated_at is None:
+            return True
+        return bool(source.get('updated_at')) and datetime.fromisoformat(source['updated_at']) >= updated_at
+
+    @staticmethod
+    def sort_hit_pages(pages: List[dict]) -> List[dict]:
+        """Order pages the way the MongoDB lookup of search hits sorts them."""
+        return sorted(pages, key=lambda page: page['orig']['simple_timestamp'], reverse=True)
+
+    def get_pages(
+            self,
+            itopics: List[str],
+            icountries: List[str],
+            start: int,
+            limit: int,
+            lang: str,
+            since: str = None,
+            until: str = None,
+    ) -> List[dict]:
+        if self.page_index is not None:
+            return self.page_index.get_pages(itopics, icountries, start, limit, lang, since, until)
+        filter_ = self.get_filter(itopics, icountries, since, until)
         sort_ = self.get_sort(itopics)
         cur = self.collection.find(filter=filter_, sort=sort_)
-        return [self.reshape_page(doc['page'], lang) for doc in cur.skip(start).limit(limit)]
+        pages = [self.reshape_page(doc['page'], lang) for doc in cur.skip(start).limit(limit)]
+        if len(pages) < limit and self.archive_collection is not None:
+            # The request pages past the hot tier; the archived pages follow its pages.
+            num_hot = start + len(pages) if pages or not start else self.collection.count_documents(filter_)
+            cur = self.archive_collection.find(filter=filter_, sort=sort_)
+            pages += [
+                self.reshape_page(doc['page'], lang)
+                for doc in cur.skip(max(0, start - num_hot)).limit(limit - len(pages))
+            ]
+        return pages
+
+    def count_pages(self, itopics: List[str], icountries: List[str], since: str = None, until: str = None) -> int:
+        if self.page_index is not None:
+            return self.page_index.count_pages(itopics, icountries, since, until)
+        filter_ = self.get_filter(itopics, icountries, since, until)
+        return sum(collection.count_documents(filter_) for collection in self.get_tiers())
+
+    def export_pages(
+            self, itopics: List[str], icountries: List[str], lang: str, since: str = None, until: str = None
+    ) -> Iterator[dict]:
+        """Iterate over the pages of a cell, newest first, without holding more than a batch of them."""
+        filter_ = self.get_filter(itopics, icountries, since, until)
+        for collection in self.get_tiers():
+            cur = collection.find(
+                filter=filter_, projection=get_export_projection(lang), sort=EXPORT_SORT, batch_size=EXPORT_BATCH_SIZE
+            )
+            for doc in cur:
+                yield self.reshape_page(doc['page'], lang)
+
+    def get_queue(
+            self, order: str, icountries: List[str], start: int, limit: int, lang: str, visible_only: bool = False
+    ) -> List[dict]:
+        """The unchecked pages, the most likely useful (or false rumors) first, then the newest first.
+
+        With `visible_only`, only the pages the lists show are queued. Only the pages collection is read; archived pages
+        are not queued.
+        """
+        filter_ = self.get_queue_filter(icountries, visible_only)
+        cur = self.collection.find(filter=filter_, sort=self.get_queue_sort(order))
+        return [self.reshape_queue_page(doc['page'], lang) for doc in cur.skip(start).limit(limit)]
+
+    @staticmethod
+    def get_queue_filter(icountries: List[str] = None, visible_only: bool = False) -> dict:
+        # `page.is_checked` must match the filter of the partial indexes for MongoDB to use them.
+        filter_ = {'page.is_checked': 0}
+        if visible_only:
+            filter_.update({'page.is_about_COVID-19': 1, 'page.is_hidden': 0})
+        if icountries:
+            filter_['page.displayed_country'] = {'$in': icountries}
+        return filter_
+
+    @staticmethod
+    def get_queue_sort(order: str):
+        return [(f'page.scores.{QUEUE_SCORES[order]}', DESCENDING), ('page.orig.simple_timestamp', DESCENDING)]
+
+    @classmethod
+    def reshape_queue_page(cls, page: dict, lang: str) -> dict:
+        """A page of the queue: `reshape_page` with the scores; pages ingested before the scores were kept have none."""
+        scores = page.get('scores', {})
+        return dict(cls.reshape_page(page, lang), scores=scores)
 
     @staticmethod
-    def get_filter(itopics: List[str] = None, icountries: List[str] = None) -> Dict[str, List]:
+    def get_filter(
+            itopics: List[str] = None, icountries: List[str] = None, since: str = None, until: str = None
+    ) -> Dict[str, List]:
         filters = [{'$and': [{'page.is_about_COVID-19': 1}, {'page.is_hidden': 0}]}]
         if itopics:
             filters += [{'$or': [{f'page.topics.{itopic}': {'$exists': True}} for itopic in itopics]}]
         if icountries:
             filters += [{'page.displayed_country': {'$in': icountries}}]
+        if since:
+            filters += [{'page.orig.simple_timestamp': {'$gte': since}}]
+        if until:
+            filters += [{'page.orig.simple_timestamp': {'$lte': until}}]
         return {'$and': filters}
 
     @staticmethod
@@ -298,6 +749,19 @@ class DBHandler:
             }
             for itopic in page['topics'] if itopic in ITOPICS
         ]
+        DBHandler.add_search_topic(page, search_snippet)
+        page['translated'] = page[f'{lang}_translated']
+        page['domain_label'] = page[f'{lang}_domain_label']
+        page['is_about_false_rumor'] = 1 if page['domain'] == 'fij.info' else page['is_about_false_rumor']
+        # `pop` since the pages of `/export` are read without the fields of the other language.
+        for lang_ in ('ja', 'en'):
+            for field in ('snippets', 'translated', 'domain_label'):
+                page.pop(f'{lang_}_{field}', None)
+        page.pop('scores', None)  # only served by `/queue`
+        return page
+
+    @staticmethod
+    def add_search_topic(page: dict, search_snippet):
         if search_snippet:
             page['topics'].append(
                 {
@@ -306,16 +770,6 @@ class DBHandler:
                     'relatedness': -1.
                 }
             )
-        page['translated'] = page[f'{lang}_translated']
-        page['domain_label'] = page[f'{lang}_domain_label']
-        page['is_about_false_rumor'] = 1 if page['domain'] == 'fij.info' else page['is_about_false_rumor']
-        del page['ja_snippets']
-        del page['en_snippets']
-        del page['ja_translated']
-        del page['en_translated']
-        del page['ja_domain_label']
-        del page['en_domain_label']
-        return page
 
     @staticmethod
     def trim_snippet(search_snippet):
@@ -338,26 +792,125 @@ class DBHandler:
             etopics: List[str],
             notes: str
     ) -> Dict[str, Union[int, str, List[str]]]:
+        update, updated = self.get_page_update(
+            url, is_hidden, is_about_covid_19, is_useful, is_about_false_rumor, icountry, etopics, notes
+        )
+        before = self.find_tier(url).find_one_and_update(
+            {'page.url': url}, update, projection=COUNT_PROJECTION, upsert=True, return_document=ReturnDocument.BEFORE
+        )
+        before_page = before['page'] if before else None
+        after_page = apply_page_set(before_page, update['$set'])
+        apply_count_deltas(self.counts_collection, get_count_deltas(before_page, after_page))
+        get_generation().bump()
+        return updated
+
+    def update_pages(self, edits: List[Dict]) -> List[Dict]:
+        """Apply editors' checks with one bulk write (per tier when the archive is enabled).
+
+        `edits` are keyword arguments of `update_page`. A result is returned per edit, in the same order;
+        the check log records of the applied edits are in their `updated` field.
+        """
+        requests, results = self.get_page_updates(edits)
+        if requests:
+            urls = list({url for _, url, _ in requests})
+            befores, archived_urls = [], set()
+            for collection in self.get_tiers():
+                for doc in collection.find({'page.url': {'$in': urls}}, projection=COUNT_PROJECTION + ['page.url']):
+                    befores.append(doc['page'])
+                    if collection is self.archive_collection:
+                        archived_urls.add(doc['page']['url'])
+            applied = []
+            for collection, tier_requests in zip(self.get_tiers(), self.split_page_updates(requests, archived_urls)):
+                if not tier_requests:
+                    continue
+                try:
+                    collection.bulk_write(self.get_bulk_requests(tier_requests), ordered=True)
+                    applied += tier_requests
+                except BulkWriteError as e:
+                    applied += tier_requests[:e.details['writeErrors'][0]['index']]
+                    self.fail_page_updates(tier_requests, results, e.details)
+            apply_count_deltas(self.counts_collection, self.get_page_updates_count_deltas(befores, applied))
+            get_generation().bump()
+        return results
+
+    @staticmethod
+    def split_page_updates(requests: List[Tuple[int, str, dict]], archived_urls: Set[str]) -> Tuple[list, list]:
+        """Split the requests of `get_page_updates` into those of the pages collection and those of the archive."""
+        return (
+            [request for request in requests if request[1] not in archived_urls],
+            [request for request in requests if request[1] in archived_urls],
+        )
+
+    @staticmethod
+    def get_bulk_requests(requests: List[Tuple[int, str, dict]]) -> List[UpdateOne]:
+        return [UpdateOne({'page.url': url}, update, upsert=True) for _, url, update in requests]
+
+    @staticmethod
+    def get_page_updates_count_deltas(befores: List[dict], requests: List[Tuple[int, str, dict]]) -> Counter:
+        """The changes of the counts made by a batch of edits, given the pages they update as they were before."""
+        pages = {page['url']: page for page in befores}
+        deltas = Counter()
+        for _, url, update in requests:
+            after = apply_page_set(pages.get(url), update['$set'])
+            deltas.update(get_count_deltas(pages.get(url), after))
+            pages[url] = after
+        return deltas
+
+    @classmethod
+    def get_page_updates(cls, edits: List[Dict]) -> Tuple[List[Tuple[int, str, dict]], List[Dict]]:
+        """Build the `(position of the edit, url, update)` of the valid edits of a batch and the results of all."""
+        requests, results = [], []
+        for i, edit in enumerate(edits):
+            url, etopics = edit.get('url'), edit.get('etopics')
+            if not url or not isinstance(url, str):
+                results.append({'url': url, 'status': 'error', 'message': 'Parameter `url` is required.'})
+            elif not isinstance(etopics, list) or any(etopic not in ETOPIC_ITOPICS_MAP for etopic in etopics):
+                results.append({'url': url, 'status': 'error', 'message': 'Unknown classes in `new_classes`.'})
+            else:
+                update, updated = cls.get_page_update(**edit)
+                requests.append((i, url, update))
+                results.append({'url': url, 'status': 'updated', 'updated': updated})
+        return requests, results
+
+    @staticmethod
+    def fail_page_updates(requests: List[Tuple[int, str, dict]], results: List[Dict], details: Dict):
+        """Mark the edits that an ordered bulk write did not apply because it stopped at an error."""
+        error = details['writeErrors'][0]
+        for j, (i, _, _) in enumerate(requests[error['index']:]):
+            message = error['errmsg'] if j == 0 else 'Not applied because of a previous error.'
+            results[i] = {'url': results[i]['url'], 'status': 'error', 'message': message}
+
+    @staticmethod
+    def get_page_update(
+            url: str,
+            is_hidden: bool,
+            is_about_covid_19: bool,
+            is_useful: bool,
+            is_about_false_rumor: bool,
+            icountry: str,
+            etopics: List[str],
+            notes: str
+    ) -> Tuple[dict, Dict[str, Union[int, str, List[str]]]]:
+        """Build the Mongo update for an editor's check and the record to be written to the check log."""
         new_is_hidden = 1 if is_hidden else 0
         new_is_about_covid_19 = 1 if is_about_covid_19 else 0
         new_is_useful = 1 if is_useful else 0
         new_is_about_false_rumor = 1 if is_about_false_rumor else 0
         new_etopics = {ETOPIC_ITOPICS_MAP[etopic][0]: 1.0 for etopic in etopics}
 
-        self.collection.update_one(
-            {'page.url': url},
-            {'$set': {
+        update = {
+            '$set': {
                 'page.is_hidden': new_is_hidden,
                 'page.is_about_COVID-19': new_is_about_covid_19,
                 'page.is_useful': new_is_useful,
                 'page.is_about_false_rumor': new_is_about_false_rumor,
                 'page.is_checked': 1,
                 'page.displayed_country': icountry,
-                'page.topics': new_etopics
-            }},
-            upsert=True
-        )
-        return {
+                'page.topics': new_etopics,
+                'updated_at': datetime.utcnow(),
+            }
+        }
+        updated = {
             'url': url,
             'is_hidden': new_is_hidden,
             'is_about_COVID-19': new_is_about_covid_19,
@@ -368,3 +921,4 @@ class DBHandler:
             'notes': notes,
             'time': datetime.now().isoformat()
         }
+        return update, updated
@@ -0,0 +1,57 @@
+"""A data generation counter shared by all the processes on the host.
+
+Every write that changes what the API serves (an editor's update, a database update by cron, new stats or sources)
+bumps the counter. Workers compare it with the generation their caches were filled at, which costs a read from a
+memory-mapped file, and drop the caches when it has moved.
+"""
+import fcntl
+import mmap
+import os
+import struct
+import threading
+
+GENERATION_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'generation')
+GENERATION_FORMAT = '<Q'
+GENERATION_SIZE = struct.calcsize(GENERATION_FORMAT)
+
+
+class Generation:
+
+    def __init__(self, path: str = GENERATION_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o664)
+        if os.fstat(self.fd).st_size < GENERATION_SIZE:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self.fd).st_size < GENERATION_SIZE:
+                    os.ftruncate(self.fd, GENERATION_SIZE)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.mm = mmap.mmap(self.fd, GENERATION_SIZE)
+        # `flock` excludes other processes, not the other threads of this one (e.g., the jobs of `cron.py --daemon`).
+        self.lock = threading.Lock()
+
+    def current(self) -> int:
+        return struct.unpack_from(GENERATION_FORMAT, self.mm, 0)[0]
+
+    def bump(self) -> int:
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                generation = self.current() + 1
+                struct.pack_into(GENERATION_FORMAT, self.mm, 0, generation)
+                self.mm.flush()
+                return generation
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+_generation = None
+
+
+def get_generation() -> Generation:
+    """Return the generation counter of this process, opening it on first use."""
+    global _generation
+    if _generation is None:
+        _generation = Generation()
+    return _generation
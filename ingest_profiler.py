@@ -0,0 +1,44 @@
+"""Timing of the stages of the ingest by `cron.py --update_database --profile`.
+
+`DBHandler.upsert_page` runs each stage of a page in `StageTimer.stage`, and cron reports the time spent per stage
+with the would-be statuses and the throughput, so that an ingest optimization can be measured (with `--dry_run`,
+without writing) before it is run in production.
+"""
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from typing import ContextManager, Iterator, List
+
+STAGES = ['parse', 'reshape', 'reshape_snippets', 'find_one', 'dedup', 'write']
+
+
+def no_stage(name: str) -> ContextManager:
+    return nullcontext()
+
+
+class StageTimer:
+
+    def __init__(self):
+        self.seconds = Counter()
+        self.calls = Counter()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+            self.calls[name] += 1
+
+    def format_report(self, seconds: float) -> List[str]:
+        """One line per stage: total time, share of `seconds` (the wall time of the ingest) and time per call."""
+        seconds = max(seconds, 1e-9)
+        lines = []
+        for name in STAGES + sorted(set(self.seconds) - set(STAGES)):
+            if self.calls[name]:
+                lines.append(f'{name:<18}{self.seconds[name]:9.2f} s{100 * self.seconds[name] / seconds:7.1f} %'
+                             f'{1e6 * self.seconds[name] / self.calls[name]:10.0f} us/call ({self.calls[name]} calls)')
+        other = seconds - sum(self.seconds.values())
+        lines.append(f'{"other":<18}{other:9.2f} s{100 * other / seconds:7.1f} %')
+        return lines
@@ -0,0 +1,353 @@
+"""An embedded full-text search engine that can stand in for ElasticSearch.
+
+`LocalSearch` answers the queries built by `DBHandler.get_es_query` and accepts the bulk requests sent by `SearchSync`,
+so `DBHandler.search` and cron work with it unchanged. Each index is an SQLite database holding the documents and an
+inverted index from terms to documents. Latin text is indexed by words; runs of Japanese/Chinese/Korean characters
+are indexed by character unigrams and bigrams, and a query word in such a script matches documents containing all its
+bigrams (and the word itself). As with the `match` query of `get_es_query`, a document matches if any query word does;
+results are ordered by timestamp, newest first.
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from elasticsearch.exceptions import ConnectionError as ESConnectionError
+
+logger = logging.getLogger(__file__)
+
+LOCAL_SEARCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'search')
+
+CJK_PATTERN = r'[぀-ヿ㐀-䶿一-鿿豈-﫿가-힯]'
+TOKEN_PATTERN = re.compile(rf'({CJK_PATTERN}+)|([^\W_]+)')
+CJK_RUN_PATTERN = re.compile(rf'{CJK_PATTERN}+')
+
+FRAGMENT_SIZE = 100
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS docs (
+    id INTEGER PRIMARY KEY,
+    doc_id TEXT UNIQUE NOT NULL,
+    region TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    text TEXT NOT NULL,
+    source TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS docs_timestamp ON docs (timestamp DESC);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT NOT NULL,
+    doc INTEGER NOT NULL,
+    PRIMARY KEY (term, doc)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc);
+'''
+
+
+def normalize(text: str) -> str:
+    return unicodedata.normalize('NFKC', text).lower()
+
+
+def tokenize(text: str) -> Set[str]:
+    """The terms of a text: words, and the character unigrams and bigrams of CJK runs."""
+    terms = set()
+    for cjk, word in TOKEN_PATTERN.findall(normalize(text)):
+        if word:
+            terms.add(word)
+        else:
+            terms.update(cjk)
+            terms.update(cjk[i:i + 2] for i in range(len(cjk) - 1))
+    return terms
+
+
+def get_query_terms(word: str) -> Set[str]:
+    """The terms a document must have to match a query word: its words, and the bigrams of its CJK runs."""
+    terms = set()
+    for cjk, word_ in TOKEN_PATTERN.findall(normalize(word)):
+        if word_:
+            terms.add(word_)
+        elif len(cjk) == 1:
+            terms.add(cjk)
+        else:
+            terms.update(cjk[i:i + 2] for i in range(len(cjk) - 1))
+    return terms
+
+
+def parse_timestamp(timestamp: str) -> float:
+    try:
+        return datetime.fromisoformat(timestamp).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def get_time_range(body: dict) -> Tuple[Optional[float], Optional[float]]:
+    """The `[gte, lt)` range of the timestamps of the filter built by `DBHandler.get_es_date_filter`, if any."""
+    lower, upper = None, None
+    for filter_ in body['query']['bool'].get('filter', []):
+        range_ = filter_['nested']['query']['range']['timestamp.local']
+        if 'gte' in range_:
+            lower = parse_timestamp(range_['gte'])
+        if 'lt' in range_:
+            upper = parse_timestamp(range_['lt'])
+    return lower, upper
+
+
+def highlight(text: str, words: List[str]) -> List[str]:
+    """A fragment of `text` around the first match, with the matches of `words` wrapped in `<em>` like ElasticSearch."""
+    pattern = re.compile('|'.join(re.escape(word) for word in sorted(words, key=len, reverse=True)), re.IGNORECASE)
+    m = pattern.search(text)
+    if not m:
+        return [text[:FRAGMENT_SIZE]]
+    begin = max(0, m.start() - FRAGMENT_SIZE // 2)
+    return [pattern.sub(lambda m_: f'<em>{m_.group(0)}</em>', text[begin:begin + FRAGMENT_SIZE])]
+
+
+class LocalIndices:
+
+    def __init__(self, search: 'LocalSearch'):
+        self.search = search
+
+    def exists(self, index: str) -> bool:
+        return os.path.exists(self.search.get_path(index))
+
+    def create(self, index: str, body: dict = None):
+        self.search.connect(index)
+
+    def delete(self, index: str, ignore=None):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.search.get_path(index) + suffix):
+                os.remove(self.search.get_path(index) + suffix)
+        self.search.get_connections().pop(index, None)
+
+    def refresh(self, index: str = None):
+        pass  # writes are visible as soon as they are committed
+
+
+class LocalSearch:
+    """Just enough of `Elasticsearch` for `DBHandler.search` and `SearchSync`, backed by SQLite files in `search_dir`."""
+
+    def __init__(self, search_dir: str = LOCAL_SEARCH_DIR):
+        self.search_dir = search_dir
+        self.local = threading.local()  # SQLite connections cannot be shared between threads
+        self.indices = LocalIndices(self)
+
+    def get_path(self, index: str) -> str:
+        return os.path.join(self.search_dir, f'{index}.sqlite3')
+
+    def get_connections(self) -> Dict[str, sqlite3.Connection]:
+        if not hasattr(self.local, 'connections'):
+            self.local.connections = {}
+        return self.local.connections
+
+    def connect(self, index: str) -> sqlite3.Connection:
+        connections = self.get_connections()
+        conn = connections.get(index)
+        if conn is None:
+            os.makedirs(self.search_dir, exist_ok=True)
+            conn = sqlite3.connect(self.get_path(index), timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')  # readers are not blocked by cron's writes
+            conn.executescript(SCHEMA)
+            connections[index] = conn
+        return conn
+
+    @staticmethod
+    @contextmanager
+    def transaction(conn: sqlite3.Connection):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def index(self, index: str, body: dict, id: str):
+        with self.transaction(self.connect(index)) as conn:
+            self.put(conn, id, body)
+
+    def delete(self, index: str, id: str):
+        with self.transaction(self.connect(index)) as conn:
+            self.remove(conn, id)
+
+    def bulk(self, body: List[dict]) -> dict:
+        """Apply index and delete actions; the actions on each index are committed at once."""
+        by_index: Dict[str, List[tuple]] = {}
+        actions = iter(body)
+        for action in actions:
+            (op, meta), = action.items()
+            by_index.setdefault(meta['_index'], []).append((op, meta, next(actions) if op == 'index' else None))
+        items = []
+        for index, index_actions in by_index.items():
+            with self.transaction(self.connect(index)) as conn:
+                for op, meta, source in index_actions:
+                    if op == 'index':
+                        self.put(conn, meta['_id'], source)
+                        status = 200
+                    else:
+                        status = 200 if self.remove(conn, meta['_id']) else 404
+                    items.append({op: dict(meta, status=status)})
+        return {'errors': False, 'items': items}
+
+    @staticmethod
+    def remove(conn: sqlite3.Connection, doc_id: str) -> bool:
+        row = conn.execute('SELECT id FROM docs WHERE doc_id = ?', (doc_id,)).fetchone()
+        if row is None:
+            return False
+        conn.execute('DELETE FROM postings WHERE doc = ?', row)
+        conn.execute('DELETE FROM docs WHERE id = ?', row)
+        return True
+
+    def put(self, conn: sqlite3.Connection, doc_id: str, source: dict):
+        self.remove(conn, doc_id)
+        cur = conn.execute(
+            'INSERT INTO docs (doc_id, region, timestamp, text, source) VALUES (?, ?, ?, ?, ?)',
+            (doc_id, source['region'], parse_timestamp(source['timestamp']['local']), source['text'],
+             json.dumps(source, ensure_ascii=False)),
+        )
+        conn.executemany('INSERT INTO postings (term, doc) VALUES (?, ?)',
+                         [(term, cur.lastrowid) for term in tokenize(source['text'])])
+
+    def search(self, index: str, body: dict) -> dict:
+        """Answer a query in the shape built by `DBHandler.get_es_query`."""
+        must = body['query']['bool']['must']
+        regions = [should['term']['region'] for should in must[0]['bool']['should']]
+        words = [word for word in must[1]['match']['text'].split() if get_query_terms(word)]
+        start, size = body.get('from', 0), body.get('size', 10)
+        time_range = get_time_range(body)
+        if not regions or not words or not os.path.exists(self.get_path(index)):
+            return {'hits': {'total': {'value': 0, 'relation': 'eq'}, 'hits': []}}
+
+        hits = []
+        total = 0
+        for id_, text, source in self.iterate_matches(self.connect(index), regions, words, start + size, time_range):
+            total += 1
+            if total > start:
+                hits.append({'_id': id_, '_source': json.loads(source), 'highlight': {'text': highlight(text, words)}})
+                if len(hits) == size:
+                    break
+        # Like ElasticSearch with `track_total_hits` disabled, the total is a lower bound once the page is filled.
+        relation = 'gte' if len(hits) == size else 'eq'
+        return {'hits': {'total': {'value': total, 'relation': relation}, 'hits': hits}}
+
+    @staticmethod
+    def iterate_matches(
+            conn: sqlite3.Connection,
+            regions: List[str],
+            words: List[str],
+            size: int,
+            time_range: Tuple[Optional[float], Optional[float]] = (None, None),
+    ) -> Iterator[tuple]:
+        """Iterate over `(doc_id, text, source)` of the documents matching any of `words`, newest first.
+
+        `size` is the number of matches expected to be consumed; it is used to choose between scanning the documents
+        newest first until enough of them match (cheap for common words) and sorting all the matching documents
+        (cheap for rare words). `time_range` restricts the documents to timestamps in `[lower, upper)`.
+        """
+        time_conditions, time_params = [], []
+        for condition, bound in zip(('timestamp >= ?', 'timestamp < ?'), time_range):
+            if bound is not None:
+                time_conditions.append(condition)
+                time_params.append(bound)
+        time_sql = ''.join(f' AND {condition}' for condition in time_conditions)
+
+        word_terms = [sorted(get_query_terms(word)) for word in words]
+        counts = {
+            term: conn.execute('SELECT COUNT(*) FROM postings WHERE term = ?', (term,)).fetchone()[0]
+            for terms in word_terms for term in terms
+        }
+        num_candidates = sum(min(counts[term] for term in terms) for terms in word_terms)
+        # The documents of a time range are a range of `docs_timestamp`, so they are counted (and scanned) in its time.
+        num_docs = conn.execute(f'SELECT COUNT(*) FROM docs WHERE 1{time_sql}', time_params).fetchone()[0]
+        scan = num_candidates * num_candidates > size * num_docs
+
+        conditions, params = [], []
+        for terms in word_terms:
+            terms = sorted(terms, key=counts.get)  # check the rarest term first
+            if scan:
+                conditions.append(' AND '.join(
+                    ['EXISTS (SELECT 1 FROM postings WHERE term = ? AND doc = docs.id)'] * len(terms)
+                ))
+            else:
+                conditions.append(f'id IN ({" INTERSECT ".join(["SELECT doc FROM postings WHERE term = ?"] * len(terms))})')
+            params += terms
+        # Only the ids are sorted; the (large) rows are read as the matches are consumed.
+        sql = (
+            f'SELECT id FROM docs {"INDEXED BY docs_timestamp" if scan else ""} '
+            f'WHERE region IN ({", ".join("?" * len(regions))}){time_sql} '
+            f'AND ({" OR ".join(f"({c})" for c in conditions)}) '
+            f'ORDER BY timestamp DESC'
+        )
+
+        parts = [
+            ([cjk for cjk, _ in TOKEN_PATTERN.findall(normalize(word)) if cjk],
+             {word_ for _, word_ in TOKEN_PATTERN.findall(normalize(word)) if word_})
+            for word in words
+        ]
+        for id_, in conn.execute(sql, regions + time_params + params):
+            doc_id, text, source = conn.execute('SELECT doc_id, text, source FROM docs WHERE id = ?', (id_,)).fetchone()
+            # Bigrams can co-occur without the word; check that some word is in the text as a whole.
+            normalized = normalize(text)
+            text_words = {word_ for _, word_ in TOKEN_PATTERN.findall(normalized) if word_}
+            if any(all(run in normalized for run in runs) and latin <= text_words for runs, latin in parts):
+                yield doc_id, text, source
+
+
+_local_searches: Dict[str, LocalSearch] = {}
+
+
+def get_local_search(search_dir: str = LOCAL_SEARCH_DIR) -> LocalSearch:
+    """The `LocalSearch` of the process for `search_dir`, so that its connections are reused across requests."""
+    if search_dir not in _local_searches:
+        _local_searches[search_dir] = LocalSearch(search_dir)
+    return _local_searches[search_dir]
+
+
+class FallbackSearch:
+    """Send queries to ElasticSearch, and to a `LocalSearch` while ElasticSearch cannot be reached."""
+
+    def __init__(self, es, local: LocalSearch):
+        self.es = es
+        self.local = local
+
+    def search(self, index: str, body: dict) -> dict:
+        try:
+            return self.es.search(index=index, body=body)
+        except ESConnectionError as e:
+            logger.warning(f'ElasticSearch is unavailable ({e}); searching the local index.')
+            return self.local.search(index=index, body=body)
+
+
+class AsyncLocalSearch:
+    """Run the queries of a `LocalSearch` in threads, for `AsyncDBHandler`."""
+
+    def __init__(self, local: LocalSearch):
+        self.local = local
+
+    async def search(self, index: str, body: dict) -> dict:
+        return await asyncio.get_running_loop().run_in_executor(None, lambda: self.local.search(index=index, body=body))
+
+    async def close(self):
+        pass
+
+
+class AsyncFallbackSearch:
+
+    def __init__(self, es, local: LocalSearch):
+        self.es = es
+        self.local = AsyncLocalSearch(local)
+
+    async def search(self, index: str, body: dict) -> dict:
+        try:
+            return await self.es.search(index=index, body=body)
+        except ESConnectionError as e:
+            logger.warning(f'ElasticSearch is unavailable ({e}); searching the local index.')
+            return await self.local.search(index=index, body=body)
+
+    async def close(self):
+        await self.es.close()
@@ -1,47 +1,197 @@
+import fcntl
+import gzip
 import json
 import os
-from typing import List
+import re
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple
 
 TOPIC_CHECK_LOG = 'category_check.txt'
 FEEDBACK_LOG = 'feedback.txt'
 PAGE_NUMBER_LOG = 'update.txt'
 
+SEGMENT_PATTERN = re.compile(r'^(\d{8})-(\d+)\.txt(\.gz)?$')
+
+
+class SegmentedLog:
+    """An append-only log split into numbered segment files.
+
+    A log named `<name>.txt` is stored in the directory `<name>/` as `<seq>-<start time>.txt`. Appends go to the last
+    segment, which is rolled over when it grows past `segment_bytes` or gets older than `segment_seconds`.
+    The other segments are sealed; they are never written again, except by `compact`, and may be gzipped.
+    A log written by older versions as a single file is taken over as the first segment.
+    """
+
+    def __init__(self, log_dir: str, name: str, segment_bytes: int, segment_seconds: float):
+        self.legacy_path = os.path.join(log_dir, name)
+        self.dir = os.path.join(log_dir, os.path.splitext(name)[0])
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+
+    @contextmanager
+    def lock(self, name: str = '.lock'):
+        os.makedirs(self.dir, exist_ok=True)
+        with open(os.path.join(self.dir, name), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def take_over_legacy_file(self):
+        if not os.path.exists(self.legacy_path):
+            return
+        with self.lock():
+            if os.path.exists(self.legacy_path) and not self.segments():
+                start = int(os.path.getmtime(self.legacy_path))
+                os.rename(self.legacy_path, os.path.join(self.dir, f'{0:08d}-{start}.txt'))
+
+    def segments(self) -> List[Tuple[int, int, str]]:
+        """List `(seq, start time, path)` of the segments, oldest first."""
+        if not os.path.isdir(self.dir):
+            return []
+        segments = []
+        for file_name in os.listdir(self.dir):
+            m = SEGMENT_PATTERN.match(file_name)
+            if m:
+                segments.append((int(m.group(1)), int(m.group(2)), os.path.join(self.dir, file_name)))
+        return sorted(segments)
+
+    def sealed_segments(self) -> List[Tuple[int, int, str]]:
+        return self.segments()[:-1]
+
+    def append(self, lines: List[str]):
+        if not lines:
+            return
+        self.take_over_legacy_file()
+        data = ''.join(line + '\n' for line in lines)
+        with self.lock():
+            segments = self.segments()
+            if segments and not segments[-1][2].endswith('.gz'):
+                seq, start, path = segments[-1]
+                if os.path.getsize(path) >= self.segment_bytes or time.time() - start >= self.segment_seconds:
+                    path = self.new_segment_path(seq + 1)
+            else:
+                path = self.new_segment_path(segments[-1][0] + 1 if segments else 1)
+            with open(path, 'a') as f:
+                f.write(data)
+
+    def new_segment_path(self, seq: int) -> str:
+        return os.path.join(self.dir, f'{seq:08d}-{int(time.time())}.txt')
+
+    @staticmethod
+    def read_segment(path: str) -> List[str]:
+        try:
+            if path.endswith('.gz'):
+                with gzip.open(path, 'rt') as f:
+                    return f.readlines()
+            with open(path) as f:
+                return f.readlines()
+        except FileNotFoundError:  # removed by compaction; its records are in a newer segment
+            return []
+
+    def iterate(self) -> Iterator[str]:
+        """Iterate over the non-empty lines, oldest first."""
+        self.take_over_legacy_file()
+        for _, _, path in self.segments():
+            for line in self.read_segment(path):
+                if line.strip():
+                    yield line
+
+    def iterate_reversed(self) -> Iterator[str]:
+        """Iterate over the non-empty lines, newest first."""
+        self.take_over_legacy_file()
+        for _, _, path in reversed(self.segments()):
+            for line in reversed(self.read_segment(path)):
+                if line.strip():
+                    yield line
+
+    def compress(self):
+        """Gzip the sealed segments."""
+        for _, _, path in self.sealed_segments():
+            if path.endswith('.gz'):
+                continue
+            with open(path, 'rb') as f_in, gzip.open(path + '.tmp', 'wb') as f_out:
+                f_out.writelines(f_in)
+            with self.lock():
+                os.replace(path + '.tmp', path + '.gz')
+                os.remove(path)
+
+    def compact(self, get_key, compress: bool = False):
+        """Rewrite the sealed segments into one, keeping only the last line per key."""
+        self.take_over_legacy_file()
+        with self.lock('.compact.lock'):
+            sealed = self.sealed_segments()
+            if not sealed:
+                return
+            latest = {}
+            for _, _, path in sealed:
+                for line in self.read_segment(path):
+                    if line.strip():
+                        key = get_key(line)
+                        latest.pop(key, None)  # move the key to the end to keep the order of the last records
+                        latest[key] = line
+            seq, start, _ = sealed[-1]
+            path = os.path.join(self.dir, f'{seq:08d}-{start}.txt' + ('.gz' if compress else ''))
+            with (gzip.open(path + '.tmp', 'wt') if compress else open(path + '.tmp', 'w')) as f:
+                f.writelines(latest.values())
+            with self.lock():
+                os.replace(path + '.tmp', path)
+                for _, _, old_path in sealed:
+                    if old_path != path:
+                        os.remove(old_path)
+
+    def apply_retention(self, retention_segments: int):
+        """Remove the oldest sealed segments so that at most `retention_segments` sealed segments are kept."""
+        sealed = self.sealed_segments()
+        with self.lock():
+            for _, _, path in sealed[:max(0, len(sealed) - retention_segments)]:
+                os.remove(path)
+
 
 class LogHandler:
 
-    def __init__(self, log_dir: str):
+    def __init__(
+            self,
+            log_dir: str,
+            segment_bytes: int = 16 * 1024 * 1024,
+            segment_seconds: float = 7 * 24 * 60 * 60,
+            compress: bool = False,
+            retention_segments: Optional[int] = None,
+    ):
         self.log_dir = log_dir
+        self.compress = compress
+        self.retention_segments = retention_segments
+        self.topic_check_log = SegmentedLog(log_dir, TOPIC_CHECK_LOG, segment_bytes, segment_seconds)
+        self.feedback_log = SegmentedLog(log_dir, FEEDBACK_LOG, segment_bytes, segment_seconds)
+        self.page_number_log = SegmentedLog(log_dir, PAGE_NUMBER_LOG, segment_bytes, segment_seconds)
 
     def extend_topic_check_log(self, lines: List[str]):
-        self.extend_log(os.path.join(self.log_dir, TOPIC_CHECK_LOG), lines)
+        self.topic_check_log.append(lines)
 
     def extend_feedback_log(self, lines: List[str]):
-        self.extend_log(os.path.join(self.log_dir, FEEDBACK_LOG), lines)
+        self.feedback_log.append(lines)
 
     def extend_page_number_log(self, lines: List[str]):
-        self.extend_log(os.path.join(self.log_dir, PAGE_NUMBER_LOG), lines)
-
-    @staticmethod
-    def extend_log(path: str, lines: List[str]):
-        with open(path, 'a') as f:
-            for line in lines:
-                f.write(line + '\n')
+        self.page_number_log.append(lines)
 
     def find_topic_check_log(self, url: str):
-        path = os.path.join(self.log_dir, TOPIC_CHECK_LOG)
-        with open(path) as f:
-            for line in reversed(f.readlines()):
-                if line.strip() == '':
-                    break
-                edited_info = json.loads(line)
-                if edited_info.get('url', '') == url:
-                    edited_info['is_checked'] = 1
-                    return edited_info
+        for line in self.topic_check_log.iterate_reversed():
+            edited_info = json.loads(line)
+            if edited_info.get('url', '') == url:
+                edited_info['is_checked'] = 1
+                return edited_info
         return {'url': url, 'is_checked': 0}
 
     def iterate_topic_check_log(self):
-        path = os.path.join(self.log_dir, TOPIC_CHECK_LOG)
-        with open(path) as f:
-            for line in f:
-                if line.strip():
-                    yield line
+        yield from self.topic_check_log.iterate()
+
+    def maintain(self):
+        """Compact the topic check log to the latest record per URL, and compress and expire the other logs."""
+        self.topic_check_log.compact(lambda line: json.loads(line).get('url', ''), compress=self.compress)
+        for log in (self.feedback_log, self.page_number_log):
+            if self.compress:
+                log.compress()
+            if self.retention_segments is not None:
+                log.apply_retention(self.retention_segments)
@@ -0,0 +1,223 @@
+"""Per-request instrumentation exposed in the Prometheus text format.
+
+The statistics of the request being served are kept in a context variable, so that MongoDB commands (observed by a
+pymongo command listener) and ElasticSearch calls (observed by a transport wrapper) are attributed to it.
+Metrics are kept per process; with several gunicorn workers, each worker reports its own.
+"""
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict, Tuple
+
+from elasticsearch import Transport
+from pymongo import monitoring
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+SIZE_BUCKETS = (1e2, 1e3, 1e4, 1e5, 1e6, 1e7)
+
+
+class Histogram:
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    """Counters and histograms keyed by metric name and a tuple of label pairs."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.helps: Dict[str, Tuple[str, str]] = {}
+        self.counters: Dict[str, Dict[tuple, float]] = {}
+        self.histograms: Dict[str, Dict[tuple, Histogram]] = {}
+        self.histogram_buckets: Dict[str, Tuple[float, ...]] = {}
+
+    def counter(self, name: str, help_: str):
+        self.helps[name] = ('counter', help_)
+        self.counters[name] = {}
+
+    def histogram(self, name: str, help_: str, buckets: Tuple[float, ...]):
+        self.helps[name] = ('histogram', help_)
+        self.histograms[name] = {}
+        self.histogram_buckets[name] = buckets
+
+    def inc(self, name: str, value: float = 1., **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.counters[name][key] = self.counters[name].get(key, 0.) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if key not in self.histograms[name]:
+                self.histograms[name][key] = Histogram(self.histogram_buckets[name])
+            self.histograms[name][key].observe(value)
+
+    def get(self, name: str, **labels) -> float:
+        return self.counters[name].get(tuple(sorted(labels.items())), 0.)
+
+    def render(self) -> str:
+        def format_labels(labels) -> str:
+            if not labels:
+                return ''
+            escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for _, value in labels)
+            return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+        lines = []
+        with self.lock:
+            for name, (type_, help_) in self.helps.items():
+                lines.append(f'# HELP {name} {help_}')
+                lines.append(f'# TYPE {name} {type_}')
+                if type_ == 'counter':
+                    for labels, value in self.counters[name].items():
+                        lines.append(f'{name}{format_labels(labels)} {value}')
+                    continue
+                for labels, histogram in self.histograms[name].items():
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {count}')
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {histogram.count}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+                    lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+REGISTRY.counter('covid19_requests_total', 'The number of requests by route and status.')
+REGISTRY.histogram('covid19_request_duration_seconds', 'Request latency by route.', DURATION_BUCKETS)
+REGISTRY.histogram('covid19_request_mongo_commands', 'MongoDB commands per request by route.', COUNT_BUCKETS)
+REGISTRY.histogram('covid19_request_es_calls', 'ElasticSearch calls per request by route.', COUNT_BUCKETS)
+REGISTRY.histogram('covid19_response_bytes', 'Serialized response size by route.', SIZE_BUCKETS)
+REGISTRY.counter('covid19_mongo_commands_total', 'The number of MongoDB commands by command name.')
+REGISTRY.counter('covid19_mongo_command_seconds_total', 'Time spent in MongoDB commands by command name.')
+REGISTRY.counter('covid19_es_calls_total', 'The number of ElasticSearch calls by method.')
+REGISTRY.counter('covid19_es_call_seconds_total', 'Time spent in ElasticSearch calls by method.')
+REGISTRY.counter('covid19_cache_requests_total', 'Cache lookups by cache and result (hit or miss).')
+REGISTRY.counter('covid19_coalesced_requests_total',
+                 'Requests served by an identical concurrent computation, by whether they waited or got a stale result.')
+REGISTRY.counter('covid19_rejected_requests_total', 'Requests rejected by admission control, by reason.')
+
+
+class RequestStats:
+
+    __slots__ = ('start', 'mongo_commands', 'mongo_seconds', 'es_calls', 'es_seconds', 'cache_hits', 'cache_misses',
+                 'coalesced')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.mongo_commands = 0
+        self.mongo_seconds = 0.
+        self.es_calls = 0
+        self.es_seconds = 0.
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.coalesced = False
+
+
+_request_stats = ContextVar('request_stats', default=None)
+
+
+def start_request() -> RequestStats:
+    stats = RequestStats()
+    _request_stats.set(stats)
+    return stats
+
+
+def finish_request(stats: RequestStats, route: str, status: int, response_bytes: int) -> str:
+    """Record the metrics of a finished request and return its `Server-Timing` header value."""
+    duration = time.perf_counter() - stats.start
+    _request_stats.set(None)
+    REGISTRY.inc('covid19_requests_total', route=route, status=status)
+    REGISTRY.observe('covid19_request_duration_seconds', duration, route=route)
+    REGISTRY.observe('covid19_request_mongo_commands', stats.mongo_commands, route=route)
+    REGISTRY.observe('covid19_request_es_calls', stats.es_calls, route=route)
+    REGISTRY.observe('covid19_response_bytes', response_bytes, route=route)
+    return ', '.join([
+        f'app;dur={duration * 1000:.1f}',
+        f'mongo;dur={stats.mongo_seconds * 1000:.1f};desc="{stats.mongo_commands} commands"',
+        f'es;dur={stats.es_seconds * 1000:.1f};desc="{stats.es_calls} calls"',
+        f'cache;desc="{stats.cache_hits} hits, {stats.cache_misses} misses"',
+    ] + (['coalesced'] if stats.coalesced else []))
+
+
+def record_cache(cache: str, hit: bool):
+    REGISTRY.inc('covid19_cache_requests_total', cache=cache, result='hit' if hit else 'miss')
+    stats = _request_stats.get()
+    if stats is not None:
+        if hit:
+            stats.cache_hits += 1
+        else:
+            stats.cache_misses += 1
+
+
+def record_coalesced(how: str):
+    REGISTRY.inc('covid19_coalesced_requests_total', how=how)
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.coalesced = True
+
+
+def record_rejected(reason: str):
+    REGISTRY.inc('covid19_rejected_requests_total', reason=reason)
+
+
+def record_es_call(method: str, seconds: float):
+    REGISTRY.inc('covid19_es_calls_total', method=method)
+    REGISTRY.inc('covid19_es_call_seconds_total', seconds, method=method)
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.es_calls += 1
+        stats.es_seconds += seconds
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Count MongoDB commands and the time spent in them."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.record(event.command_name, event.duration_micros / 1e6)
+
+    def failed(self, event):
+        self.record(event.command_name, event.duration_micros / 1e6)
+
+    @staticmethod
+    def record(command_name: str, seconds: float):
+        REGISTRY.inc('covid19_mongo_commands_total', command=command_name)
+        REGISTRY.inc('covid19_mongo_command_seconds_total', seconds, command=command_name)
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.mongo_commands += 1
+            stats.mongo_seconds += seconds
+
+
+class InstrumentedTransport(Transport):
+
+    def perform_request(self, method, url, headers=None, params=None, body=None):
+        start = time.perf_counter()
+        try:
+            return super().perform_request(method, url, headers=headers, params=params, body=body)
+        finally:
+            record_es_call(method, time.perf_counter() - start)
+
+
+_installed = False
+
+
+def install():
+    """Register the MongoDB command listener. This must be called before any `MongoClient` is created."""
+    global _installed
+    if not _installed:
+        monitoring.register(MongoCommandListener())
+        _installed = True
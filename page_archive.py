@@ -0,0 +1,54 @@
+"""Hot/cold tiering of the pages collection.
+
+Cron moves the pages published before a cutoff from the pages collection (the hot tier) to
+`<collection name>_archive` (the cold tier) with `move_pages`. Every archived page is older than every page left in
+the hot tier, and `DBHandler.upsert_page` keeps it that way, so a list sorted newest first is the pages of the hot tier
+followed by those of the archive: readers query the archive only when a request pages past the hot tier.
+"""
+import time
+from datetime import date, timedelta
+from typing import Dict
+
+from pymongo import DESCENDING, DeleteOne, ReplaceOne
+
+
+def get_archive_collection_name(mongo_collection_name: str) -> str:
+    return f'{mongo_collection_name}_archive'
+
+
+def get_cutoff(max_age_days: int) -> str:
+    """The publication date the pages older than `max_age_days` are published before."""
+    return (date.today() - timedelta(days=max_age_days)).isoformat()
+
+
+def get_archive_boundary(archive_collection) -> str:
+    """The publication date of the newest archived page, or an empty string if nothing is archived."""
+    doc = archive_collection.find_one(
+        {}, projection=['page.orig.simple_timestamp'], sort=[('page.orig.simple_timestamp', DESCENDING)]
+    )
+    return doc['page']['orig']['simple_timestamp'] if doc else ''
+
+
+def move_pages(collection, archive_collection, cutoff: str, batch_size: int = 1000) -> Dict[str, float]:
+    """Move the pages published before `cutoff` to the archive.
+
+    A page is written to the archive before it is removed from the hot tier, and it is only removed if it has not been
+    written since it was read, so the job can be interrupted and run again without losing pages or edits.
+    """
+    started = time.time()
+    filter_ = {'page.orig.simple_timestamp': {'$lt': cutoff}}
+    moved = 0
+    while True:
+        docs = list(collection.find(filter_, limit=batch_size))
+        if not docs:
+            break
+        archive_collection.bulk_write([
+            ReplaceOne({'page.url': doc['page']['url']}, {key: doc[key] for key in doc if key != '_id'}, upsert=True)
+            for doc in docs
+        ], ordered=False)
+        r = collection.bulk_write([
+            DeleteOne({'_id': doc['_id'], 'updated_at': doc.get('updated_at')}) for doc in docs
+        ], ordered=False)
+        moved += r.deleted_count
+    seconds = time.time() - started
+    return {'moved': moved, 'seconds': seconds}
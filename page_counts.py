@@ -0,0 +1,163 @@
+"""Counts of pages per topic × country × visibility.
+
+The counts are kept in a MongoDB collection next to the pages, with one document per
+`(external topic, internal country, visibility)`. Writers update them incrementally with the difference between the
+states of the pages before and after their writes (`get_count_deltas`); `rebuild` recounts everything. Workers keep a
+copy in memory (`get_page_counts`), reloaded when the data generation moves.
+"""
+import threading
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import MongoClient, UpdateOne
+
+from generation import Generation, get_generation
+from util import ECOUNTRY_ICOUNTRIES_MAP, ETOPIC_ITOPICS_MAP
+
+VISIBILITIES = ('visible', 'hidden', 'off_topic')
+
+# The fields of a page its counts depend on.
+COUNT_PROJECTION = ['page.topics', 'page.displayed_country', 'page.is_hidden', 'page.is_about_COVID-19']
+
+# The key of the pages regardless of their topics, used by cells without a topic filter.
+ANY_TOPIC = ''
+
+CountKey = Tuple[str, str, str]
+
+
+def get_counts_collection_name(mongo_collection_name: str) -> str:
+    return f'{mongo_collection_name}_counts'
+
+
+def get_visibility(page: dict) -> str:
+    if page.get('is_hidden'):
+        return 'hidden'
+    return 'visible' if page.get('is_about_COVID-19') == 1 else 'off_topic'
+
+
+def get_count_keys(page: dict) -> List[CountKey]:
+    topics = page.get('topics') or {}
+    country, visibility = page.get('displayed_country'), get_visibility(page)
+    etopics = [etopic for etopic, itopics in ETOPIC_ITOPICS_MAP.items() if any(itopic in topics for itopic in itopics)]
+    return [(etopic, country, visibility) for etopic in etopics + [ANY_TOPIC]]
+
+
+def get_count_deltas(before: Optional[dict], after: Optional[dict]) -> Counter:
+    """The changes of the counts when a page goes from `before` to `after` (`None` when it does not exist)."""
+    deltas = Counter()
+    for key in get_count_keys(before) if before is not None else []:
+        deltas[key] -= 1
+    for key in get_count_keys(after) if after is not None else []:
+        deltas[key] += 1
+    return deltas
+
+
+def apply_page_set(page: Optional[dict], set_: dict) -> dict:
+    """The page after an update with the `$set` of `DBHandler.get_page_update` (or of the check log replay)."""
+    page = dict(page or {})
+    for key, value in set_.items():
+        if key.startswith('page.'):
+            page[key[len('page.'):]] = value
+    return page
+
+
+def get_count_requests(deltas: Counter) -> List[UpdateOne]:
+    return [
+        UpdateOne(
+            {'_id': '\t'.join(map(str, key))},
+            {'$inc': {'count': delta}, '$set': {'topic': key[0], 'country': key[1], 'visibility': key[2]}},
+            upsert=True,
+        )
+        for key, delta in deltas.items() if delta
+    ]
+
+
+def apply_count_deltas(counts_collection, deltas: Counter):
+    requests = get_count_requests(deltas)
+    if requests:
+        counts_collection.bulk_write(requests, ordered=False)
+
+
+def rebuild(collections: list, counts_collection):
+    """Recount the pages of `collections` (the pages collection and its archive) from scratch."""
+    counts = Counter()
+    for collection in collections:
+        for doc in collection.find({}, projection=COUNT_PROJECTION):
+            counts.update(get_count_keys(doc['page']))
+    counts_collection.delete_many({})
+    apply_count_deltas(counts_collection, counts)
+
+
+class PageCounts:
+
+    def __init__(self, counts_collection, generation: Generation):
+        self.counts_collection = counts_collection
+        self.generation = generation
+        self.lock = threading.Lock()
+        self.loaded_generation: Optional[int] = None
+        self.counts: Dict[CountKey, int] = {}
+        self.matrix: Dict[str, Dict[str, Dict[str, int]]] = {}
+
+    def ensure_fresh(self):
+        generation = self.generation.current()
+        if generation == self.loaded_generation:
+            return
+        with self.lock:
+            if generation == self.loaded_generation:
+                return
+            counts = {
+                (doc['topic'], doc['country'], doc['visibility']): doc['count']
+                for doc in self.counts_collection.find({})
+            }
+            self.counts = counts
+            self.matrix = self.get_matrix(counts)
+            self.loaded_generation = generation
+
+    @staticmethod
+    def get_matrix(counts: Dict[CountKey, int]) -> Dict[str, Dict[str, Dict[str, int]]]:
+        """Sum the counts per external topic × external country × visibility."""
+        matrix = {}
+        for etopic in ETOPIC_ITOPICS_MAP:
+            matrix[etopic] = {}
+            for ecountry, icountries in ECOUNTRY_ICOUNTRIES_MAP.items():
+                matrix[etopic][ecountry] = {
+                    visibility: sum(counts.get((etopic, icountry, visibility), 0) for icountry in icountries)
+                    for visibility in VISIBILITIES
+                }
+        return matrix
+
+    def get_total(self, itopics: List[str], icountries: List[str]) -> Optional[int]:
+        """The number of visible pages in a cell, or `None` if the topics are not those of an external topic."""
+        self.ensure_fresh()
+        if itopics:
+            etopics = [etopic for etopic, itopics_ in ETOPIC_ITOPICS_MAP.items() if itopics_ == list(itopics)]
+            if not etopics:
+                return None
+            etopic = etopics[0]
+        else:
+            etopic = ANY_TOPIC
+        counts = self.counts
+        if icountries:
+            return sum(counts.get((etopic, icountry, 'visible'), 0) for icountry in icountries)
+        return sum(n for (etopic_, _, visibility), n in counts.items() if etopic_ == etopic and visibility == 'visible')
+
+    def get_all(self) -> Dict[str, Dict[str, Dict[str, int]]]:
+        self.ensure_fresh()
+        return self.matrix
+
+
+_page_counts: Optional[PageCounts] = None
+_page_counts_lock = threading.Lock()
+
+
+def get_page_counts(mongo_host: str, mongo_port: int, mongo_db_name: str, mongo_collection_name: str) -> PageCounts:
+    """Return the page counts of this process, creating them on first use."""
+    global _page_counts
+    with _page_counts_lock:
+        if _page_counts is None:
+            mongo = MongoClient(mongo_host, mongo_port)
+            counts_collection = mongo.get_database(mongo_db_name).get_collection(
+                name=get_counts_collection_name(mongo_collection_name)
+            )
+            _page_counts = PageCounts(counts_collection, get_generation())
+        return _page_counts
@@ -0,0 +1,179 @@
+"""Collapsing of near-duplicate pages at ingest.
+
+`DBHandler.upsert_page` computes a MinHash signature of the English title and snippets of each new page and looks up
+pages with a similar signature in a banded LSH index, the collection `<collection name>_lsh`: a page is indexed under
+one key per band of its signature, so pages sharing any band are candidates, and a candidate is a duplicate when
+the signatures estimate a Jaccard similarity of at least `SIMILARITY_THRESHOLD`. A duplicate is stored in
+`<collection name>_duplicates` with the URL of its canonical page (the first one ingested) instead of in the pages
+collection, so the lists, counts, search indices and exports have one page per cluster.
+
+The lookup is one query on the LSH index and, when there are candidates, one on the pages for at most
+`NUM_BANDS * MAX_BUCKET_URLS` signatures, so the cost of a page does not grow with the corpus.
+
+Pages ingested without dedup have no signature; `DuplicateIndex.backfill` (`cron.py --rebuild_dedup`) indexes them so
+that new articles are collapsed into them too. It does not collapse the near-duplicates among them.
+"""
+import hashlib
+import re
+import time
+import zlib
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from pymongo import ASCENDING, UpdateOne
+
+NUM_PERM = 64
+NUM_BANDS = 8  # of 8 rows: pages become candidates from a similarity of about (1 / NUM_BANDS) ** (1 / 8) = 0.77
+SIMILARITY_THRESHOLD = 0.8
+SHINGLE_SIZE = 3
+MAX_BUCKET_URLS = 8  # the pages kept per LSH key, newest last
+BACKFILL_BATCH_SIZE = 1000
+SIGNATURE_FIELDS = ['page.url', 'page.country', 'page.en_translated.title', 'page.en_snippets']
+
+MERSENNE_PRIME = (1 << 61) - 1
+_rnd = np.random.RandomState(0)  # fixed, since the signatures are stored
+PERM_A = _rnd.randint(1, 1 << 31, NUM_PERM).astype(np.uint64)
+PERM_B = _rnd.randint(0, 1 << 31, NUM_PERM).astype(np.uint64)
+
+WORD_PATTERN = re.compile(r'\w+')
+
+
+def get_lsh_collection_name(mongo_collection_name: str) -> str:
+    return f'{mongo_collection_name}_lsh'
+
+
+def get_duplicates_collection_name(mongo_collection_name: str) -> str:
+    return f'{mongo_collection_name}_duplicates'
+
+
+def get_shingles(page: dict) -> set:
+    """Word `SHINGLE_SIZE`-grams of the English title and snippets of a page reshaped by `upsert_page`."""
+    texts = [page['en_translated']['title']] + sorted(set(page['en_snippets'].values()))
+    shingles = set()
+    for text in texts:
+        words = WORD_PATTERN.findall(text.lower())
+        shingles.update(' '.join(words[i:i + SHINGLE_SIZE]) for i in range(max(1, len(words) - SHINGLE_SIZE + 1)))
+    shingles.discard('')
+    return shingles
+
+
+def get_signature(page: dict) -> Optional[np.ndarray]:
+    shingles = get_shingles(page)
+    if not shingles:
+        return None
+    hashes = np.fromiter((zlib.crc32(shingle.encode()) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+    # Products stay below 2 ** 63, so the permutations do not overflow.
+    return ((hashes[:, None] * PERM_A + PERM_B) % MERSENNE_PRIME).min(axis=0).astype(np.uint32)
+
+
+def get_band_keys(signature: np.ndarray, country: str) -> List[str]:
+    """The LSH keys of a signature; pages of different countries are never duplicates."""
+    rows = NUM_PERM // NUM_BANDS
+    keys = []
+    for band in range(NUM_BANDS):
+        digest = hashlib.blake2b(signature[band * rows:(band + 1) * rows].tobytes(), digest_size=8).hexdigest()
+        keys.append(f'{country}:{band}:{digest}')
+    return keys
+
+
+def get_similarity(signature: np.ndarray, other: np.ndarray) -> float:
+    """The Jaccard similarity of the shingles of two pages estimated from their signatures."""
+    return float(np.count_nonzero(signature == other)) / NUM_PERM
+
+
+class DuplicateIndex:
+
+    def __init__(self, lsh_collection, duplicates_collection):
+        self.lsh_collection = lsh_collection
+        self.duplicates_collection = duplicates_collection
+
+    def create_indexes(self):
+        self.duplicates_collection.create_index('url', unique=True)
+        self.duplicates_collection.create_index('canonical_url')
+
+    def find_duplicate(self, url: str) -> Optional[dict]:
+        return self.duplicates_collection.find_one({'url': url})
+
+    def find_canonical(self, signature: np.ndarray, country: str, tiers: list) -> Optional[str]:
+        """The URL of the page most similar to `signature` above the threshold, if any."""
+        urls = {
+            url
+            for doc in self.lsh_collection.find({'_id': {'$in': get_band_keys(signature, country)}})
+            for url in doc['urls']
+        }
+        best_url, best_similarity = None, SIMILARITY_THRESHOLD
+        for collection in tiers:
+            if not urls:
+                break
+            for doc in collection.find({'page.url': {'$in': list(urls)}}, projection=['page.url', 'minhash']):
+                urls.discard(doc['page']['url'])
+                if 'minhash' not in doc:
+                    continue
+                similarity = get_similarity(signature, np.frombuffer(doc['minhash'], dtype=np.uint32))
+                if similarity >= best_similarity:
+                    best_url, best_similarity = doc['page']['url'], similarity
+        return best_url
+
+    def add_page(self, signature: np.ndarray, country: str, url: str):
+        self.add_pages([(signature, country, url)])
+
+    def add_pages(self, pages: List[Tuple[np.ndarray, str, str]]):
+        """Index `(signature, country, url)` of pages, in the order they were ingested."""
+        urls_by_key: Dict[str, List[str]] = {}
+        for signature, country, url in pages:
+            for key in get_band_keys(signature, country):
+                urls_by_key.setdefault(key, []).append(url)
+        if urls_by_key:
+            self.lsh_collection.bulk_write([
+                UpdateOne({'_id': key}, {'$push': {'urls': {'$each': urls, '$slice': -MAX_BUCKET_URLS}}}, upsert=True)
+                for key, urls in urls_by_key.items()
+            ], ordered=False)
+
+    def update_page(self, doc: dict, signature: Optional[np.ndarray], country: str, url: str):
+        """Move a page from the LSH keys of its stored `doc` to those of its new `signature`, if any."""
+        old_keys = set()
+        if 'minhash' in doc:
+            old_keys = set(get_band_keys(np.frombuffer(doc['minhash'], dtype=np.uint32), doc['page']['country']))
+        new_keys = set(get_band_keys(signature, country)) if signature is not None else set()
+        if old_keys - new_keys:
+            self.lsh_collection.update_many({'_id': {'$in': list(old_keys - new_keys)}}, {'$pull': {'urls': url}})
+        if new_keys - old_keys:
+            self.lsh_collection.bulk_write([
+                UpdateOne({'_id': key}, {'$push': {'urls': {'$each': [url], '$slice': -MAX_BUCKET_URLS}}}, upsert=True)
+                for key in new_keys - old_keys
+            ], ordered=False)
+
+    def backfill(self, tiers: list) -> Dict[str, float]:
+        """Compute the signatures of the pages that have none and index them, the oldest first."""
+        started = time.time()
+        stats = {'indexed': 0, 'skipped': 0}
+        for collection in reversed(tiers):  # the archive first, since its pages are the oldest
+            cursor = collection.find(
+                {'minhash': {'$exists': False}}, projection=SIGNATURE_FIELDS,
+                sort=[('page.orig.simple_timestamp', ASCENDING)], batch_size=BACKFILL_BATCH_SIZE,
+            )
+            updates, pages = [], []
+            for doc in cursor:
+                signature = get_signature(doc['page'])
+                if signature is None:
+                    stats['skipped'] += 1
+                    continue
+                updates.append(UpdateOne({'_id': doc['_id']}, {'$set': {'minhash': signature.tobytes()}}))
+                pages.append((signature, doc['page']['country'], doc['page']['url']))
+                if len(updates) == BACKFILL_BATCH_SIZE:
+                    self.backfill_batch(collection, updates, pages, stats)
+                    updates, pages = [], []
+            if updates:
+                self.backfill_batch(collection, updates, pages, stats)
+        stats['seconds'] = time.time() - started
+        return stats
+
+    def backfill_batch(self, collection, updates: List[UpdateOne], pages: list, stats: Dict[str, float]):
+        collection.bulk_write(updates, ordered=False)
+        self.add_pages(pages)
+        stats['indexed'] += len(updates)
+
+    def add_duplicate(self, page: dict, canonical_url: str):
+        duplicate = {'url': page['url'], 'canonical_url': canonical_url, 'page': page, 'updated_at': datetime.utcnow()}
+        self.duplicates_collection.update_one({'url': page['url']}, {'$set': duplicate}, upsert=True)
@@ -0,0 +1,56 @@
+"""Streaming of the pages for `/export`.
+
+The pages are read with a cursor sorted on the date alone, which the date index serves without sorting in memory,
+fetched `EXPORT_BATCH_SIZE` documents at a time with only the fields of the requested language, and written as
+newline-delimited JSON in chunks of about `EXPORT_CHUNK_BYTES`, so that memory use does not depend on the size of the
+export.
+"""
+import json
+from typing import AsyncIterator, Dict, Iterable, Iterator, List
+
+from pymongo import DESCENDING
+
+EXPORT_BATCH_SIZE = 1000
+EXPORT_CHUNK_BYTES = 64 * 1024
+EXPORT_SORT = [('page.orig.simple_timestamp', DESCENDING)]
+
+PAGE_FIELDS = [
+    'country', 'displayed_country', 'orig', 'url', 'topics', 'is_checked', 'is_hidden', 'is_about_COVID-19',
+    'is_useful', 'is_clear', 'is_about_false_rumor', 'domain',
+]
+LANG_PAGE_FIELDS = ['snippets', 'translated', 'domain_label']
+
+
+def get_export_projection(lang: str) -> Dict[str, bool]:
+    """The fields `DBHandler.reshape_page` needs to build the pages in `lang`."""
+    fields = PAGE_FIELDS + [f'{lang}_{field}' for field in LANG_PAGE_FIELDS]
+    return dict({f'page.{field}': True for field in fields}, _id=False)
+
+
+def iterate_chunks(pages: Iterable[dict]) -> Iterator[bytes]:
+    """Serialize pages as NDJSON, a chunk of lines at a time."""
+    lines: List[bytes] = []
+    size = 0
+    for page in pages:
+        line = json.dumps(page, ensure_ascii=False).encode() + b'\n'
+        lines.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_BYTES:
+            yield b''.join(lines)
+            lines, size = [], 0
+    if lines:
+        yield b''.join(lines)
+
+
+async def iterate_chunks_async(pages: AsyncIterator[dict]) -> AsyncIterator[bytes]:
+    lines: List[bytes] = []
+    size = 0
+    async for page in pages:
+        line = json.dumps(page, ensure_ascii=False).encode() + b'\n'
+        lines.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_BYTES:
+            yield b''.join(lines)
+            lines, size = [], 0
+    if lines:
+        yield b''.join(lines)
@@ -0,0 +1,282 @@
+"""An in-process index of the visible pages answering `DBHandler.get_pages` without MongoDB.
+
+Pages are stored column-wise: for each column, row `i` holds the value of the `i`-th loaded page.
+Filters are byte-per-row flag arrays (one per topic and per country), intersected as big integers; orderings for each
+combination of sort topics are sorted once and reused, and so are the rows of each cell (topics and countries) in the
+order of its topics, so that a page of a cell is a slice of them. The index is refreshed incrementally, from the pages
+modified since the last refresh, whenever the data generation moves: the rows of the pages that changed are moved
+within the cached orderings and cells, which are only rebuilt when many pages changed at once.
+"""
+import math
+import threading
+from array import array
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import MongoClient
+
+from generation import Generation, get_generation
+from page_archive import get_archive_collection_name
+
+# Pages modified this long before the last refresh are read again, so that writes committed late are not missed.
+REFRESH_MARGIN = timedelta(seconds=60)
+# Above this share of the rows changed by a refresh, the orderings and cells are rebuilt instead of updated.
+MAX_INCREMENTAL_SHARE = 0.05
+
+
+class PageRecord:
+
+    __slots__ = ('page', 'views')
+
+    def __init__(self, page: dict):
+        self.page = page
+        self.views: Dict[str, dict] = {}
+
+    def view(self, lang: str) -> dict:
+        """The page as served in `lang`. Views are shared between requests and must not be modified."""
+        view = self.views.get(lang)
+        if view is None:
+            from db_handler import DBHandler
+            view = self.views[lang] = DBHandler.reshape_page(dict(self.page), lang)
+        return view
+
+
+class PageIndex:
+
+    def __init__(self, collection, generation: Generation, archive_collection=None):
+        self.collection = collection
+        self.archive_collection = archive_collection
+        self.generation = generation
+        self.lock = threading.RLock()
+        self.loaded_generation: Optional[int] = None
+        self.checkpoint: Optional[datetime] = None
+
+        self.records: List[PageRecord] = []
+        self.row_of_url: Dict[str, int] = {}
+        self.days = array('l')  # `page.orig.simple_timestamp` as a proleptic Gregorian ordinal
+        self.visible = bytearray()
+        self.topic_flags: Dict[str, bytearray] = {}
+        self.topic_scores: Dict[str, array] = {}  # -inf where a page does not have the topic
+        self.country_flags: Dict[str, bytearray] = {}
+
+        self.orderings: Dict[Tuple[str, ...], List[int]] = {}
+        self.cells: Dict[Tuple[Tuple[str, ...], Tuple[str, ...]], List[int]] = {}
+
+    def ensure_fresh(self):
+        generation = self.generation.current()
+        if generation == self.loaded_generation:
+            return
+        with self.lock:
+            if generation == self.loaded_generation:
+                return
+            self.refresh()
+            self.loaded_generation = generation
+
+    def refresh(self):
+        """Load the pages modified since the last refresh, or all the visible pages on the first call.
+
+        The archived pages are loaded too, so the index answers for both tiers; see `page_archive`.
+        """
+        from db_handler import DBHandler
+        if self.checkpoint is None:
+            filter_ = DBHandler.get_filter()
+        else:
+            filter_ = {'updated_at': {'$gte': self.checkpoint - REFRESH_MARGIN}}
+        checkpoint = self.checkpoint
+        collections = [self.collection] + ([self.archive_collection] if self.archive_collection is not None else [])
+        pages = []
+        for collection in collections:
+            for doc in collection.find(filter_):
+                row = self.row_of_url.get(doc['page']['url'])
+                if row is None or self.records[row].page != doc['page']:
+                    pages.append(doc['page'])
+                if doc.get('updated_at') and (checkpoint is None or doc['updated_at'] > checkpoint):
+                    checkpoint = doc['updated_at']
+        self.checkpoint = checkpoint or datetime.utcnow()
+        if len(pages) > MAX_INCREMENTAL_SHARE * len(self.records):
+            for page in pages:
+                self.put(page)
+            self.orderings.clear()
+            self.cells.clear()
+        else:
+            for page in pages:
+                self.update(page)
+
+    def update(self, page: dict):
+        """`put` a page and move its row within the cached orderings and cells."""
+        row = self.row_of_url.get(page['url'])
+        if row is not None:
+            for itopics, ordering in self.orderings.items():
+                del ordering[self.find_position(ordering, self.get_sort_key(itopics), row)]
+            for (itopics, _), rows in self.cells.items():
+                position = self.find_position(rows, self.get_sort_key(itopics), row)
+                if position < len(rows) and rows[position] == row:
+                    del rows[position]
+        self.put(page)
+        row = self.row_of_url.get(page['url'])
+        if row is None:
+            return
+        for itopics, ordering in self.orderings.items():
+            sort_key = self.get_sort_key(itopics)
+            ordering.insert(self.find_position(ordering, sort_key, row), row)
+        for (itopics, icountries), rows in self.cells.items():
+            if self.matches(row, itopics, icountries):
+                rows.insert(self.find_position(rows, self.get_sort_key(itopics), row), row)
+
+    def put(self, page: dict):
+        row = self.row_of_url.get(page['url'])
+        is_visible = page.get('is_about_COVID-19') == 1 and page.get('is_hidden') == 0
+        if row is None:
+            if not is_visible:
+                return
+            row = len(self.records)
+            self.row_of_url[page['url']] = row
+            self.records.append(PageRecord(page))
+            self.days.append(0)
+            self.visible.append(0)
+            for flags in self.topic_flags.values():
+                flags.append(0)
+            for scores in self.topic_scores.values():
+                scores.append(-math.inf)
+            for flags in self.country_flags.values():
+                flags.append(0)
+        else:
+            old_page = self.records[row].page
+            for itopic in old_page['topics']:
+                self.topic_flags[itopic][row] = 0
+                self.topic_scores[itopic][row] = -math.inf
+            self.country_flags[old_page['displayed_country']][row] = 0
+            self.records[row] = PageRecord(page)
+
+        self.days[row] = date.fromisoformat(page['orig']['simple_timestamp']).toordinal()
+        self.visible[row] = 1 if is_visible else 0
+        for itopic, score in page['topics'].items():
+            if itopic not in self.topic_flags:
+                self.topic_flags[itopic] = bytearray(len(self.records))
+                self.topic_scores[itopic] = array('d', [-math.inf]) * len(self.records)
+            self.topic_flags[itopic][row] = 1
+            self.topic_scores[itopic][row] = score
+        country = page['displayed_country']
+        if country not in self.country_flags:
+            self.country_flags[country] = bytearray(len(self.records))
+        self.country_flags[country][row] = 1
+
+    def get_sort_key(self, itopics: Tuple[str, ...]):
+        days = self.days
+        columns = [self.topic_scores.get(itopic) for itopic in itopics]
+        columns = [column for column in columns if column is not None]
+        return lambda row: (-days[row], *(-column[row] for column in columns), row)
+
+    @staticmethod
+    def find_position(ordering: List[int], sort_key, row: int) -> int:
+        """The index of `row` in `ordering`, or where to insert it."""
+        key = sort_key(row)
+        lo, hi = 0, len(ordering)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if sort_key(ordering[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def get_ordering(self, itopics: Tuple[str, ...]) -> List[int]:
+        """Rows in the order of `DBHandler.get_sort(itopics)`, ties broken by load order."""
+        ordering = self.orderings.get(itopics)
+        if ordering is None:
+            ordering = self.orderings[itopics] = sorted(range(len(self.records)), key=self.get_sort_key(itopics))
+        return ordering
+
+    def matches(self, row: int, itopics: Tuple[str, ...], icountries: Tuple[str, ...]) -> int:
+        if not self.visible[row]:
+            return 0
+        for flags_by_key, keys in ((self.topic_flags, itopics), (self.country_flags, icountries)):
+            if keys and not any(k in flags_by_key and flags_by_key[k][row] for k in keys):
+                return 0
+        return 1
+
+    def get_cell(self, itopics: Tuple[str, ...], icountries: Tuple[str, ...]) -> List[int]:
+        """The rows matching `DBHandler.get_filter(itopics, icountries)`, in the order of `get_ordering(itopics)`."""
+        key = (itopics, icountries)
+        rows = self.cells.get(key)
+        if rows is None:
+            mask = self.get_mask(itopics, icountries)
+            rows = self.cells[key] = [row for row in self.get_ordering(itopics) if mask[row]]
+        return rows
+
+    def get_mask(self, itopics: Tuple[str, ...], icountries: Tuple[str, ...]) -> bytes:
+        """A byte per row, 1 if the row matches `DBHandler.get_filter(itopics, icountries)`."""
+        value = int.from_bytes(self.visible, 'little')
+        for flags_by_key, keys in ((self.topic_flags, itopics), (self.country_flags, icountries)):
+            if keys:
+                union = 0
+                for k in keys:
+                    if k in flags_by_key:
+                        union |= int.from_bytes(flags_by_key[k], 'little')
+                value &= union
+        return value.to_bytes(len(self.records), 'little')
+
+    def get_window(self, ordering: List[int], since: str = None, until: str = None) -> Tuple[int, int]:
+        """The range of `ordering` (sorted by date, newest first) of the rows dated from `since` to `until`."""
+        days = self.days
+
+        def first_older_than(day: int) -> int:
+            lo, hi = 0, len(ordering)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if days[ordering[mid]] > day:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo
+
+        begin = first_older_than(date.fromisoformat(until).toordinal()) if until else 0
+        end = first_older_than(date.fromisoformat(since).toordinal() - 1) if since else len(ordering)
+        return begin, end
+
+    def get_rows(
+            self, itopics: List[str], icountries: List[str], since: str = None, until: str = None
+    ) -> Tuple[List[int], int, int]:
+        """The rows of a cell and the range of them dated from `since` to `until`."""
+        rows = self.get_cell(tuple(itopics or ()), tuple(icountries or ()))
+        return (rows, *self.get_window(rows, since, until))
+
+    def get_pages(
+            self,
+            itopics: List[str],
+            icountries: List[str],
+            start: int,
+            limit: int,
+            lang: str,
+            since: str = None,
+            until: str = None,
+    ) -> List[dict]:
+        self.ensure_fresh()
+        with self.lock:
+            rows, begin, end = self.get_rows(itopics, icountries, since, until)
+            return [self.records[row].view(lang) for row in rows[begin + start:min(begin + start + limit, end)]]
+
+    def count_pages(self, itopics: List[str], icountries: List[str], since: str = None, until: str = None) -> int:
+        self.ensure_fresh()
+        with self.lock:
+            _, begin, end = self.get_rows(itopics, icountries, since, until)
+            return end - begin
+
+
+_page_index = None
+_page_index_lock = threading.Lock()
+
+
+def get_page_index(
+        mongo_host: str, mongo_port: int, mongo_db_name: str, mongo_collection_name: str, use_archive: bool = False
+) -> PageIndex:
+    """Return the page index of this process, creating it on first use."""
+    global _page_index
+    with _page_index_lock:
+        if _page_index is None:
+            db = MongoClient(mongo_host, mongo_port).get_database(mongo_db_name)
+            archive_collection = None
+            if use_archive:
+                archive_collection = db.get_collection(name=get_archive_collection_name(mongo_collection_name))
+            _page_index = PageIndex(db.get_collection(name=mongo_collection_name), get_generation(), archive_collection)
+        return _page_index
@@ -0,0 +1,166 @@
+"""Request parameters and errors shared by the WSGI and ASGI applications."""
+from datetime import date
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+from mojimoji import han_to_zen
+
+from util import ECOUNTRY_ICOUNTRIES_MAP, ECOUNTRY_TRANS_MAP, ETOPIC_ITOPICS_MAP, ETOPIC_TRANS_MAP
+
+MAX_BATCH_EDITS = 1000
+QUEUE_ORDERS = ('useful', 'rumor')
+
+
+class InvalidUsage(Exception):
+
+    status_code = 400
+
+    def __init__(self, message, status_code=None, payload=None):
+        Exception.__init__(self)
+        self.message = message
+        if status_code is not None:
+            self.status_code = status_code
+        self.payload = payload
+
+    def to_dict(self):
+        rv = dict(self.payload or ())
+        rv['message'] = self.message
+        return rv
+
+
+class InvalidPassword(Exception):
+
+    status_code = 403
+
+    def __init__(self, message, status_code=None, payload=None):
+        Exception.__init__(self)
+        self.message = message
+        if status_code is not None:
+            self.status_code = status_code
+        self.payload = payload
+
+    def to_dict(self):
+        rv = dict(self.payload or ())
+        rv['message'] = self.message
+        return rv
+
+
+class TooManyRequests(Exception):
+
+    status_code = 429
+
+    def __init__(self, message, retry_after: int, payload=None):
+        Exception.__init__(self)
+        self.message = message
+        self.retry_after = retry_after
+        self.payload = payload
+
+    def to_dict(self):
+        rv = dict(self.payload or ())
+        rv['message'] = self.message
+        return rv
+
+
+def get_start(args: Mapping[str, str]) -> int:
+    start = args.get('start', '0')  # NOTE: set the default value as a string object.
+    if not start.isdecimal():
+        raise InvalidUsage('Parameter `start` must be an integer.')
+    return int(start)
+
+
+def get_limit(args: Mapping[str, str], max_limit: Optional[int] = None) -> int:
+    """The `limit` parameter, lowered to `max_limit` if it is larger."""
+    limit = args.get('limit', '10')  # NOTE: set the default value as a string object.
+    if not limit.isdecimal():
+        raise InvalidUsage('Parameter `limit` must be an integer.')
+    if max_limit is not None:
+        return min(int(limit), max_limit)
+    return int(limit)
+
+
+def get_lang(args: Mapping[str, str]) -> str:
+    lang = args.get('lang', 'ja')
+    if lang not in {'ja', 'en'}:
+        raise InvalidUsage('Allowed languages are `ja` and `en`.')
+    return lang
+
+
+def get_query(args: Mapping[str, str]) -> str:
+    return args.get('query', '')
+
+
+def get_with_total(args: Mapping[str, str]) -> bool:
+    return args.get('total', '0').lower() in {'1', 'true'}
+
+
+def get_date_range(args: Mapping[str, str]) -> Tuple[Optional[str], Optional[str]]:
+    """The `since` and `until` dates (inclusive, `YYYY-MM-DD`) of the pages to list; `None` when not given."""
+    dates = []
+    for key in ('since', 'until'):
+        value = args.get(key) or None
+        if value is not None:
+            try:
+                value = date.fromisoformat(value).isoformat()
+            except ValueError:
+                raise InvalidUsage(f'Parameter `{key}` must be a date in the format of `YYYY-MM-DD`.')
+        dates.append(value)
+    since, until = dates
+    if since and until and since > until:
+        raise InvalidUsage('Parameter `since` must not be after `until`.')
+    return since, until
+
+
+def get_export_cell(args: Mapping[str, str]) -> Tuple[List[str], List[str]]:
+    """The topics and countries of the pages to export, given by name in `topic` and `country` (all by default)."""
+    etopic = args.get('topic') or 'all'
+    etopic = ETOPIC_TRANS_MAP.get((etopic, 'ja'), etopic)
+    if etopic not in ETOPIC_ITOPICS_MAP:
+        raise InvalidUsage(f'Unknown topic `{args.get("topic")}`.')
+    return ETOPIC_ITOPICS_MAP[etopic], get_icountries(args)
+
+
+def get_icountries(args: Mapping[str, str]) -> List[str]:
+    """The countries given by name in `country` (all by default)."""
+    ecountry = args.get('country') or 'all'
+    ecountry = ECOUNTRY_TRANS_MAP.get((ecountry, 'ja'), ecountry)
+    if ecountry not in ECOUNTRY_ICOUNTRIES_MAP:
+        raise InvalidUsage(f'Unknown country `{args.get("country")}`.')
+    return ECOUNTRY_ICOUNTRIES_MAP[ecountry]
+
+
+def get_queue_args(data: Mapping[str, Any]) -> Dict[str, str]:
+    """The parameters of a `/queue` request body, as strings like those of a query string."""
+    return {key: str(value) for key, value in data.items() if key != 'password' and value is not None}
+
+
+def get_queue_order(args: Mapping[str, str]) -> str:
+    order = args.get('order', 'useful')
+    if order not in QUEUE_ORDERS:
+        raise InvalidUsage(f'Parameter `order` must be one of {", ".join(f"`{order_}`" for order_ in QUEUE_ORDERS)}.')
+    return order
+
+
+def get_visible_only(args: Mapping[str, str]) -> bool:
+    return args.get('visible_only', '0').lower() in {'1', 'true'}
+
+
+def get_page_edit(data: Mapping[str, Any]) -> Dict[str, Any]:
+    """Convert an edit posted by an editor to the keyword arguments of `DBHandler.update_page`."""
+    return dict(
+        url=data.get('url'),
+        is_hidden=data.get('is_hidden'),
+        is_about_covid_19=data.get('is_about_COVID-19'),
+        is_useful=data.get('is_useful'),
+        is_about_false_rumor=data.get('is_about_false_rumor'),
+        icountry=data.get('new_displayed_country'),
+        etopics=data.get('new_classes'),
+        notes=han_to_zen(str(data.get('notes'))),
+    )
+
+
+def get_page_edits(data: Mapping[str, Any]) -> List[Dict[str, Any]]:
+    edits = data.get('edits')
+    if not isinstance(edits, list) or not all(isinstance(edit, dict) for edit in edits):
+        raise InvalidUsage('Parameter `edits` must be a list of objects.')
+    if len(edits) > MAX_BATCH_EDITS:
+        raise InvalidUsage(f'At most {MAX_BATCH_EDITS} edits can be sent at once.')
+    return [get_page_edit(edit) for edit in edits]
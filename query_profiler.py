@@ -0,0 +1,238 @@
+"""An opt-in profiler recording slow MongoDB operations with their query shape and winning plan.
+
+Operations slower than the threshold are appended as JSON lines to a log shared by the processes of the host. The log
+is not rotated here, as several gunicorn workers rotating the same file would lose records; rotate it externally (e.g.,
+with logrotate), and each process reopens the file once it is moved. The winning plan and the numbers of examined and
+returned documents are captured by running `explain` on a background thread, at most once per query shape
+and interval, so that profiling never adds to the latency of the request being served.
+"""
+import glob
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import statistics
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional
+
+from pymongo import MongoClient, monitoring
+
+PROFILED_COMMANDS = {'find', 'aggregate', 'count', 'distinct', 'update', 'delete', 'findAndModify'}
+
+
+def get_shape(value):
+    """Replace the values of a query with placeholders, keeping field names and operators."""
+    if isinstance(value, dict):
+        return {key: get_shape(value_) for key, value_ in value.items()}
+    if isinstance(value, (list, tuple)):
+        if value and all(isinstance(value_, dict) for value_ in value):
+            return [get_shape(value_) for value_ in value]
+        return ['?']
+    return '?'
+
+
+def get_filter(command_name: str, command: dict) -> dict:
+    if command_name == 'find':
+        return command.get('filter', {})
+    if command_name in {'count', 'distinct'}:
+        return command.get('query', {})
+    if command_name == 'findAndModify':
+        return command.get('query', {})
+    if command_name in {'update', 'delete'}:
+        statements = command.get('updates') or command.get('deletes') or [{}]
+        return statements[0].get('q', {})
+    if command_name == 'aggregate':
+        pipeline = command.get('pipeline', [])
+        return pipeline[0].get('$match', {}) if pipeline else {}
+    return {}
+
+
+def summarize_plan(plan: dict) -> str:
+    """Summarize a plan tree like `LIMIT > FETCH > IXSCAN(page.orig.simple_timestamp_-1)`."""
+    stages = []
+    while plan:
+        stage = plan.get('stage', '?')
+        if 'indexName' in plan:
+            stage += f'({plan["indexName"]})'
+        stages.append(stage)
+        if 'inputStage' in plan:
+            plan = plan['inputStage']
+        elif plan.get('inputStages'):
+            stages.append('[' + ', '.join(summarize_plan(p) for p in plan['inputStages']) + ']')
+            break
+        else:
+            break
+    return ' > '.join(stages)
+
+
+class SlowQueryProfiler(monitoring.CommandListener):
+
+    def __init__(
+            self,
+            mongo_host: str,
+            mongo_port: int,
+            log_path: str,
+            threshold_ms: float = 100.,
+            explain_interval: float = 600.,
+    ):
+        self.mongo_host = mongo_host
+        self.mongo_port = mongo_port
+        self.threshold_ms = threshold_ms
+        self.explain_interval = explain_interval
+        self.started_commands: Dict[tuple, dict] = {}
+        self.explained: Dict[str, tuple] = {}  # shape key -> (time, explain summary)
+        self.queue = queue.Queue(maxsize=1000)
+        self.lock = threading.Lock()
+        self.worker: Optional[threading.Thread] = None
+        self.worker_pid: Optional[int] = None
+
+        os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok=True)
+        self.log = logging.getLogger(f'{__name__}.{log_path}')
+        self.log.propagate = False
+        self.log.setLevel(logging.INFO)
+        handler = logging.handlers.WatchedFileHandler(log_path)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.log.addHandler(handler)
+
+    def start_worker(self):
+        """Start the explain thread of this process; threads do not survive the fork of a preloading server."""
+        with self.lock:
+            if self.worker_pid != os.getpid():
+                self.worker_pid = os.getpid()
+                self.worker = threading.Thread(target=self.work, daemon=True)
+                self.worker.start()
+
+    def started(self, event):
+        if event.command_name in PROFILED_COMMANDS:
+            with self.lock:
+                self.started_commands[(event.connection_id, event.request_id)] = event.command
+
+    def succeeded(self, event):
+        self.finish(event, failed=False)
+
+    def failed(self, event):
+        self.finish(event, failed=True)
+
+    def finish(self, event, failed: bool):
+        if event.command_name not in PROFILED_COMMANDS:
+            return
+        with self.lock:
+            command = self.started_commands.pop((event.connection_id, event.request_id), None)
+        duration_ms = event.duration_micros / 1000
+        if command is None or duration_ms < self.threshold_ms:
+            return
+        record = {
+            'time': datetime.now().isoformat(),
+            'database': event.database_name,
+            'collection': command.get(event.command_name),
+            'command': event.command_name,
+            'shape': get_shape(get_filter(event.command_name, command)),
+            'sort': list(dict(command.get('sort') or {}).items()),
+            'skip': command.get('skip', 0),
+            'limit': command.get('limit', 0),
+            'duration_ms': duration_ms,
+            'failed': failed,
+        }
+        if not failed and event.command_name == 'find':
+            record['docs_returned'] = len(event.reply.get('cursor', {}).get('firstBatch', []))
+        if self.worker_pid != os.getpid():
+            self.start_worker()
+        try:
+            self.queue.put_nowait((record, command))
+        except queue.Full:
+            pass
+
+    def work(self):
+        mongo: Optional[MongoClient] = None
+        while True:
+            record, command = self.queue.get()
+            try:
+                if record['command'] == 'find':
+                    if mongo is None:
+                        mongo = MongoClient(self.mongo_host, self.mongo_port)
+                    record.update(self.explain(mongo, record, command))
+            except Exception as e:
+                record['explain_error'] = str(e)
+            self.log.info(json.dumps(record, ensure_ascii=False, default=str))
+
+    def explain(self, mongo: MongoClient, record: dict, command: dict) -> dict:
+        key = json.dumps([record['collection'], record['shape'], record['sort']], ensure_ascii=False, sort_keys=True)
+        explained_at, summary = self.explained.get(key, (0., None))
+        if summary is not None and time.time() - explained_at < self.explain_interval:
+            return dict(summary, explain_cached=True)
+
+        explained_command = {k: command[k] for k in ('find', 'filter', 'sort', 'skip', 'limit', 'projection')
+                             if k in command}
+        explanation = mongo.get_database(record['database']).command(
+            'explain', explained_command, verbosity='executionStats'
+        )
+        stats = explanation.get('executionStats', {})
+        winning_plan = explanation.get('queryPlanner', {}).get('winningPlan', {})
+        summary = {
+            'docs_examined': stats.get('totalDocsExamined'),
+            'keys_examined': stats.get('totalKeysExamined'),
+            'n_returned': stats.get('nReturned'),
+            'plan': summarize_plan(winning_plan),
+            'winning_plan': winning_plan,
+        }
+        self.explained[key] = (time.time(), summary)
+        return summary
+
+
+_installed = False
+
+
+def install(mongo_host: str, mongo_port: int, enabled: bool = False, **kwargs):
+    """Register the profiler if enabled.
+
+    This must be called from the entry point of a process, before any `MongoClient` is created.
+    """
+    global _installed
+    if enabled and not _installed:
+        monitoring.register(SlowQueryProfiler(mongo_host, mongo_port, **kwargs))
+        _installed = True
+
+
+def iterate_records(log_path: str) -> Iterator[dict]:
+    """Read the log and the files rotated out of it (`<log_path>.1`, `<log_path>.2.gz`, ...), oldest first."""
+    paths = sorted(glob.glob(f'{glob.escape(log_path)}.*'), key=os.path.getmtime) + [log_path]
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with (gzip.open(path, 'rt') if path.endswith('.gz') else open(path)) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def summarize_records(records: Iterator[dict]) -> List[dict]:
+    """Group slow operations by shape and order the groups by their total time."""
+    groups: Dict[str, List[dict]] = {}
+    for record in records:
+        key = json.dumps([record['collection'], record['command'], record['shape'], record['sort']],
+                         ensure_ascii=False, sort_keys=True)
+        groups.setdefault(key, []).append(record)
+
+    summaries = []
+    for key, group in groups.items():
+        durations = sorted(record['duration_ms'] for record in group)
+        explained = [record for record in group if record.get('docs_examined') is not None]
+        latest = explained[-1] if explained else {}
+        summaries.append({
+            'collection': group[0]['collection'],
+            'command': group[0]['command'],
+            'shape': group[0]['shape'],
+            'sort': group[0]['sort'],
+            'count': len(group),
+            'total_ms': sum(durations),
+            'median_ms': statistics.median(durations),
+            'max_ms': durations[-1],
+            'docs_examined': latest.get('docs_examined'),
+            'n_returned': latest.get('n_returned'),
+            'plan': latest.get('plan'),
+        })
+    return sorted(summaries, key=lambda summary: summary['total_ms'], reverse=True)
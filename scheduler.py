@@ -0,0 +1,115 @@
+"""A scheduler of the cron jobs for `cron.py --daemon`.
+
+Jobs run on their own intervals in one process, each in its own thread, so that a long database update does not delay
+the stats. Every run holds a lock file of its job (`job_lock`), which one-shot `cron.py` runs take too, so the same job
+never runs twice at once on the host. A failed job is retried after `retry_seconds`, doubled on each consecutive
+failure up to its interval.
+"""
+import fcntl
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__file__)
+
+LOCK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'locks')
+
+
+@contextmanager
+def job_lock(name: str, lock_dir: str = LOCK_DIR) -> Iterator[bool]:
+    """Take the lock of job `name` if no other process holds it; yields whether it was taken."""
+    os.makedirs(lock_dir, exist_ok=True)
+    fd = os.open(os.path.join(lock_dir, f'{name}.lock'), os.O_RDWR | os.O_CREAT, 0o664)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            os.ftruncate(fd, 0)
+            os.write(fd, f'{os.getpid()}\n'.encode())
+            yield True
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+class Job:
+
+    def __init__(self, name: str, fn: Callable[[], None], interval: float, retry_seconds: float = 60.):
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.retry_seconds = retry_seconds
+        self.next_run = 0.  # run on start
+        self.failures = 0
+
+    def get_delay(self, succeeded: bool) -> float:
+        """The time until the next run after a run."""
+        if succeeded:
+            self.failures = 0
+            return self.interval
+        self.failures += 1
+        return min(self.retry_seconds * 2 ** (self.failures - 1), max(self.interval, self.retry_seconds))
+
+
+class Scheduler:
+
+    def __init__(self, jobs: List[Job], lock_dir: str = LOCK_DIR):
+        self.jobs = jobs
+        self.lock_dir = lock_dir
+        self.running: Dict[str, Future] = {}
+        self.lock = threading.RLock()  # a future done on submission runs its callback in the submitting thread
+        self.stopped = threading.Event()
+        self.wakeup = threading.Event()  # set when a job finishes or the scheduler is stopped
+
+    def run_job(self, job: Job) -> Optional[bool]:
+        """Run a job under its lock; returns whether it succeeded, or None if another process is running it."""
+        with job_lock(job.name, self.lock_dir) as locked:
+            if not locked:
+                logger.info(f'Skip {job.name}: another process is running it.')
+                return None
+            started = time.time()
+            try:
+                job.fn()
+            except Exception:
+                logger.exception(f'{job.name} failed.')
+                return False
+            logger.info(f'{job.name} finished in {time.time() - started:.1f} s.')
+            return True
+
+    def on_done(self, job: Job, future: Future):
+        succeeded = future.result()
+        # A job skipped because another process runs it is tried again on its interval.
+        delay = job.get_delay(succeeded is not False)
+        if succeeded is False:
+            logger.warning(f'Retry {job.name} in {delay:.0f} s ({job.failures} consecutive failures).')
+        with self.lock:
+            job.next_run = time.monotonic() + delay
+            del self.running[job.name]
+        self.wakeup.set()
+
+    def run(self):
+        """Run the jobs until `stop` is called, then wait for the running ones."""
+        with ThreadPoolExecutor(max_workers=len(self.jobs)) as executor:
+            while not self.stopped.is_set():
+                self.wakeup.clear()
+                with self.lock:
+                    now = time.monotonic()
+                    for job in self.jobs:
+                        if job.name not in self.running and job.next_run <= now:
+                            future = self.running[job.name] = executor.submit(self.run_job, job)
+                            future.add_done_callback(lambda future_, job_=job: self.on_done(job_, future_))
+                    waiting = [job.next_run for job in self.jobs if job.name not in self.running]
+                timeout = max(0., min(waiting) - time.monotonic()) if waiting else None
+                self.wakeup.wait(timeout)
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
@@ -0,0 +1,169 @@
+"""Keep the ElasticSearch indices searched by `DBHandler.search` in sync with MongoDB.
+
+Pages written since the last sync (by cron or by editors through `/update`) are sent to both indices with bulk
+requests: visible pages are (re)indexed and the others are deleted, so that hidden pages and country reassignments
+reach the search results. Each document also carries the page as `DBHandler.reshape_page` serves it and the time the
+page was written, so that search can answer without looking the hits up in MongoDB as long as the page has not been
+written since. The checkpoint and the figures of the last sync are kept in a small JSON file.
+"""
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from db_handler import DBHandler, SEARCH_VIEW_VERSION
+from local_search import FallbackSearch, LocalSearch
+
+logger = logging.getLogger(__file__)
+
+SYNC_STATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'search_sync.json')
+
+# Pages modified this long before the checkpoint are sent again, so that writes committed late are not missed.
+SYNC_MARGIN = timedelta(seconds=60)
+
+LANGS = ('ja', 'en')
+
+ES_MAPPINGS = {
+    'properties': {
+        'url': {'type': 'keyword'},
+        'region': {'type': 'keyword'},
+        'text': {'type': 'text'},
+        'timestamp': {'type': 'nested', 'properties': {'local': {'type': 'date'}}},
+        'view': {'type': 'object', 'enabled': False},
+        'view_version': {'type': 'integer'},
+        'updated_at': {'type': 'date'},
+    }
+}
+
+
+class SearchSync:
+    """Sync the search indices of `es` (ElasticSearch or a `LocalSearch`) with the pages of `db_handler`."""
+
+    def __init__(self, db_handler, es=None, state_path: str = None, batch_size: int = 500):
+        self.collections = db_handler.get_tiers()
+        self.es = es or db_handler.es
+        self.get_es_index = db_handler.get_es_index
+        if state_path is None:
+            # The checkpoint of a local index is kept with its files, so that removing them starts over.
+            state_path = os.path.join(self.es.search_dir, 'sync.json') if isinstance(self.es, LocalSearch) \
+                else SYNC_STATE_PATH
+        self.state_path = state_path
+        self.batch_size = batch_size
+
+    @classmethod
+    def for_db_handler(cls, db_handler, batch_size: int = 500) -> List['SearchSync']:
+        """The syncs of all the search backends `db_handler` queries."""
+        if isinstance(db_handler.es, FallbackSearch):
+            return [cls(db_handler, es, batch_size=batch_size) for es in (db_handler.es.es, db_handler.es.local)]
+        return [cls(db_handler, batch_size=batch_size)]
+
+    def load_state(self) -> dict:
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def save_state(self, state: dict):
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        with open(self.state_path + '.tmp', 'w') as f:
+            json.dump(state, f, indent=4)
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+    def ensure_indices(self):
+        for lang in LANGS:
+            index = self.get_es_index(lang)
+            if not self.es.indices.exists(index=index):
+                self.es.indices.create(index=index, body={'mappings': ES_MAPPINGS})
+
+    @staticmethod
+    def get_es_doc(page: dict, lang: str, updated_at: Optional[datetime] = None) -> dict:
+        """The document of a page in the index of `lang`, in the shape `DBHandler.get_es_query` searches."""
+        return {
+            'url': page['url'],
+            'region': page['displayed_country'],
+            'text': ' '.join([page[f'{lang}_translated']['title']] + list(page[f'{lang}_snippets'].values())),
+            'timestamp': {'local': page['orig']['timestamp']},
+            'view': DBHandler.reshape_page(dict(page), lang),
+            'view_version': SEARCH_VIEW_VERSION,
+            'updated_at': updated_at.isoformat() if updated_at else None,
+        }
+
+    def get_actions(self, page: dict, updated_at: Optional[datetime] = None) -> List[dict]:
+        actions = []
+        is_visible = page.get('is_about_COVID-19') == 1 and page.get('is_hidden') == 0
+        for lang in LANGS:
+            meta = {'_index': self.get_es_index(lang), '_id': page['url']}
+            if is_visible:
+                actions += [{'index': meta}, self.get_es_doc(page, lang, updated_at)]
+            else:
+                actions.append({'delete': meta})
+        return actions
+
+    def send(self, actions: List[dict], stats: Dict[str, float]):
+        r = self.es.bulk(body=actions)
+        for item in r['items']:
+            (op, result), = item.items()
+            if op == 'delete' and result['status'] == 404:
+                continue  # not indexed in the first place
+            if result['status'] >= 300:
+                stats['errors'] += 1
+                logger.warning(f'Failed to {op} {result.get("_id")} in {result.get("_index")}: {result.get("error")}')
+            else:
+                stats['indexed' if op == 'index' else 'deleted'] += 1
+
+    def sync(self, full: bool = False) -> Dict[str, float]:
+        """Send the pages modified since the last sync (all the pages if `full`) to the search indices.
+
+        Returns the number of pages read, documents indexed and deleted, errors, the throughput in pages per second,
+        and the lag, i.e., how long the oldest change sent had been waiting for the sync.
+        """
+        started, started_at = time.time(), datetime.utcnow()
+        state = self.load_state()
+        checkpoint: Optional[datetime] = None
+        if not full and state.get('checkpoint'):
+            checkpoint = datetime.fromisoformat(state['checkpoint'])
+        if checkpoint is None:
+            self.ensure_indices()
+            filter_ = {}
+        else:
+            filter_ = {'updated_at': {'$gte': checkpoint - SYNC_MARGIN}}
+
+        stats = {'pages': 0, 'indexed': 0, 'deleted': 0, 'errors': 0}
+        new_checkpoint, oldest_change = checkpoint, None
+        actions = []
+        docs = (
+            doc for collection in self.collections
+            for doc in collection.find(filter_, projection=['updated_at', 'page'], batch_size=self.batch_size)
+        )
+        for doc in docs:
+            stats['pages'] += 1
+            updated_at = doc.get('updated_at')
+            actions += self.get_actions(doc['page'], updated_at)
+            if updated_at:
+                if new_checkpoint is None or updated_at > new_checkpoint:
+                    new_checkpoint = updated_at
+                if checkpoint is not None and updated_at > checkpoint and (
+                        oldest_change is None or updated_at < oldest_change):
+                    oldest_change = updated_at
+            if stats['pages'] % self.batch_size == 0:
+                self.send(actions, stats)
+                actions = []
+        if actions:
+            self.send(actions, stats)
+
+        seconds = time.time() - started
+        stats['seconds'] = seconds
+        stats['pages_per_second'] = stats['pages'] / seconds if seconds > 0 else 0.0
+        stats['lag_seconds'] = max(0.0, (started_at - oldest_change).total_seconds()) if oldest_change else 0.0
+        if stats['errors']:
+            new_checkpoint = checkpoint  # send the failed pages again next time
+        elif new_checkpoint is None:
+            new_checkpoint = started_at
+        self.save_state({
+            'checkpoint': new_checkpoint.isoformat() if new_checkpoint else None,
+            'last_sync': dict(stats, finished_at=datetime.utcnow().isoformat()),
+        })
+        return stats
@@ -0,0 +1,118 @@
+"""Coalescing of identical concurrent computations.
+
+When many identical requests miss the cache at once, e.g., right after cron bumps the data generation, only the first
+one queries the backends and the others wait for and share its result. With a stale-while-revalidate window, the
+others are served the previous result instead of waiting, as long as it is not older than the window.
+"""
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+import metrics
+
+
+class Call:
+
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class StaleResults:
+    """The last results of keys, kept for the stale-while-revalidate window."""
+
+    def __init__(self, stale_seconds: float, max_entries: int = 1024):
+        self.stale_seconds = stale_seconds
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (time, result)
+
+    def get(self, key: Hashable):
+        entry = self.entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.stale_seconds:
+            return None
+        return entry
+
+    def set(self, key: Hashable, result):
+        if self.stale_seconds <= 0:
+            return
+        self.entries[key] = (time.monotonic(), result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+class SingleFlight:
+
+    def __init__(self, stale_seconds: float = 0.):
+        self.lock = threading.Lock()
+        self.calls: Dict[Hashable, Call] = {}
+        self.stale = StaleResults(stale_seconds)
+
+    def do(self, key: Hashable, fn: Callable[[], Any]):
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = self.calls[key] = Call()
+                leader = True
+            else:
+                leader = False
+                stale = self.stale.get(key)
+
+        if not leader:
+            if stale is not None:
+                metrics.record_coalesced('stale')
+                return stale[1]
+            metrics.record_coalesced('wait')
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            with self.lock:
+                self.stale.set(key, call.result)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+
+
+class AsyncSingleFlight:
+    """`SingleFlight` for coroutines running on one event loop."""
+
+    def __init__(self, stale_seconds: float = 0.):
+        self.calls: Dict[Hashable, asyncio.Future] = {}
+        self.stale = StaleResults(stale_seconds)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]):
+        future = self.calls.get(key)
+        if future is not None:
+            stale = self.stale.get(key)
+            if stale is not None:
+                metrics.record_coalesced('stale')
+                return stale[1]
+            metrics.record_coalesced('wait')
+            return await asyncio.shield(future)
+
+        future = self.calls[key] = asyncio.get_event_loop().create_future()
+        try:
+            result = await fn()
+            self.stale.set(key, result)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # mark the exception as retrieved when nobody is waiting
+            raise
+        finally:
+            del self.calls[key]
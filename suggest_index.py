@@ -0,0 +1,214 @@
+"""A memory-mapped prefix index of page titles and domain labels answering `/suggest`.
+
+Cron builds one file per language (`build_suggest_index`), and workers map it (`get_suggest_index`).
+The keys are the normalized titles and domain labels, and their suffixes starting at each word, sorted by their UTF-8
+bytes; the keys starting with a query are found by binary search. Suggestions are numbered from the most recent, so
+the top-k of a range of keys are its k smallest suggestion ids. The top-k of the prefixes shared by many keys are
+precomputed, so a query never scans more than `SCAN_LIMIT` keys.
+
+File layout (little endian): a header, then the sections in the order of `SECTIONS`. `key_offsets`, `item_offsets`
+and `prefix_offsets` delimit the UTF-8 strings in `keys`, `items` (JSON) and `prefixes`; `key_items` maps each key to
+its suggestion; `prefix_items` holds `top_k` suggestion ids per prefix, padded with `NO_ITEM`.
+"""
+import heapq
+import json
+import mmap
+import os
+import struct
+import threading
+import unicodedata
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from generation import get_generation
+
+SUGGEST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+MAGIC = b'SGT1'
+HEADER = struct.Struct('<4sIIII')  # magic, number of keys, items, prefixes, top_k
+SECTIONS = ('key_offsets', 'key_items', 'keys', 'item_offsets', 'items', 'prefix_offsets', 'prefixes', 'prefix_items')
+OFFSET_SECTIONS = {'keys': 'key_offsets', 'items': 'item_offsets', 'prefixes': 'prefix_offsets'}
+NO_ITEM = 0xFFFFFFFF
+
+MAX_KEY_CHARS = 64
+SCAN_LIMIT = 256
+TOP_K = 10
+
+
+def get_suggest_path(lang: str, suggest_dir: str = SUGGEST_DIR) -> str:
+    return os.path.join(suggest_dir, f'suggest-{lang}.bin')
+
+
+def normalize(text: str) -> str:
+    return ' '.join(unicodedata.normalize('NFKC', text).lower().split())
+
+
+def is_separator(c: str) -> bool:
+    return unicodedata.category(c)[0] in 'PZ'
+
+
+def get_keys(text: str) -> Iterator[str]:
+    """The keys a text is found by: its suffixes starting at a word, i.e., after a space or a punctuation mark."""
+    normalized = normalize(text)
+    for i, c in enumerate(normalized):
+        if not is_separator(c) and (i == 0 or is_separator(normalized[i - 1])):
+            yield normalized[i:i + MAX_KEY_CHARS]
+
+
+def iterate_suggestions(collection, lang: str) -> Iterator[Tuple[float, dict]]:
+    """Yield `(timestamp, suggestion)` of the titles of the visible pages and of their domain labels."""
+    from db_handler import DBHandler
+    domains: Dict[str, Tuple[float, dict]] = {}
+    projection = ['page.url', 'page.orig.timestamp', f'page.{lang}_translated.title', 'page.domain',
+                  f'page.{lang}_domain_label']
+    for doc in collection.find(DBHandler.get_filter(), projection=projection):
+        page = doc['page']
+        try:
+            timestamp = datetime.fromisoformat(page['orig']['timestamp']).timestamp()
+        except (KeyError, TypeError, ValueError):
+            timestamp = 0.0
+        title = page.get(f'{lang}_translated', {}).get('title')
+        if title:
+            yield timestamp, {'text': title, 'type': 'title', 'url': page['url']}
+        label = page.get(f'{lang}_domain_label')
+        if label and (label not in domains or domains[label][0] < timestamp):
+            domains[label] = (timestamp, {'text': label, 'type': 'domain', 'domain': page.get('domain', '')})
+    yield from domains.values()
+
+
+def build_suggest_index(collection, lang: str, path: str, top_k: int = TOP_K):
+    """Write the suggest index of `lang` to `path`, replacing the previous one atomically."""
+    suggestions = sorted(iterate_suggestions(collection, lang), key=lambda x: x[0], reverse=True)
+    items = [json.dumps(suggestion, ensure_ascii=False).encode('utf-8') for _, suggestion in suggestions]
+    keys = sorted(
+        {(key.encode('utf-8'), item) for item, (_, suggestion) in enumerate(suggestions)
+         for key in get_keys(suggestion['text'])}
+    )
+    prefixes = list(iterate_dense_prefixes(keys, top_k))
+
+    def offsets(blobs: List[bytes]) -> bytes:
+        acc, result = 0, [0]
+        for blob in blobs:
+            acc += len(blob)
+            result.append(acc)
+        return struct.pack(f'<{len(result)}I', *result)
+
+    sections = {
+        'key_offsets': offsets([key for key, _ in keys]),
+        'key_items': struct.pack(f'<{len(keys)}I', *(item for _, item in keys)),
+        'keys': b''.join(key for key, _ in keys),
+        'item_offsets': offsets(items),
+        'items': b''.join(items),
+        'prefix_offsets': offsets([prefix for prefix, _ in prefixes]),
+        'prefixes': b''.join(prefix for prefix, _ in prefixes),
+        'prefix_items': b''.join(
+            struct.pack(f'<{top_k}I', *(top + [NO_ITEM] * (top_k - len(top)))) for _, top in prefixes
+        ),
+    }
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(keys), len(items), len(prefixes), top_k))
+        f.write(struct.pack(f'<{len(SECTIONS)}I', *(len(sections[name]) for name in SECTIONS)))
+        for name in SECTIONS:
+            f.write(sections[name])
+    os.replace(path + '.tmp', path)
+
+
+def iterate_dense_prefixes(keys: List[Tuple[bytes, int]], top_k: int) -> Iterator[Tuple[bytes, List[int]]]:
+    """Yield the prefixes shared by more than `SCAN_LIMIT` keys with their top-k suggestions, in byte order."""
+    decoded = [key.decode('utf-8') for key, _ in keys]
+    dense = []
+    groups = [(0, len(keys))]
+    for length in range(1, MAX_KEY_CHARS + 1):
+        next_groups = []
+        for begin, end in groups:
+            i = begin
+            while i < end:
+                prefix = decoded[i][:length]
+                j = i
+                while j < end and decoded[j][:length] == prefix:
+                    j += 1
+                if j - i > SCAN_LIMIT and len(prefix) == length:
+                    top = heapq.nsmallest(top_k, {item for _, item in keys[i:j]})
+                    dense.append((prefix.encode('utf-8'), top))
+                    next_groups.append((i, j))
+                i = j
+        if not next_groups:
+            break
+        groups = next_groups
+    yield from sorted(dense)
+
+
+class SuggestIndex:
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.stat = os.stat(path)
+        magic, self.num_keys, self.num_items, self.num_prefixes, self.top_k = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a suggest index.')
+        lengths = struct.unpack_from(f'<{len(SECTIONS)}I', self.mm, HEADER.size)
+        self.offsets = {}
+        offset = HEADER.size + 4 * len(SECTIONS)
+        for name, length in zip(SECTIONS, lengths):
+            self.offsets[name] = offset
+            offset += length
+
+    def get_uint(self, section: str, i: int) -> int:
+        return struct.unpack_from('<I', self.mm, self.offsets[section] + 4 * i)[0]
+
+    def get_string(self, section: str, i: int) -> bytes:
+        begin, end = struct.unpack_from('<2I', self.mm, self.offsets[OFFSET_SECTIONS[section]] + 4 * i)
+        return self.mm[self.offsets[section] + begin:self.offsets[section] + end]
+
+    def lower_bound(self, section: str, n: int, target: bytes) -> int:
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get_string(section, mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def suggest(self, query: str, limit: int = TOP_K) -> List[dict]:
+        """The most recent suggestions with a word starting with `query` (the titles' words are matched in order)."""
+        prefix = normalize(query)[:MAX_KEY_CHARS].encode('utf-8')
+        if not prefix or limit <= 0:
+            return []
+        begin = self.lower_bound('keys', self.num_keys, prefix)
+        end = self.lower_bound('keys', self.num_keys, prefix + b'\xff')  # 0xff never occurs in UTF-8
+        top = None
+        if end - begin > SCAN_LIMIT:
+            i = self.lower_bound('prefixes', self.num_prefixes, prefix)
+            if i < self.num_prefixes and self.get_string('prefixes', i) == prefix:
+                base = self.offsets['prefix_items'] + 4 * self.top_k * i
+                top = [item for item in struct.unpack_from(f'<{self.top_k}I', self.mm, base) if item != NO_ITEM]
+        if top is None:
+            items = {self.get_uint('key_items', i) for i in range(begin, min(end, begin + SCAN_LIMIT))}
+            top = heapq.nsmallest(limit, items)
+        return [json.loads(self.get_string('items', item)) for item in top[:limit]]
+
+
+_suggest_indices: Dict[str, Tuple[int, Optional[SuggestIndex]]] = {}
+_suggest_indices_lock = threading.Lock()
+
+
+def get_suggest_index(lang: str, suggest_dir: str = SUGGEST_DIR) -> Optional[SuggestIndex]:
+    """The suggest index of `lang`, mapped again when the data generation moved and the file was replaced."""
+    generation = get_generation().current()
+    loaded = _suggest_indices.get(lang)
+    if loaded is not None and loaded[0] == generation:
+        return loaded[1]
+    with _suggest_indices_lock:
+        path = get_suggest_path(lang, suggest_dir)
+        index = loaded[1] if loaded else None
+        try:
+            stat = os.stat(path)
+            if index is None or (stat.st_ino, stat.st_mtime) != (index.stat.st_ino, index.stat.st_mtime):
+                index = SuggestIndex(path)
+        except FileNotFoundError:
+            index = None
+        _suggest_indices[lang] = (generation, index)
+        return index